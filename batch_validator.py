@@ -17,6 +17,8 @@ import argparse
 from typing import List, Dict, Tuple
 from pathlib import Path
 
+from dataset_shards import add_shard_arguments, save_sharded, shard_bytes_from_args
+
 def extract_think_content(output: str) -> Tuple[str, str]:
     """提取 think 部分和非 think 部分的内容"""
     think_pattern = r'<think>(.*?)</think>'
@@ -291,6 +293,7 @@ def main():
     parser.add_argument('--format', choices=['auto', 'constructor', 'hw3'], default='auto',
                        help='数据格式 (auto: 自动检测, constructor: data_constructor格式, hw3: hw3_2格式)')
     parser.add_argument('--keep-invalid', action='store_true', help='同时保存无效数据用于分析')
+    add_shard_arguments(parser)
     
     args = parser.parse_args()
     
@@ -340,6 +343,10 @@ def main():
             json.dump(alpaca_data, f, ensure_ascii=False, indent=2)
         
         print(f"📦 有效数据(Alpaca格式)已保存到: {alpaca_file}")
+        
+        if args.shard_dir:
+            save_sharded(alpaca_data, args.shard_dir, shard_bytes_from_args(args), args.append,
+                         input_file, args.dataset_name, args.dataset_info)
     
     # 可选：保存无效数据用于分析
     if args.keep_invalid and results['invalid_items'] > 0:
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+checkpoint_compare.py - 多个 LoRA 检查点的一次性对比
+
+训练在 saves/Qwen2.5-3B/lora/<run>/ 下保存最终适配器和 checkpoint-N/。本脚本只加载一次基座模型，
+把所有适配器挂在上面（vLLM 多 LoRA / transformers+peft 混合适配器批处理），
+同一个查询文件对每个检查点各生成一遍，所有请求交错提交、共享批次，最后输出并排的通过率和延迟表。
+
+使用方法：
+    python checkpoint_compare.py saves/Qwen2.5-3B/lora/train_2025-07-18-01-18-07 --include-base
+    python checkpoint_compare.py --lora ckpt100=saves/.../checkpoint-100 --lora final=saves/... \\
+        --backend transformers --max-tokens 256
+"""
+
+import argparse
+import json
+import os
+import time
+from typing import Dict, List, Optional
+
+from hw3_2 import (
+    QUERY_FILE, SYSTEM_PROMPT, add_engine_arguments, add_sampling_arguments, backend_kwargs, build_messages,
+    load_queries, render_messages, save_results,
+)
+from inference_backends import create_backend, parse_lora_adapters
+from inference_metrics import build_request_record, detect_mode, summarize
+from repair_rounds import is_valid_output
+from sequence_packing import render_sample
+from tokenizer_registry import get_tokenizer
+
+ADAPTER_CONFIG_FILE = "adapter_config.json"
+BASE_NAME = "base"
+COMPARE_DIR = "outputs/compare"
+
+
+def _checkpoint_step(name: str) -> int:
+    step = name.rsplit("-", 1)[-1]
+    return int(step) if step.isdigit() else 0
+
+
+def discover_adapters(roots: List[str]) -> Dict[str, str]:
+    """
+    在训练输出目录中查找适配器：目录本身（最终适配器）和其下的 checkpoint-N
+
+    Returns:
+        dict: {名称: 路径}，按 run 和步数排序；多个 run 时名称带 run 前缀
+    """
+    adapters = {}
+    for root in roots:
+        run = os.path.basename(os.path.normpath(root))
+        found = []
+        if os.path.isdir(root):
+            checkpoints = [name for name in os.listdir(root)
+                           if name.startswith("checkpoint-")
+                           and os.path.exists(os.path.join(root, name, ADAPTER_CONFIG_FILE))]
+            for name in sorted(checkpoints, key=_checkpoint_step):
+                found.append((name, os.path.join(root, name)))
+        if os.path.exists(os.path.join(root, ADAPTER_CONFIG_FILE)):
+            found.append(("final", root))
+        if not found:
+            raise FileNotFoundError(f"{root} 下没有找到 LoRA 适配器 ({ADAPTER_CONFIG_FILE})")
+        for name, path in found:
+            adapters[f"{run}-{name}" if len(roots) > 1 else name] = path
+    return adapters
+
+
+def adapter_base_model(path: str) -> Optional[str]:
+    """适配器训练时使用的基座模型路径"""
+    with open(os.path.join(path, ADAPTER_CONFIG_FILE), 'r', encoding='utf-8') as f:
+        return json.load(f).get("base_model_name_or_path")
+
+
+def render_prompt(tokenizer, query: str, template: str) -> List[int]:
+    """
+    按训练时的模板渲染查询
+
+    default/qwen 与 sequence_packing.render_sample 一致（训练数据没有系统提示词）；
+    hw3_2 使用 hw3_2.py 的系统提示词和对话模板。
+    """
+    if template == "hw3_2":
+        text = render_messages(build_messages(query, SYSTEM_PROMPT), chat_tokenizer=tokenizer)
+    else:
+        text, _ = render_sample(tokenizer, {"instruction": query, "output": ""}, template)
+    return tokenizer.encode(text, add_special_tokens=False)
+
+
+def compare_checkpoints(engine, prompt_ids: List[List[int]], names: List[Optional[str]], sampling: Dict):
+    """
+    所有 (查询, 检查点) 组合一次提交，按完成顺序收集
+
+    Returns:
+        tuple: ({检查点: 输出文本列表}, {检查点: 指标记录列表}, 墙钟时间)
+    """
+    all_prompts = [ids for _ in names for ids in prompt_ids]
+    all_adapters = [name for name in names for _ in prompt_ids]
+    texts = {name: [None] * len(prompt_ids) for name in names}
+    records = {name: [] for name in names}
+
+    start_time = time.time()
+    for index, result in engine.generate_iter(all_prompts, sampling, adapters=all_adapters):
+        name = all_adapters[index]
+        query_index = index % len(prompt_ids)
+        texts[name][query_index] = result["outputs"][0]["text"]
+        records[name].append(build_request_record(query_index, result))
+    return texts, records, time.time() - start_time
+
+
+def comparison_table(texts: Dict, records: Dict) -> List[Dict]:
+    """每个检查点一行：通过率、模式分布、延迟分位数"""
+    rows = []
+    for name, outputs in texts.items():
+        summary = summarize(records[name])
+        passed = sum(is_valid_output(text) for text in outputs)
+        modes = {}
+        for text in outputs:
+            mode = detect_mode(text)
+            modes[mode] = modes.get(mode, 0) + 1
+        rows.append({
+            "checkpoint": name or BASE_NAME,
+            "requests": len(outputs),
+            "passed": passed,
+            "pass_rate": passed / len(outputs) if outputs else 0.0,
+            "modes": modes,
+            "ttft_s": summary["ttft_s"],
+            "e2e_s": summary["e2e_s"],
+            "generated_tokens": summary["generated_tokens"],
+        })
+    return rows
+
+
+def print_table(rows: List[Dict], wall_time: float):
+    def p(stats, key):
+        return f"{stats[key]:.2f}" if stats else "-"
+
+    print(f"\n📊 检查点对比 (共 {sum(r['requests'] for r in rows)} 个请求，墙钟 {wall_time:.2f}s):")
+    header = f"{'检查点':<28}{'通过率':>10}{'AGENT/EDIT/NONE':>18}{'TTFT p50':>10}{'E2E p50':>10}{'E2E p90':>10}{'输出均长':>10}"
+    print(header)
+    print("-" * 100)
+    for row in rows:
+        modes = "/".join(str(row["modes"].get(mode, 0)) for mode in ("AGENT", "EDIT", "NONE"))
+        tokens = f"{row['generated_tokens']['mean']:.0f}" if row["generated_tokens"] else "-"
+        print(f"{row['checkpoint']:<28}{row['pass_rate'] * 100:>9.1f}%{modes:>18}"
+              f"{p(row['ttft_s'], 'p50'):>10}{p(row['e2e_s'], 'p50'):>10}{p(row['e2e_s'], 'p90'):>10}{tokens:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='在同一个常驻基座模型上对比多个 LoRA 检查点')
+    parser.add_argument('runs', nargs='*', help='训练输出目录（包含 adapter_config.json 或 checkpoint-N/）')
+    parser.add_argument('--queries', default=QUERY_FILE, help=f'查询文件 (默认: {QUERY_FILE})')
+    parser.add_argument('--include-base', action='store_true', help='同时评测不带适配器的基座模型')
+    parser.add_argument('--template', choices=['default', 'qwen', 'hw3_2'], default='default',
+                        help='prompt 模板：default/qwen 与训练一致，hw3_2 使用系统提示词 (默认: default)')
+    parser.add_argument('--tokenizer', default=None, help='分词器路径 (默认: 基座模型路径)')
+    parser.add_argument('--output-dir', default=COMPARE_DIR, help=f'各检查点输出目录 (默认: {COMPARE_DIR})')
+    parser.add_argument('--report', default='outputs/reports/checkpoint_compare.json', help='对比报告路径')
+    add_engine_arguments(parser)
+    add_sampling_arguments(parser)
+    # 基座模型默认取适配器配置中的路径
+    parser.set_defaults(model=None)
+    args = parser.parse_args()
+
+    adapters = discover_adapters(args.runs) if args.runs else {}
+    for name, path in parse_lora_adapters(args.lora).items():
+        adapters[name] = path
+    if not adapters:
+        parser.error("请指定训练输出目录或 --lora NAME=PATH")
+
+    model_path = args.model or adapter_base_model(next(iter(adapters.values())))
+    tokenizer_path = args.tokenizer or model_path
+    print(f"🔧 基座模型: {model_path}")
+    for name, path in adapters.items():
+        print(f"   适配器 {name}: {path}")
+
+    tokenizer = get_tokenizer(tokenizer_path)
+    queries = load_queries(args.queries)
+    prompt_ids = [render_prompt(tokenizer, item["Query"], args.template) for item in queries]
+
+    kwargs = backend_kwargs(args)
+    kwargs["lora_adapters"] = adapters
+    engine = create_backend(args.backend, model_path, tokenizer_path, **kwargs)
+    names = ([None] if args.include_base else []) + list(adapters)
+    sampling = {"temperature": args.temperature, "top_p": args.top_p, "max_tokens": args.max_tokens}
+
+    print(f"\n🚀 {len(queries)} 个查询 × {len(names)} 个检查点，一次提交...")
+    try:
+        texts, records, wall_time = compare_checkpoints(engine, prompt_ids, names, sampling)
+    finally:
+        engine.close()
+
+    rows = comparison_table(texts, records)
+    print_table(rows, wall_time)
+
+    for name, outputs in texts.items():
+        results = [{"Query": item["Query"], "Output": text} for item, text in zip(queries, outputs)]
+        save_results(results, os.path.join(args.output_dir, f"{name or BASE_NAME}.json"))
+    os.makedirs(os.path.dirname(args.report) or ".", exist_ok=True)
+    with open(args.report, 'w', encoding='utf-8') as f:
+        json.dump({"base_model": model_path, "adapters": adapters, "template": args.template,
+                   "wall_time_s": wall_time, "checkpoints": rows}, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 各检查点输出: {args.output_dir}/，对比报告: {args.report}")
+
+
+if __name__ == "__main__":
+    main()
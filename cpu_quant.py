@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+cpu_quant.py - 无 GPU 机器上的量化 CPU 推理
+
+全精度 transformers 在 CPU 上解码受内存带宽限制。inference_backends.CPUQuantizedBackend 使用本模块：
+- dynamic: torch 动态 int8 量化（nn.Linear -> 动态量化 Linear，权重 int8，激活逐批量化，fbgemm/qnnpack 内核）
+- weight-only: 只把 Linear 权重存为 int8 + 逐输出通道 scale；安装了 torchao 时使用其 int8_weight_only 内核，
+  否则回退为每次前向都反量化的纯 PyTorch 实现 —— 只节省内存，不提升 token/s（提速请用 dynamic）
+- 计算线程数设为物理核数（超线程对 GEMM 没有帮助，反而争抢缓存）
+- 按固定批大小分组生成，每批使用预分配的静态 KV cache（cache_implementation="static"）
+
+使用方法：
+    python cpu_quant.py bench --model /path/to/model --quantization dynamic --max-tokens 256
+    python hw3_2.py run --backend cpu-quant --model /path/to/model --quantization dynamic
+"""
+
+import argparse
+import os
+import time
+from typing import Optional
+
+QUANTIZATION_MODES = ("none", "dynamic", "weight-only")
+
+
+def physical_cores() -> int:
+    """物理核数：Linux 上按 /proc/cpuinfo 的 (physical id, core id) 去重，否则按逻辑核数估计"""
+    cores = set()
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            physical_id = core_id = None
+            for line in f:
+                key, _, value = line.partition(":")
+                key = key.strip()
+                if key == "physical id":
+                    physical_id = value.strip()
+                elif key == "core id":
+                    core_id = value.strip()
+                elif not line.strip():
+                    if core_id is not None:
+                        cores.add((physical_id, core_id))
+                    physical_id = core_id = None
+            if core_id is not None:
+                cores.add((physical_id, core_id))
+    except OSError:
+        pass
+    if cores:
+        return len(cores)
+    try:
+        import psutil
+
+        count = psutil.cpu_count(logical=False)
+        if count:
+            return count
+    except ImportError:
+        pass
+    return max(1, (os.cpu_count() or 2) // 2)
+
+
+def configure_threads(num_threads: Optional[int] = None) -> int:
+    """设置 torch 的计算线程数（默认物理核数），返回实际使用的线程数"""
+    import torch
+
+    num_threads = num_threads or physical_cores()
+    torch.set_num_threads(num_threads)
+    try:
+        # 只能在第一次并行计算之前设置
+        torch.set_num_interop_threads(max(1, min(4, num_threads // 4)))
+    except RuntimeError:
+        pass
+    return num_threads
+
+
+def _int8_weight_only_linear_class():
+    import torch
+
+    class Int8WeightOnlyLinear(torch.nn.Module):
+        """
+        int8 权重 + 逐输出通道 scale 的 Linear，内存占用约为 float32 的 1/4
+
+        每次前向把权重反量化回激活精度再做普通 GEMM，没有 int8 内核，因此不提升吞吐。
+        """
+
+        def __init__(self, linear: torch.nn.Linear):
+            super().__init__()
+            weight = linear.weight.detach().float()
+            scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127.0
+            self.register_buffer("weight_int8", torch.round(weight / scale[:, None]).to(torch.int8))
+            self.register_buffer("scale", scale.to(linear.weight.dtype))
+            self.bias = linear.bias
+            self.in_features = linear.in_features
+            self.out_features = linear.out_features
+
+        def forward(self, x):
+            out = torch.nn.functional.linear(x, self.weight_int8.to(x.dtype))
+            out = out * self.scale.to(x.dtype)
+            if self.bias is not None:
+                out = out + self.bias
+            return out
+
+    return Int8WeightOnlyLinear
+
+
+def has_torchao() -> bool:
+    try:
+        import torchao  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _replace_linear(module, factory, skip: tuple):
+    import torch
+
+    for name, child in module.named_children():
+        if name in skip:
+            continue
+        if isinstance(child, torch.nn.Linear):
+            setattr(module, name, factory(child))
+        else:
+            _replace_linear(child, factory, skip)
+
+
+def quantize_model(model, mode: str, skip_modules: tuple = ("lm_head",)):
+    """
+    对模型中的 Linear 层做 int8 量化
+
+    lm_head 默认不量化：它决定 <|AGENT|>/<|EDIT|> 的 logits，量化误差直接影响路由。
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"未知的量化方式: {mode} (可选: {', '.join(QUANTIZATION_MODES)})")
+    if mode == "none":
+        return model
+
+    import torch
+
+    if mode == "dynamic":
+        targets = {name for name, module in model.named_modules()
+                   if isinstance(module, torch.nn.Linear) and name.split(".")[-1] not in skip_modules}
+        return torch.ao.quantization.quantize_dynamic(model, targets, dtype=torch.qint8)
+
+    if has_torchao():
+        from torchao.quantization import int8_weight_only, quantize_
+
+        quantize_(model, int8_weight_only(),
+                  filter_fn=lambda module, fqn: isinstance(module, torch.nn.Linear)
+                  and fqn.split(".")[-1] not in skip_modules)
+    else:
+        print("⚠️  未安装 torchao：weight-only 回退为逐次反量化实现，只节省内存，不提升吞吐（提速请用 --quantization dynamic）")
+        _replace_linear(model, _int8_weight_only_linear_class(), skip_modules)
+    return model
+
+
+def model_size_mb(model) -> float:
+    """参数 + buffer（含量化后的打包权重）的大小"""
+    import torch
+
+    total = 0
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        total += tensor.numel() * tensor.element_size()
+    # 动态量化的打包权重不在 parameters/buffers 中
+    for module in model.modules():
+        if hasattr(module, "_packed_params") and hasattr(module, "weight") and callable(module.weight):
+            weight = module.weight()
+            if isinstance(weight, torch.Tensor):
+                total += weight.numel() * weight.element_size()
+    return total / 1024 / 1024
+
+
+def run_bench(args):
+    """同一批查询上对比不量化与量化的吞吐和通过率"""
+    from hw3_2 import TOKENIZER_PATH, encode_prompt, generate_prompt, get_tokenizer, load_queries
+    from inference_backends import create_backend
+    from repair_rounds import is_valid_output
+
+    queries = load_queries(args.queries)[:args.limit] if args.limit else load_queries(args.queries)
+    get_tokenizer()
+    prompt_ids = [encode_prompt(generate_prompt(item["Query"])) for item in queries]
+    sampling = {"temperature": args.temperature, "top_p": args.top_p, "max_tokens": args.max_tokens}
+
+    rows = []
+    for mode in ("none", args.quantization):
+        engine = create_backend("cpu-quant", args.model, TOKENIZER_PATH, quantization=mode,
+                                num_threads=args.num_threads, max_batch_size=args.max_batch_size)
+        start_time = time.time()
+        results = engine.generate(prompt_ids, sampling)
+        elapsed = time.time() - start_time
+        output_tokens = sum(len(r["outputs"][0]["token_ids"]) for r in results)
+        passed = sum(is_valid_output(r["outputs"][0]["text"]) for r in results)
+        rows.append({
+            "quantization": mode,
+            "seconds": elapsed,
+            "tokens_per_s": output_tokens / elapsed if elapsed else 0.0,
+            "pass_rate": passed / len(results) if results else 0.0,
+            "model_mb": model_size_mb(engine.model),
+            "threads": engine.num_threads,
+        })
+        engine.close()
+
+    print(f"\n📊 CPU 推理对比 ({len(prompt_ids)} 个查询, max_tokens={args.max_tokens}, {rows[0]['threads']} 线程):")
+    print(f"{'量化方式':<14}{'耗时(s)':>10}{'token/s':>10}{'通过率':>10}{'模型(MB)':>12}")
+    for row in rows:
+        print(f"{row['quantization']:<14}{row['seconds']:>10.2f}{row['tokens_per_s']:>10.1f}"
+              f"{row['pass_rate'] * 100:>9.1f}%{row['model_mb']:>12.0f}")
+    if rows[0]["tokens_per_s"]:
+        print(f"🚀 吞吐提升: {rows[1]['tokens_per_s'] / rows[0]['tokens_per_s']:.2f}x")
+    if args.quantization == "weight-only" and not has_torchao():
+        print("ℹ️  未安装 torchao，weight-only 为仅节省内存的回退实现，吞吐对比不代表 int8 内核；提速请用 dynamic")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='量化 CPU 推理')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    bench_parser = subparsers.add_parser('bench', help='对比不量化与 int8 量化的吞吐和通过率')
+    bench_parser.add_argument('--model', required=True, help='模型路径')
+    bench_parser.add_argument('--queries', default='query_only.json', help='查询文件 (默认: query_only.json)')
+    bench_parser.add_argument('--limit', type=int, default=None, help='只使用前 N 个查询')
+    bench_parser.add_argument('--quantization', choices=list(QUANTIZATION_MODES[1:]), default='dynamic',
+                              help='量化方式 (默认: dynamic；未安装 torchao 时 weight-only 只节省内存)')
+    bench_parser.add_argument('--num-threads', type=int, default=None, help='计算线程数 (默认: 物理核数)')
+    bench_parser.add_argument('--max-batch-size', type=int, default=8, help='静态批大小 (默认: 8)')
+    bench_parser.add_argument('--temperature', type=float, default=0.0, help='默认贪心，便于对比')
+    bench_parser.add_argument('--top-p', type=float, default=1.0)
+    bench_parser.add_argument('--max-tokens', type=int, default=512)
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        run_bench(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,20 +8,46 @@ data_constructor.py - 使用GPT-4.1构造符合特殊token格式的训练数据
 2. 使用GPT-4.1生成有小错误的代码
 3. 根据需求(Agent/Edit)包装成instruction
 4. 使用GPT-4.1生成包含特殊token的output
+5. （可选 --edit-format diff）把 editor 调用转换为紧凑的 diff 格式，见 edit_diff.py
+
+请求大小：题目描述按 token 预算截断，输出的 max_tokens 按错误代码长度估算（EDIT 约为 AGENT 的两倍
+代码量），减少每个请求计入 TPM 的额度，见 token_budget.py。
+
+请求对冲 (--hedge)：慢请求超过实时 p95 延迟时发送副本，降低尾延迟，见 request_hedging.py。
+
+配额模式 (--agent N --edit M)：不再固定尝试 --samples 次，而是按各类型实时的有效率分配类型，
+两种类型的有效样本都达到配额后停止提交并取消在途项目，见 run_quota_scheduler。
+
+多机生成：
+    每个 item_id 按 item_id % num_shards 确定地分配给一个分片，随机选择（AGENT/EDIT 类型、
+    instruction 模板）和 GPT 请求的 seed 都由 (--seed, item_id) 派生，同一分片重跑结果一致：
+    python data_constructor.py --samples 128 --shard-index 0 --num-shards 4   # 机器 0
+    python data_constructor.py --samples 128 --shard-index 1 --num-shards 4   # 机器 1 ...
+    python data_constructor.py --merge outputs/training_data/*.shard-*-of-00004.json \
+        --output outputs/training_data/training_data_full_128.json
 """
 
 import os
+import hashlib
+import heapq
 import json
 import time
 import random
 import re
 import threading
 import pandas as pd
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from typing import List, Dict, Tuple, Optional
 import openai
 from openai import OpenAI
 
+from dataset_shards import add_shard_arguments, save_sharded, shard_bytes_from_args
+from edit_diff import EDIT_FORMATS, convert_output
+from request_hedging import HedgedCaller, print_hedge_summary
+from token_budget import (
+    count_tokens, new_usage_stats, output_max_tokens, print_usage_stats, trim_to_budget, update_usage_stats,
+)
+
 # 设置OpenAI API (延迟初始化)
 client = None
 
@@ -34,13 +60,51 @@ def get_openai_client():
             raise ValueError("请设置 OPENAI_API_KEY 环境变量")
         client = OpenAI(
             api_key=api_key,
-            base_url="https://api.chatanywhere.tech/v1"
+            # OPENAI_BASE_URL 可指向本地 mock 服务 (mock_openai.py)
+            base_url=os.getenv("OPENAI_BASE_URL", "https://api.chatanywhere.tech/v1")
         )
     return client
 
+# 请求对冲 (--hedge)，为 None 时直接调用
+hedger = None
+
+# 请求大小：题目描述的 token 预算（0 表示不截断），输出 max_tokens 是否按代码长度估算
+REQUEST_SIZING = {"problem_token_budget": 1200, "adaptive_max_tokens": True}
+BUGGY_CODE_MAX_TOKENS = 1000
+OUTPUT_MAX_TOKENS = 2048
+token_usage = {"buggy_code": new_usage_stats(), "output": new_usage_stats()}
+token_usage_lock = threading.Lock()
+
+def record_token_usage(stage: str, prompt_text: str, max_tokens: int, fixed_max_tokens: int, trimmed: bool = False):
+    with token_usage_lock:
+        update_usage_stats(token_usage[stage], count_tokens(prompt_text), max_tokens, fixed_max_tokens, trimmed)
+
+def chat_completion(stage: str, **kwargs):
+    """调用 chat.completions.create；开启对冲时按 stage 分别统计延迟并对慢请求发送副本"""
+    client = get_openai_client()
+    if hedger is None:
+        return client.chat.completions.create(**kwargs)
+    return hedger.call(stage, client.chat.completions.create, **kwargs)
+
 # 数据文件路径
 PARQUET_FILE = "data/test-00000-of-00001.parquet"
 
+def item_seed(seed: int, item_id: int) -> int:
+    """由基础 seed 和 item_id 派生的稳定 seed（不依赖线程调度和 Python 的 hash 随机化）"""
+    digest = hashlib.sha256(f"{seed}:{item_id}".encode('utf-8')).digest()
+    return int.from_bytes(digest[:4], 'big')
+
+def shard_item_ids(num_samples: int, shard_index: int = 0, num_shards: int = 1) -> List[int]:
+    """该分片负责的 item_id（全局编号，合并时据此去重）"""
+    return [item_id for item_id in range(num_samples) if item_id % num_shards == shard_index]
+
+def shard_output_file(output_file: str, shard_index: int, num_shards: int) -> str:
+    """x.json -> x.shard-00001-of-00004.json"""
+    if num_shards <= 1:
+        return output_file
+    stem, ext = os.path.splitext(output_file)
+    return f"{stem}.shard-{shard_index:05d}-of-{num_shards:05d}{ext}"
+
 def extract_think_content(output: str) -> Tuple[str, str]:
     """提取 think 部分和非 think 部分的内容"""
     think_pattern = r'<think>(.*?)</think>'
@@ -136,14 +200,23 @@ def extract_problem_description(problem_text: str) -> str:
     
     description = '\n'.join(description_lines).strip()
     
-    # 如果没有找到问题描述，返回整个文本的前部分
+    # 如果没有找到问题描述，返回整个文本（请求前按 token 预算截断，见 generate_buggy_code）
     if not description:
-        description = problem_text[:1000] + "..." if len(problem_text) > 1000 else problem_text
+        description = problem_text
     
     return description
 
-def generate_buggy_code(problem_desc: str, max_retries: int = 3) -> Optional[str]:
-    """使用GPT-4.1生成包含小错误的代码"""
+def is_cancelled(cancel_event: Optional[threading.Event]) -> bool:
+    return cancel_event is not None and cancel_event.is_set()
+
+def generate_buggy_code(problem_desc: str, max_retries: int = 3, seed: Optional[int] = None,
+                        cancel_event: Optional[threading.Event] = None) -> Optional[str]:
+    """使用GPT-4.1生成包含小错误的代码（cancel_event 被设置后不再发起请求或重试）"""
+    # 过长的题目描述按 token 预算截断
+    budget = REQUEST_SIZING["problem_token_budget"]
+    trimmed = bool(budget) and count_tokens(problem_desc) > budget
+    if trimmed:
+        problem_desc = trim_to_budget(problem_desc, budget)
     prompt = f"""请根据以下编程问题，生成一个包含小错误的Python代码实现。
 
 问题描述：
@@ -162,15 +235,20 @@ def generate_buggy_code(problem_desc: str, max_retries: int = 3) -> Optional[str
 """
 
     for attempt in range(max_retries):
+        if is_cancelled(cancel_event):
+            return None
         try:
-            client = get_openai_client()
-            response = client.chat.completions.create(
+            record_token_usage("buggy_code", prompt, BUGGY_CODE_MAX_TOKENS, BUGGY_CODE_MAX_TOKENS,
+                               trimmed=trimmed and attempt == 0)
+            response = chat_completion(
+                "buggy_code",
                 model="gpt-4.1",
                 messages=[
                     {"role": "user", "content": prompt}
                 ],
                 temperature=0.7,
-                max_tokens=1000,
+                max_tokens=BUGGY_CODE_MAX_TOKENS,
+                seed=seed,
                 timeout=30
             )
             
@@ -195,7 +273,7 @@ def generate_buggy_code(problem_desc: str, max_retries: int = 3) -> Optional[str
     
     return None
 
-def create_instruction(problem_desc: str, buggy_code: str, instruction_type: str) -> str:
+def create_instruction(problem_desc: str, buggy_code: str, instruction_type: str, rng=random) -> str:
     """根据需求类型创建instruction"""
     if instruction_type == "agent":
         # Agent模式 - 用户没有明确错误信息，需要调试分析
@@ -223,7 +301,7 @@ def create_instruction(problem_desc: str, buggy_code: str, instruction_type: str
             "IndentationError: expected an indented block"
         ]
         
-        error_msg = random.choice(error_types)
+        error_msg = rng.choice(error_types)
         templates = [
             f"这个Python代码报错：{error_msg}，请帮我修复：\n\n{buggy_code}",
             f"我的代码出现{error_msg.split(':')[0]}错误，需要修复：\n\n{buggy_code}",
@@ -231,10 +309,18 @@ def create_instruction(problem_desc: str, buggy_code: str, instruction_type: str
             f"这个代码有错误：{error_msg}：\n\n{buggy_code}",
         ]
     
-    return random.choice(templates)
+    return rng.choice(templates)
+
+def generate_output_with_special_tokens(instruction: str, instruction_type: str, max_retries: int = 3,
+                                        seed: Optional[int] = None, max_tokens: Optional[int] = None,
+                                        cancel_event: Optional[threading.Event] = None) -> Optional[str]:
+    """
+    使用GPT-4.1生成包含特殊token的输出
 
-def generate_output_with_special_tokens(instruction: str, instruction_type: str, max_retries: int = 3) -> Optional[str]:
-    """使用GPT-4.1生成包含特殊token的输出"""
+    max_tokens 为按代码长度估算的输出上限；输出因长度被截断时翻倍（不超过 OUTPUT_MAX_TOKENS）后重试。
+    cancel_event 被设置后不再发起请求或重试。
+    """
+    max_tokens = max_tokens or OUTPUT_MAX_TOKENS
     
     system_prompt = """你是一个专业的代码调试助手。请根据用户的问题类型选择合适的处理模式：
 
@@ -258,21 +344,33 @@ def generate_output_with_special_tokens(instruction: str, instruction_type: str,
 请严格按照上述格式输出，确保包含<think>部分和相应的特殊词符 <|EDIT|> 或 <|AGENT|>。"""
 
     for attempt in range(max_retries):
+        if is_cancelled(cancel_event):
+            return None
         try:
-            client = get_openai_client()
-            response = client.chat.completions.create(
+            record_token_usage("output", system_prompt + instruction, max_tokens, OUTPUT_MAX_TOKENS)
+            response = chat_completion(
+                "output",
                 model="gpt-4.1",
                 messages=[
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": instruction}
                 ],
                 temperature=0.7,
-                max_tokens=2048,
+                max_tokens=max_tokens,
+                seed=seed,
                 timeout=30
             )
             
             output = response.choices[0].message.content
             
+            # 预算不足被截断：放宽 max_tokens 重试
+            if response.choices[0].finish_reason == "length" and max_tokens < OUTPUT_MAX_TOKENS \
+                    and attempt < max_retries - 1:
+                max_tokens = min(OUTPUT_MAX_TOKENS, max_tokens * 2)
+                with token_usage_lock:
+                    token_usage["output"]["length_retries"] += 1
+                continue
+            
             # 验证输出格式
             if output:
                 is_valid, issues = validate_output(output)
@@ -296,31 +394,53 @@ def generate_output_with_special_tokens(instruction: str, instruction_type: str,
     
     return None
 
-def process_single_problem(problem: Dict, item_id: int) -> Optional[Dict]:
-    """处理单个编程问题，生成完整的训练样本"""
+def process_single_problem(problem: Dict, item_id: int, edit_format: str = "full", seed: int = 0,
+                           instruction_type: Optional[str] = None,
+                           cancel_event: Optional[threading.Event] = None) -> Optional[Dict]:
+    """
+    处理单个编程问题，生成完整的训练样本
+
+    instruction_type 由配额调度器指定时不再随机选择；cancel_event 被设置后在每次 API 调用（含重试）前放弃。
+    """
+    # 每个项目独立的随机数生成器，结果与线程调度和分片方式无关
+    rng = random.Random(item_seed(seed, item_id))
+    api_seed = item_seed(seed, item_id) % (2 ** 31)
     try:
         # 步骤1: 生成有错误的代码
         print(f"🔧 项目 {item_id}: 生成错误代码...")
-        buggy_code = generate_buggy_code(problem['problem_description'])
+        buggy_code = generate_buggy_code(problem['problem_description'], seed=api_seed,
+                                         cancel_event=cancel_event)
+        
+        if is_cancelled(cancel_event):
+            print(f"⏹️  项目 {item_id}: 配额已满，取消")
+            return None
         
         if not buggy_code:
             print(f"❌ 项目 {item_id}: 生成错误代码失败")
             return None
         
-        # 步骤2: 随机选择instruction类型
-        instruction_type = random.choice(['agent', 'edit'])
+        # 步骤2: 随机选择instruction类型（总是抽取一次，保证后续随机选择与是否指定类型无关）
+        drawn_type = rng.choice(['agent', 'edit'])
+        instruction_type = instruction_type or drawn_type
         
         # 步骤3: 创建instruction
         print(f"📝 项目 {item_id}: 创建{instruction_type}类型instruction...")
         instruction = create_instruction(
             problem['problem_description'], 
             buggy_code, 
-            instruction_type
+            instruction_type,
+            rng
         )
         
         # 步骤4: 生成包含特殊token的输出
         print(f"🤖 项目 {item_id}: 生成特殊token输出...")
-        output = generate_output_with_special_tokens(instruction, instruction_type)
+        max_tokens = output_max_tokens(buggy_code, instruction_type) if REQUEST_SIZING["adaptive_max_tokens"] else None
+        output = generate_output_with_special_tokens(instruction, instruction_type, seed=api_seed,
+                                                     max_tokens=max_tokens, cancel_event=cancel_event)
+        
+        if is_cancelled(cancel_event):
+            print(f"⏹️  项目 {item_id}: 配额已满，丢弃")
+            return None
         
         if not output:
             print(f"❌ 项目 {item_id}: 生成输出失败")
@@ -331,14 +451,23 @@ def process_single_problem(problem: Dict, item_id: int) -> Optional[Dict]:
             is_valid, issues = validate_output(output)
         else:
             is_valid, issues = False, ["生成输出为空"]
+
+        # 步骤5: 本地把完整格式的 editor 调用转换为 diff（GPT 仍按完整格式生成，保证 diff 与修复一致）
+        if edit_format != "full" and is_valid:
+            try:
+                output = convert_output(output, edit_format)
+            except (ValueError, KeyError, TypeError) as e:
+                is_valid, issues = False, [f"editor 调用无法转换为 {edit_format} 格式: {e}"]
         
         result = {
             'item_id': item_id,
+            'seed': seed,
             'question_id': problem['question_id'],
             'question_title': problem['question_title'],
             'instruction': instruction,
             'output': output,
             'expected_type': instruction_type,
+            'edit_format': edit_format,
             'buggy_code': buggy_code,
             'valid': is_valid,
             'issues': issues
@@ -353,44 +482,30 @@ def process_single_problem(problem: Dict, item_id: int) -> Optional[Dict]:
         print(f"❌ 项目 {item_id} 处理失败: {e}")
         return None
 
-def construct_training_data_from_parquet(
-    num_samples: int = 100, 
-    num_threads: int = 32, 
-    output_file: str = "outputs/training_data/training_data_from_parquet.json"
-) -> List[Dict]:
-    """从parquet数据构造训练数据"""
-    
-    print(f"🚀 开始从parquet数据构造 {num_samples} 个训练样本...")
-    print(f"🔧 使用 {num_threads} 个线程")
-    print(f"📁 输出文件: {output_file}")
-    print("=" * 50)
-    
-    # 加载编程问题
-    problems = load_programming_problems(PARQUET_FILE)
-    
-    if not problems:
-        print("❌ 无法加载编程问题，退出")
-        return []
-    
+def run_fixed_samples(problems: List[Dict], num_samples: int, num_threads: int, edit_format: str, seed: int,
+                      shard_index: int = 0, num_shards: int = 1) -> List[Dict]:
+    """固定尝试次数：每个 item_id 生成一次，类型随机"""
     # 如果请求的样本数超过可用问题数，就循环使用
     if num_samples > len(problems):
         print(f"⚠️  请求样本数({num_samples})超过可用问题数({len(problems)})，将循环使用问题")
     
-    selected_problems = []
-    for i in range(num_samples):
-        problem_idx = i % len(problems)
-        selected_problems.append(problems[problem_idx])
+    item_ids = shard_item_ids(num_samples, shard_index, num_shards)
+    if num_shards > 1:
+        print(f"🧩 分片 {shard_index}/{num_shards}: 负责 {len(item_ids)} / {num_samples} 个项目")
+    
+    selected_problems = {}
+    for item_id in item_ids:
+        problem_idx = item_id % len(problems)
+        selected_problems[item_id] = problems[problem_idx]
     
     results = []
-    valid_count = 0
-    invalid_count = 0
     
     # 使用线程池执行
     with ThreadPoolExecutor(max_workers=num_threads) as executor:
         # 提交任务
         future_to_id = {
-            executor.submit(process_single_problem, problem, i): i 
-            for i, problem in enumerate(selected_problems)
+            executor.submit(process_single_problem, problem, i, edit_format, seed): i 
+            for i, problem in selected_problems.items()
         }
         
         # 收集结果
@@ -398,10 +513,137 @@ def construct_training_data_from_parquet(
             result = future.result()
             if result:
                 results.append(result)
+    
+    return results
+
+def run_quota_scheduler(problems: List[Dict], quotas: Dict[str, int], num_threads: int, edit_format: str,
+                        seed: int, shard_index: int = 0, num_shards: int = 1,
+                        max_attempts: Optional[int] = None) -> List[Dict]:
+    """
+    按有效样本配额调度生成
+
+    - 每种类型的有效率用 (有效 + 1) / (完成 + 2) 实时估计
+    - 每个空闲线程分配给「预计还需尝试次数」最多的类型：
+      (配额 - 已有效 - 在途数 × 有效率) / 有效率
+    - 在途请求最多 num_threads 个；某类型配额已满时通知该类型的在途项目在下一次 API 调用前放弃，
+      配额满后才完成的结果直接丢弃（计入取消，不计入尝试）；所有配额满足后停止提交
+    - item_id 按分片步长递增 (shard_index, shard_index + num_shards, ...)，可与 --merge 配合
+    """
+    types = [t for t in ("agent", "edit") if quotas.get(t, 0) > 0]
+    max_attempts = max_attempts or 3 * sum(quotas[t] for t in types)
+    stats = {t: {"attempts": 0, "valid": 0, "in_flight": 0, "cancelled": 0} for t in types}
+    
+    def valid_rate(t: str) -> float:
+        return (stats[t]["valid"] + 1) / (stats[t]["attempts"] + 2)
+    
+    def expected_need(t: str) -> float:
+        return quotas[t] - stats[t]["valid"] - stats[t]["in_flight"] * valid_rate(t)
+    
+    def pick_type() -> Optional[str]:
+        candidates = [t for t in types if expected_need(t) > 0]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda t: expected_need(t) / valid_rate(t))
+    
+    results = []
+    running = {}
+    submitted = 0
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        while True:
+            while len(running) < num_threads and submitted < max_attempts:
+                instruction_type = pick_type()
+                if instruction_type is None:
+                    break
+                item_id = shard_index + submitted * num_shards
+                cancel_event = threading.Event()
+                future = executor.submit(process_single_problem, problems[item_id % len(problems)], item_id,
+                                         edit_format, seed, instruction_type, cancel_event)
+                running[future] = (instruction_type, cancel_event)
+                stats[instruction_type]["in_flight"] += 1
+                submitted += 1
+            if not running:
+                break
+            
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                instruction_type, cancel_event = running.pop(future)
+                stat = stats[instruction_type]
+                stat["in_flight"] -= 1
+                result = None if future.cancelled() else future.result()
+                if cancel_event.is_set() or stat["valid"] >= quotas[instruction_type]:
+                    stat["cancelled"] += 1
+                    continue
+                # API 失败也计入尝试次数，拉低该类型的有效率估计
+                stat["attempts"] += 1
+                if result is None:
+                    continue
                 if result["valid"]:
-                    valid_count += 1
-                else:
-                    invalid_count += 1
+                    stat["valid"] += 1
+                results.append(result)
+                
+                if stat["valid"] >= quotas[instruction_type]:
+                    for other, (other_type, other_event) in running.items():
+                        if other_type == instruction_type and not other_event.is_set():
+                            other_event.set()
+                            other.cancel()
+            
+            print("📈 配额进度: " + ", ".join(
+                f"{t.upper()} {stats[t]['valid']}/{quotas[t]} (有效率 {valid_rate(t) * 100:.0f}%, 在途 {stats[t]['in_flight']})"
+                for t in types))
+    
+    print("\n📊 配额调度统计:")
+    for t in types:
+        stat = stats[t]
+        status = "✅" if stat["valid"] >= quotas[t] else "⚠️  未达到配额"
+        print(f"   {t.upper()}: 有效 {stat['valid']}/{quotas[t]}，尝试 {stat['attempts']}，"
+              f"取消 {stat['cancelled']} {status}")
+    if submitted >= max_attempts and any(stats[t]["valid"] < quotas[t] for t in types):
+        print(f"⚠️  已达到最大尝试次数 {max_attempts}，停止提交")
+    return results
+
+def construct_training_data_from_parquet(
+    num_samples: int = 100, 
+    num_threads: int = 32, 
+    output_file: str = "outputs/training_data/training_data_from_parquet.json",
+    edit_format: str = "full",
+    problems_file: Optional[str] = None,
+    shard_options: Optional[Dict] = None,
+    seed: int = 0,
+    shard_index: int = 0,
+    num_shards: int = 1,
+    quotas: Optional[Dict[str, int]] = None,
+    max_attempts: Optional[int] = None
+) -> List[Dict]:
+    """从parquet数据构造训练数据"""
+    
+    if quotas:
+        print(f"🚀 开始按配额构造训练样本: " + ", ".join(f"{t.upper()} {n} 个有效样本" for t, n in quotas.items()))
+    else:
+        print(f"🚀 开始从parquet数据构造 {num_samples} 个训练样本...")
+    print(f"🔧 使用 {num_threads} 个线程")
+    print(f"📁 输出文件: {output_file}")
+    print("=" * 50)
+    
+    # 加载编程问题（pipeline.py 的 load_problems 阶段会预先导出为 JSON）
+    if problems_file:
+        with open(problems_file, 'r', encoding='utf-8') as f:
+            problems = json.load(f)
+        print(f"✅ 从 {problems_file} 加载 {len(problems)} 个编程问题")
+    else:
+        problems = load_programming_problems(PARQUET_FILE)
+    
+    if not problems:
+        print("❌ 无法加载编程问题，退出")
+        return []
+    
+    if quotas:
+        results = run_quota_scheduler(problems, quotas, num_threads, edit_format, seed,
+                                      shard_index, num_shards, max_attempts)
+    else:
+        results = run_fixed_samples(problems, num_samples, num_threads, edit_format, seed,
+                                    shard_index, num_shards)
+    valid_count = sum(1 for result in results if result["valid"])
+    invalid_count = len(results) - valid_count
     
     print("\n" + "=" * 50)
     print(f"📊 构造完成统计:")
@@ -410,32 +652,53 @@ def construct_training_data_from_parquet(
     print(f"   ❌ 无效样本: {invalid_count}")
     print(f"   📈 有效率: {valid_count/len(results)*100:.1f}%" if results else "0%")
     
+    # 按 item_id 排序，同一分片重跑的输出文件一致
+    results.sort(key=lambda item: item['item_id'])
+    
+    # 确保目录存在
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+    
     # 保存所有数据（包括无效的，供分析）
     with open(output_file, 'w', encoding='utf-8') as f:
         json.dump(results, f, ensure_ascii=False, indent=2)
     
     print(f"💾 原始数据已保存到: {output_file}")
     
-    # 提取有效数据并转换为alpaca格式
+    # 提取有效数据并转换为alpaca格式（配额模式下超出配额的样本只保留在原始数据中）
     valid_data = [item for item in results if item["valid"]]
     alpaca_data = convert_to_alpaca_format(valid_data)
     
-    # 确保目录存在
-    import os
-    os.makedirs(os.path.dirname(output_file), exist_ok=True)
-    
     alpaca_file = output_file.replace('.json', '_alpaca.json')
     with open(alpaca_file, 'w', encoding='utf-8') as f:
         json.dump(alpaca_data, f, ensure_ascii=False, indent=2)
     
     print(f"📦 Alpaca格式数据已保存到: {alpaca_file}")
     
+    # 可选：写成 JSONL 分片（参数见 dataset_shards.save_sharded）
+    if shard_options:
+        save_sharded(alpaca_data, source=output_file, **shard_options)
+    
     # 生成分析报告（保存到reports目录）
     base_name = os.path.basename(output_file).replace('.json', '_analysis.txt')
     report_file = f"outputs/reports/{base_name}"
     os.makedirs("outputs/reports", exist_ok=True)
     generate_analysis_report(results, report_file)
     
+    # 请求 token 预算统计
+    print_usage_stats(token_usage)
+    usage_file = f"outputs/reports/{os.path.basename(output_file).replace('.json', '_token_budget.json')}"
+    with open(usage_file, 'w', encoding='utf-8') as f:
+        json.dump({"sizing": REQUEST_SIZING, "usage": token_usage}, f, ensure_ascii=False, indent=2)
+    
+    # 请求对冲统计
+    if hedger is not None:
+        hedge_report = hedger.summary()
+        print_hedge_summary(hedge_report)
+        hedge_file = f"outputs/reports/{os.path.basename(output_file).replace('.json', '_hedging.json')}"
+        with open(hedge_file, 'w', encoding='utf-8') as f:
+            json.dump(hedge_report, f, ensure_ascii=False, indent=2)
+        print(f"⚡ 对冲统计已保存到: {hedge_file}")
+    
     return results
 
 def convert_to_alpaca_format(data: List[Dict]) -> List[Dict]:
@@ -452,51 +715,52 @@ def convert_to_alpaca_format(data: List[Dict]) -> List[Dict]:
     
     return alpaca_data
 
-def generate_analysis_report(results: List[Dict], report_file: str):
-    """生成分析报告"""
-    valid_results = [r for r in results if r["valid"]]
-    invalid_results = [r for r in results if not r["valid"]]
+def new_analysis_stats() -> Dict:
+    """分析报告的累计统计（合并分片时逐条更新，无需把全部结果放进内存）"""
+    return {"total": 0, "valid": 0, "type_stats": {}, "issue_stats": {}, "question_stats": {}}
+
+def update_analysis_stats(stats: Dict, result: Dict):
+    stats["total"] += 1
+    if result["valid"]:
+        stats["valid"] += 1
+        t = result["expected_type"]
+        stats["type_stats"][t] = stats["type_stats"].get(t, 0) + 1
+    else:
+        for issue in result["issues"]:
+            stats["issue_stats"][issue] = stats["issue_stats"].get(issue, 0) + 1
+    title = result.get("question_title", "unknown")
+    stats["question_stats"][title] = stats["question_stats"].get(title, 0) + 1
+
+def write_analysis_report(stats: Dict, report_file: str):
+    """根据累计统计写出分析报告"""
+    total, valid = stats["total"], stats["valid"]
+    invalid = total - valid
     
     report = []
     report.append("=" * 60)
     report.append("基于Parquet数据的训练数据构造分析报告")
     report.append("=" * 60)
-    report.append(f"总样本数: {len(results)}")
-    report.append(f"有效样本: {len(valid_results)} ({len(valid_results)/len(results)*100:.1f}%)")
-    report.append(f"无效样本: {len(invalid_results)} ({len(invalid_results)/len(results)*100:.1f}%)")
+    report.append(f"总样本数: {total}")
+    report.append(f"有效样本: {valid} ({valid/max(total, 1)*100:.1f}%)")
+    report.append(f"无效样本: {invalid} ({invalid/max(total, 1)*100:.1f}%)")
     report.append("")
     
     # 按类型统计
-    type_stats = {}
-    for result in valid_results:
-        t = result["expected_type"]
-        type_stats[t] = type_stats.get(t, 0) + 1
-    
     report.append("有效样本类型分布:")
-    for t, count in type_stats.items():
-        report.append(f"  {t}: {count} ({count/len(valid_results)*100:.1f}%)")
+    for t, count in stats["type_stats"].items():
+        report.append(f"  {t}: {count} ({count/valid*100:.1f}%)")
     report.append("")
     
     # 无效样本问题分析
-    if invalid_results:
-        issue_stats = {}
-        for result in invalid_results:
-            for issue in result["issues"]:
-                issue_stats[issue] = issue_stats.get(issue, 0) + 1
-        
+    if invalid:
         report.append("无效样本问题统计:")
-        for issue, count in sorted(issue_stats.items(), key=lambda x: x[1], reverse=True):
+        for issue, count in sorted(stats["issue_stats"].items(), key=lambda x: x[1], reverse=True):
             report.append(f"  {issue}: {count}")
         report.append("")
     
     # 问题来源统计
-    question_stats = {}
-    for result in results:
-        title = result.get("question_title", "unknown")
-        question_stats[title] = question_stats.get(title, 0) + 1
-    
     report.append(f"问题来源分布（前10个）:")
-    for title, count in sorted(question_stats.items(), key=lambda x: x[1], reverse=True)[:10]:
+    for title, count in sorted(stats["question_stats"].items(), key=lambda x: x[1], reverse=True)[:10]:
         title_short = title[:50] + "..." if len(title) > 50 else title
         report.append(f"  {title_short}: {count}")
     report.append("")
@@ -507,6 +771,126 @@ def generate_analysis_report(results: List[Dict], report_file: str):
     
     print(f"📊 分析报告已保存到: {report_file}")
 
+def generate_analysis_report(results: List[Dict], report_file: str):
+    """生成分析报告"""
+    stats = new_analysis_stats()
+    for result in results:
+        update_analysis_stats(stats, result)
+    write_analysis_report(stats, report_file)
+
+def iter_json_array(path: str, chunk_size: int = 1 << 20):
+    """逐个读取 JSON 数组文件中的元素，不一次性解析整个文件"""
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer, started, eof = "", False, False
+        while True:
+            buffer = buffer.lstrip()
+            if not started:
+                if not buffer and not eof:
+                    chunk = f.read(chunk_size)
+                    buffer, eof = buffer + chunk, not chunk
+                    continue
+                if not buffer.startswith("["):
+                    raise ValueError(f"{path} 不是 JSON 数组")
+                buffer, started = buffer[1:], True
+                continue
+            if buffer.startswith(","):
+                buffer = buffer[1:]
+                continue
+            if buffer.startswith("]"):
+                return
+            try:
+                item, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = f.read(chunk_size)
+                buffer, eof = buffer + chunk, not chunk
+                continue
+            yield item
+            buffer = buffer[end:]
+
+class _JsonArrayWriter:
+    """逐条写出 JSON 数组（与 json.dump(indent=2) 的内容等价）"""
+
+    def __init__(self, path: str):
+        self.file = open(path, 'w', encoding='utf-8')
+        self.count = 0
+        self.file.write("[")
+
+    def write(self, item: Dict):
+        text = json.dumps(item, ensure_ascii=False, indent=2).replace("\n", "\n  ")
+        self.file.write(("," if self.count else "") + "\n  " + text)
+        self.count += 1
+
+    def close(self):
+        self.file.write("\n]" if self.count else "]")
+        self.file.close()
+
+def merge_shard_outputs(shard_files: List[str], output_file: str, shard_options: Optional[Dict] = None) -> Dict:
+    """
+    合并各分片的原始输出：按 item_id 去重（优先保留有效样本），流式写出合并后的原始数据、
+    alpaca 文件和分析报告
+
+    第一遍只记录每个 item_id 选中的 (文件, 序号)，第二遍按 item_id 归并各分片逐条写出，
+    输出与不分片运行一致；各分片本身按 item_id 排序，内存占用与样本数无关。
+    """
+    chosen = {}
+    seeds = set()
+    duplicates = 0
+    unsorted = set()
+    for file_index, path in enumerate(shard_files):
+        last_id = None
+        for position, item in enumerate(iter_json_array(path)):
+            item_id = item["item_id"]
+            if last_id is not None and item_id < last_id:
+                unsorted.add(file_index)
+            last_id = item_id
+            seeds.add(item.get("seed"))
+            if item_id in chosen:
+                duplicates += 1
+                if chosen[item_id][2] or not item["valid"]:
+                    continue
+            chosen[item_id] = (file_index, position, item["valid"])
+    if len(seeds) > 1:
+        print(f"⚠️  分片使用了不同的 --seed: {sorted(seeds, key=str)}")
+    
+    selected = {(file_index, position) for file_index, position, _ in chosen.values()}
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+    alpaca_file = output_file.replace('.json', '_alpaca.json')
+    raw_writer, alpaca_writer = _JsonArrayWriter(output_file), _JsonArrayWriter(alpaca_file)
+    stats = new_analysis_stats()
+    
+    def selected_items(file_index: int, path: str):
+        items = (item for position, item in enumerate(iter_json_array(path)) if (file_index, position) in selected)
+        # 手工修改过、未按 item_id 排序的分片先在内存中排序
+        return sorted(items, key=lambda item: item["item_id"]) if file_index in unsorted else items
+    
+    for item in heapq.merge(*(selected_items(i, path) for i, path in enumerate(shard_files)),
+                            key=lambda item: item["item_id"]):
+        raw_writer.write(item)
+        update_analysis_stats(stats, item)
+        if item["valid"]:
+            alpaca_writer.write(convert_to_alpaca_format([item])[0])
+    raw_writer.close()
+    alpaca_writer.close()
+    
+    missing = []
+    if chosen:
+        missing = [item_id for item_id in range(max(chosen) + 1) if item_id not in chosen]
+    print(f"🔗 合并 {len(shard_files)} 个分片: {len(chosen)} 个项目 (重复 {duplicates}, "
+          f"缺失 {len(missing)}{': ' + str(missing[:10]) if missing else ''})")
+    print(f"💾 原始数据已保存到: {output_file}")
+    print(f"📦 Alpaca格式数据已保存到: {alpaca_file}")
+    
+    if shard_options:
+        save_sharded(iter_json_array(alpaca_file), source=output_file, **shard_options)
+    
+    base_name = os.path.basename(output_file).replace('.json', '_analysis.txt')
+    os.makedirs("outputs/reports", exist_ok=True)
+    write_analysis_report(stats, f"outputs/reports/{base_name}")
+    return {"items": len(chosen), "duplicates": duplicates, "missing": missing, "valid": stats["valid"]}
+
 def main():
     """主函数"""
     import argparse
@@ -516,9 +900,50 @@ def main():
     parser.add_argument('--threads', type=int, default=32, help='线程数量 (默认: 32)')
     parser.add_argument('--output', type=str, default='outputs/training_data/training_data_from_parquet.json', 
                        help='输出文件名 (默认: outputs/training_data/training_data_from_parquet.json)')
+    parser.add_argument('--problems', type=str, default=None,
+                       help='已导出的编程问题 JSON (默认: 直接读取 parquet)')
+    parser.add_argument('--edit-format', choices=list(EDIT_FORMATS), default='full',
+                       help='editor 调用格式：full 输出完整的原始/修改代码，diff 只输出 unified diff (默认: full)')
+    parser.add_argument('--seed', type=int, default=0,
+                       help='基础随机种子，每个项目的随机选择和 GPT 请求 seed 由 (seed, item_id) 派生 (默认: 0)')
+    parser.add_argument('--shard-index', type=int, default=0, help='多机生成时本机负责的分片编号 (默认: 0)')
+    parser.add_argument('--num-shards', type=int, default=1,
+                       help='多机生成的分片总数，输出文件名自动加上 .shard-<i>-of-<n> (默认: 1)')
+    parser.add_argument('--agent', type=int, default=None,
+                       help='AGENT 类型有效样本配额；与 --edit 一起使用时按配额调度，忽略 --samples')
+    parser.add_argument('--edit', type=int, default=None, help='EDIT 类型有效样本配额')
+    parser.add_argument('--max-attempts', type=int, default=None,
+                       help='配额模式下的最大尝试次数 (默认: 配额总数的 3 倍)')
+    parser.add_argument('--hedge', action='store_true',
+                       help='开启请求对冲：请求超过该阶段实时 p95 延迟仍未返回时发送副本，取先返回的结果')
+    parser.add_argument('--hedge-max-rate', type=float, default=0.1,
+                       help='对冲请求占总请求数的上限 (默认: 0.1)')
+    parser.add_argument('--hedge-quantile', type=float, default=95.0, help='触发对冲的延迟分位数 (默认: 95)')
+    parser.add_argument('--problem-token-budget', type=int, default=REQUEST_SIZING["problem_token_budget"],
+                       help='题目描述的 token 上限，超出时截断，0 表示不截断 (默认: 1200)')
+    parser.add_argument('--fixed-max-tokens', action='store_true',
+                       help=f'输出固定使用 max_tokens={OUTPUT_MAX_TOKENS}，不按代码长度估算')
+    parser.add_argument('--merge', nargs='+', metavar='SHARD_FILE', default=None,
+                       help='合并各机器的分片输出到 --output（按 item_id 去重），不调用 API')
+    add_shard_arguments(parser)
     
     args = parser.parse_args()
     
+    shard_options = {
+        "shard_dir": args.shard_dir,
+        "shard_bytes": shard_bytes_from_args(args),
+        "append": args.append,
+        "dataset_name": args.dataset_name,
+        "dataset_info_path": args.dataset_info,
+    } if args.shard_dir else None
+    
+    if args.merge:
+        merge_shard_outputs(args.merge, args.output, shard_options)
+        return
+    
+    if not 0 <= args.shard_index < args.num_shards:
+        parser.error(f"--shard-index 应在 [0, {args.num_shards}) 范围内")
+    
     # 检查API key
     if not os.getenv("OPENAI_API_KEY"):
         print("❌ 错误: 请设置 OPENAI_API_KEY 环境变量")
@@ -526,7 +951,7 @@ def main():
         return
     
     # 检查parquet文件
-    if not os.path.exists(PARQUET_FILE):
+    if not args.problems and not os.path.exists(PARQUET_FILE):
         print(f"❌ 错误: 找不到parquet文件 {PARQUET_FILE}")
         print("请确保数据文件存在")
         return
@@ -539,11 +964,33 @@ def main():
         print("   pip install pandas")
         return
     
-    construct_training_data_from_parquet(
-        num_samples=args.samples,
-        num_threads=args.threads,
-        output_file=args.output
-    )
+    REQUEST_SIZING["problem_token_budget"] = args.problem_token_budget
+    REQUEST_SIZING["adaptive_max_tokens"] = not args.fixed_max_tokens
+    
+    global hedger
+    if args.hedge:
+        hedger = HedgedCaller(max_hedge_rate=args.hedge_max_rate, quantile=args.hedge_quantile,
+                              max_workers=2 * args.threads + 4)
+    
+    try:
+        construct_training_data_from_parquet(
+            num_samples=args.samples,
+            num_threads=args.threads,
+            output_file=shard_output_file(args.output, args.shard_index, args.num_shards),
+            edit_format=args.edit_format,
+            problems_file=args.problems,
+            shard_options=shard_options,
+            seed=args.seed,
+            shard_index=args.shard_index,
+            num_shards=args.num_shards,
+            quotas={"agent": args.agent or 0, "edit": args.edit or 0} if args.agent or args.edit else None,
+            max_attempts=args.max_attempts
+        )
+    finally:
+        # 关闭对冲线程池，取消尚未开始的对冲请求
+        if hedger is not None:
+            hedger.close()
+            hedger = None
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+dataset_shards.py - 分片的 alpaca 训练数据 (JSONL 分片 + manifest)
+
+单个 *_alpaca.json 每次都要整体解析，追加数据要重写整个文件。分片格式：
+
+    training_data/<name>/shard-00000.jsonl      每行一条 {"instruction", "input", "output"}
+    training_data/<name>/shard-00001.jsonl      单个分片不超过 --shard-size 字节
+    training_data/<name>.manifest.json          每个分片的条数、字节数、sha256 和所属批次
+
+- manifest 放在分片目录之外：LLaMA-Factory 的 file_name 指向目录时会读取目录下的所有文件
+- 追加 (--append) 时新批次写入新的分片，已有分片不重写
+- dataset_info.json 的条目 file_name 指向分片目录，预处理时各 worker 可按文件并行读取
+
+使用方法：
+    python batch_validator.py outputs/training_data/x.json --shard-dir training_data/x --dataset-name x
+    python dataset_shards.py split outputs/validation/x_valid_alpaca.json training_data/x --append --register x
+    python dataset_shards.py verify training_data/x
+    python dataset_shards.py merge training_data/x --output x_alpaca.json     # 需要单文件的旧工具
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from typing import Dict, Iterator, List, Optional
+
+from token_store import sha256_file, sha256_text
+
+DEFAULT_SHARD_BYTES = 4 * 1024 * 1024
+DATASET_INFO = "training_data/dataset_info.json"
+SHARD_PATTERN = "shard-{:05d}.jsonl"
+
+
+def manifest_path(shard_dir: str) -> str:
+    return os.path.normpath(shard_dir) + ".manifest.json"
+
+
+def load_manifest(shard_dir: str) -> Optional[Dict]:
+    path = manifest_path(shard_dir)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _save_manifest(shard_dir: str, manifest: Dict):
+    path = manifest_path(shard_dir)
+    with open(path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def write_shards(records: List[Dict], shard_dir: str, shard_bytes: int = DEFAULT_SHARD_BYTES,
+                 append: bool = False, source: Optional[str] = None) -> Dict:
+    """
+    把记录写成不超过 shard_bytes 的 JSONL 分片并更新 manifest
+
+    append=False 时清除目录中已有的分片；append=True 时从下一个分片编号开始写，
+    已有分片（包括未写满的最后一个）保持不变，读取顺序与写入顺序一致。
+
+    Returns:
+        dict: 更新后的 manifest
+    """
+    manifest = load_manifest(shard_dir) if append else None
+    os.makedirs(shard_dir, exist_ok=True)
+    if manifest is None:
+        for name in os.listdir(shard_dir):
+            if name.startswith("shard-") and name.endswith(".jsonl"):
+                os.remove(os.path.join(shard_dir, name))
+        manifest = {"format": "alpaca-jsonl", "shard_bytes": shard_bytes, "num_records": 0,
+                    "shards": [], "batches": []}
+
+    batch = len(manifest["batches"])
+    next_index = len(manifest["shards"])
+    new_shards = []
+    handle, digest, current = None, None, None
+
+    def close_shard():
+        if handle is not None:
+            handle.close()
+            current["sha256"] = digest.hexdigest()
+            new_shards.append(current)
+
+    for record in records:
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8')
+        # 单条超过上限时独占一个分片
+        if handle is None or (current["records"] and current["bytes"] + len(line) > shard_bytes):
+            close_shard()
+            name = SHARD_PATTERN.format(next_index + len(new_shards))
+            handle = open(os.path.join(shard_dir, name), 'wb')
+            digest = hashlib.sha256()
+            current = {"file": name, "records": 0, "bytes": 0, "batch": batch}
+        handle.write(line)
+        digest.update(line)
+        current["records"] += 1
+        current["bytes"] += len(line)
+    close_shard()
+
+    manifest["shards"].extend(new_shards)
+    manifest["num_records"] += sum(shard["records"] for shard in new_shards)
+    manifest["total_bytes"] = sum(shard["bytes"] for shard in manifest["shards"])
+    manifest["batches"].append({
+        "batch": batch,
+        "source": source,
+        "records": sum(shard["records"] for shard in new_shards),
+        "shards": [shard["file"] for shard in new_shards],
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+    })
+    _save_manifest(shard_dir, manifest)
+    return manifest
+
+
+def iter_records(shard_dir: str) -> Iterator[Dict]:
+    """按 manifest 顺序逐行读取所有分片"""
+    manifest = load_manifest(shard_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"找不到分片 manifest: {manifest_path(shard_dir)}")
+    for shard in manifest["shards"]:
+        with open(os.path.join(shard_dir, shard["file"]), 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def load_alpaca(path: str) -> List[Dict]:
+    """读取 alpaca 数据：单个 JSON 文件或分片目录"""
+    if os.path.isdir(path):
+        return list(iter_records(path))
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def dataset_sha256(path: str) -> str:
+    """单文件取内容哈希；分片目录取各分片哈希的组合（与 manifest 一致时无需重读分片）"""
+    if os.path.isdir(path):
+        manifest = load_manifest(path) or {"shards": []}
+        return sha256_text("\n".join(f"{shard['file']}:{shard['sha256']}" for shard in manifest["shards"]))
+    return sha256_file(path)
+
+
+def verify_shards(shard_dir: str) -> List[str]:
+    """逐个分片核对条数、字节数和 sha256，返回问题列表"""
+    manifest = load_manifest(shard_dir)
+    if manifest is None:
+        return [f"找不到 manifest: {manifest_path(shard_dir)}"]
+    problems = []
+    listed = {shard["file"] for shard in manifest["shards"]}
+    for name in sorted(os.listdir(shard_dir)):
+        if name not in listed:
+            problems.append(f"{name}: 不在 manifest 中")
+    for shard in manifest["shards"]:
+        path = os.path.join(shard_dir, shard["file"])
+        if not os.path.exists(path):
+            problems.append(f"{shard['file']}: 文件缺失")
+            continue
+        if os.path.getsize(path) != shard["bytes"]:
+            problems.append(f"{shard['file']}: 字节数 {os.path.getsize(path)} != {shard['bytes']}")
+        if sha256_file(path) != shard["sha256"]:
+            problems.append(f"{shard['file']}: sha256 不一致")
+        with open(path, 'rb') as f:
+            count = sum(1 for line in f if line.strip())
+        if count != shard["records"]:
+            problems.append(f"{shard['file']}: 条数 {count} != {shard['records']}")
+    return problems
+
+
+def register_sharded_dataset(dataset_info_path: str, name: str, shard_dir: str, manifest: Dict):
+    """在 dataset_info.json 中登记分片目录（file_name 为相对 dataset_info 所在目录的路径）"""
+    dataset_info = {}
+    if os.path.exists(dataset_info_path):
+        with open(dataset_info_path, 'r', encoding='utf-8') as f:
+            dataset_info = json.load(f)
+    dataset_dir = os.path.dirname(os.path.abspath(dataset_info_path))
+    dataset_info[name] = {
+        "file_name": os.path.relpath(os.path.abspath(shard_dir), dataset_dir),
+        "formatting": "alpaca",
+        "columns": {
+            "prompt": "instruction",
+            "response": "output"
+        },
+        "num_samples": manifest["num_records"],
+        "num_shards": len(manifest["shards"]),
+    }
+    with open(dataset_info_path, 'w', encoding='utf-8') as f:
+        json.dump(dataset_info, f, ensure_ascii=False, indent=2)
+
+
+def save_sharded(records: List[Dict], shard_dir: str, shard_bytes: int = DEFAULT_SHARD_BYTES,
+                 append: bool = False, source: Optional[str] = None, dataset_name: Optional[str] = None,
+                 dataset_info_path: str = DATASET_INFO) -> Dict:
+    """batch_validator / data_constructor 共用：写分片，指定 dataset_name 时同时登记"""
+    manifest = write_shards(records, shard_dir, shard_bytes, append, source)
+    print(f"🧩 分片数据已保存到: {shard_dir}/ ({len(manifest['shards'])} 个分片, "
+          f"共 {manifest['num_records']} 条, manifest: {manifest_path(shard_dir)})")
+    if dataset_name:
+        register_sharded_dataset(dataset_info_path, dataset_name, shard_dir, manifest)
+        print(f"📝 已登记数据集 {dataset_name} -> {dataset_info_path}")
+    return manifest
+
+
+def add_shard_arguments(parser: argparse.ArgumentParser):
+    """--shard-dir 等参数（batch_validator.py / data_constructor.py 共用）"""
+    parser.add_argument('--shard-dir', type=str, default=None,
+                        help='同时把 alpaca 数据写成 JSONL 分片到该目录 (如 training_data/<name>)')
+    parser.add_argument('--shard-size', type=float, default=DEFAULT_SHARD_BYTES / 1024 / 1024,
+                        help='单个分片的最大 MB (默认: 4)')
+    parser.add_argument('--append', action='store_true', help='作为新批次追加分片，不重写已有分片')
+    parser.add_argument('--dataset-name', type=str, default=None, help='登记到 dataset_info.json 的数据集名')
+    parser.add_argument('--dataset-info', type=str, default=DATASET_INFO,
+                        help=f'dataset_info.json 路径 (默认: {DATASET_INFO})')
+
+
+def shard_bytes_from_args(args) -> int:
+    return max(1, int(args.shard_size * 1024 * 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='alpaca 数据分片工具')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    split_parser = subparsers.add_parser('split', help='把 alpaca JSON 文件写成分片')
+    split_parser.add_argument('input_file', help='alpaca 格式 JSON 文件')
+    split_parser.add_argument('shard_dir', help='分片目录')
+    split_parser.add_argument('--shard-size', type=float, default=DEFAULT_SHARD_BYTES / 1024 / 1024,
+                              help='单个分片的最大 MB (默认: 4)')
+    split_parser.add_argument('--append', action='store_true', help='作为新批次追加')
+    split_parser.add_argument('--register', metavar='NAME', help='登记到 dataset_info.json 的数据集名')
+    split_parser.add_argument('--dataset-info', default=DATASET_INFO, help=f'默认: {DATASET_INFO}')
+
+    verify_parser = subparsers.add_parser('verify', help='核对分片与 manifest')
+    verify_parser.add_argument('shard_dir', help='分片目录')
+
+    merge_parser = subparsers.add_parser('merge', help='合并分片为单个 alpaca JSON 文件')
+    merge_parser.add_argument('shard_dir', help='分片目录')
+    merge_parser.add_argument('--output', required=True, help='输出文件')
+    args = parser.parse_args()
+
+    if args.command == 'split':
+        records = load_alpaca(args.input_file)
+        save_sharded(records, args.shard_dir, shard_bytes_from_args(args), args.append, args.input_file,
+                     args.register, args.dataset_info)
+    elif args.command == 'verify':
+        problems = verify_shards(args.shard_dir)
+        for problem in problems:
+            print(f"❌ {problem}")
+        if problems:
+            sys.exit(1)
+        manifest = load_manifest(args.shard_dir)
+        print(f"✅ {len(manifest['shards'])} 个分片, {manifest['num_records']} 条记录, 校验通过")
+    elif args.command == 'merge':
+        records = list(iter_records(args.shard_dir))
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(records, f, ensure_ascii=False, indent=2)
+        print(f"📦 已合并 {len(records)} 条记录到: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
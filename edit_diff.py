@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+edit_diff.py - editor 函数调用的紧凑 diff 格式
+
+完整格式要求模型同时输出 original_code 和 modified_code，每个 EDIT 的输出 token 接近翻倍。
+紧凑格式只输出一个 unified diff（省略 ---/+++ 文件头，只保留 @@ 块）：
+
+    {"name": "editor", "arguments": {"diff": "@@ -2,3 +2,3 @@\\n def f(x):\\n-    if x > 0\\n+    if x > 0:\\n     return x"}}
+
+原始代码从查询中提取，apply_unified_diff 据此重建 modified_code。应用时先按 @@ 中的行号定位，
+行号对不上时在原始代码中查找唯一匹配的上下文，因此模型写错行号不影响结果。
+
+使用方法：
+    # 把训练数据中的 EDIT 输出转换为 diff 格式，并统计输出 token 的变化
+    python edit_diff.py convert outputs/training_data/xxx_alpaca.json --to diff
+    # 把推理结果中的 diff 还原为完整格式（original_code + modified_code）
+    python edit_diff.py convert outputs/tasks/hw3_2.json --to full --no-tokens
+"""
+
+import argparse
+import difflib
+import json
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+EDIT_FORMATS = ("full", "diff")
+DEFAULT_CONTEXT_LINES = 1
+EDITOR_CALL_PATTERN = re.compile(r'\{\s*"name"\s*:\s*"editor"')
+HUNK_HEADER_PATTERN = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+CODE_FENCE_PATTERN = re.compile(r'```[\w+-]*\n(.*?)```', re.DOTALL)
+# GPT 生成的 JSON 字符串里偶尔带有未转义的换行
+_decoder = json.JSONDecoder(strict=False)
+
+
+def make_unified_diff(original: str, modified: str, context: int = DEFAULT_CONTEXT_LINES) -> str:
+    """生成不带文件头的 unified diff"""
+    lines = difflib.unified_diff(original.splitlines(), modified.splitlines(), lineterm="", n=context)
+    return "\n".join(line for line in lines if not line.startswith(("---", "+++")))
+
+
+def _parse_hunks(diff: str) -> List[Dict]:
+    hunks = []
+    for line in diff.splitlines():
+        header = HUNK_HEADER_PATTERN.match(line)
+        if header:
+            hunks.append({"start": int(header.group(1)), "old": [], "new": []})
+            continue
+        if not hunks:
+            if line.strip():
+                raise ValueError(f"diff 在第一个 @@ 之前有内容: {line[:50]}")
+            continue
+        if line.startswith("\\"):
+            # "\ No newline at end of file"
+            continue
+        tag, text = (line[0], line[1:]) if line else (" ", "")
+        if tag == " ":
+            hunks[-1]["old"].append(text)
+            hunks[-1]["new"].append(text)
+        elif tag == "-":
+            hunks[-1]["old"].append(text)
+        elif tag == "+":
+            hunks[-1]["new"].append(text)
+        else:
+            raise ValueError(f"无法识别的 diff 行: {line[:50]}")
+    if not hunks:
+        raise ValueError("diff 中没有 @@ 块")
+    return hunks
+
+
+def _locate(lines: List[str], block: List[str], hint: int, cursor: int) -> int:
+    """在 lines[cursor:] 中定位 block：优先使用 @@ 行号，否则要求唯一匹配"""
+    if lines[hint:hint + len(block)] == block and hint >= cursor:
+        return hint
+    matches = [i for i in range(cursor, len(lines) - len(block) + 1) if lines[i:i + len(block)] == block]
+    if len(matches) != 1:
+        reason = "找不到" if not matches else f"有 {len(matches)} 处"
+        raise ValueError(f"diff 块 (@@ -{hint + 1}) 的上下文在原始代码中{reason}匹配")
+    return matches[0]
+
+
+def apply_unified_diff(original: str, diff: str) -> str:
+    """把 diff 应用到原始代码上，返回修改后的代码；无法应用时抛出 ValueError"""
+    lines = original.splitlines()
+    result: List[str] = []
+    cursor = 0
+    for hunk in _parse_hunks(diff):
+        # 纯插入块（没有上下文）在 @@ -N,0 中 N 表示插入到第 N 行之后
+        hint = hunk["start"] if not hunk["old"] else hunk["start"] - 1
+        if hunk["old"]:
+            position = _locate(lines, hunk["old"], hint, cursor)
+        elif cursor <= hint <= len(lines):
+            position = hint
+        else:
+            raise ValueError(f"插入位置 @@ -{hunk['start']},0 超出原始代码范围")
+        result.extend(lines[cursor:position])
+        result.extend(hunk["new"])
+        cursor = position + len(hunk["old"])
+    result.extend(lines[cursor:])
+    modified = "\n".join(result)
+    if original.endswith("\n") and result:
+        modified += "\n"
+    return modified
+
+
+def extract_query_code(query: str) -> str:
+    """从查询（或训练 instruction）中提取待修复的代码：优先代码块，否则取第一个空行之后的部分"""
+    fence = CODE_FENCE_PATTERN.search(query)
+    if fence:
+        return fence.group(1).rstrip("\n")
+    _, sep, code = query.partition("\n\n")
+    return code.strip("\n") if sep else query.strip("\n")
+
+
+def find_editor_call(output: str) -> Optional[Tuple[int, int, Dict]]:
+    """
+    找到输出中的 editor 函数调用
+
+    Returns:
+        tuple: (起始位置, 结束位置, 解析后的调用)，没有或无法解析时为 None
+    """
+    match = EDITOR_CALL_PATTERN.search(output)
+    if match is None:
+        return None
+    try:
+        call, end = _decoder.raw_decode(output, match.start())
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(call, dict):
+        return None
+    return match.start(), end, call
+
+
+def call_arguments(call: Dict) -> Dict:
+    """editor 调用的参数：{"name", "arguments": {...}}，或 hw3_2 基线中参数直接写在顶层的形式"""
+    if isinstance(call.get("arguments"), dict):
+        return call["arguments"]
+    return {key: value for key, value in call.items() if key != "name"}
+
+
+def editor_call_format(arguments: Dict) -> Optional[str]:
+    """根据参数判断 editor 调用的格式"""
+    if "diff" in arguments:
+        return "diff"
+    if "original_code" in arguments and "modified_code" in arguments:
+        return "full"
+    return None
+
+
+def check_editor_call(output: str, query: Optional[str] = None) -> Tuple[bool, str]:
+    """
+    检查 editor 调用的参数：只有 diff 格式需要校验（能解析，提供查询时还要求能应用到查询中的代码上）；
+    完整格式（参数在 arguments 中或直接在顶层）以及无法识别参数的调用保持原有检查结果，不额外拒绝
+    """
+    found = find_editor_call(output)
+    if found is None:
+        if re.search(r'"diff"\s*:', output):
+            return False, "diff 格式的 editor 调用无法解析为 JSON"
+        return True, "未解析 editor 参数"
+    arguments = call_arguments(found[2])
+    edit_format = editor_call_format(arguments)
+    if edit_format == "diff":
+        try:
+            if query is None:
+                _parse_hunks(arguments["diff"])
+            else:
+                apply_unified_diff(extract_query_code(query), arguments["diff"])
+        except (ValueError, AttributeError) as e:
+            return False, f"diff 无法应用: {e}"
+        return True, "diff 格式"
+    if edit_format == "full":
+        return True, "完整格式"
+    return True, "未识别的 editor 参数"
+
+
+def convert_output(output: str, to_format: str, query: Optional[str] = None,
+                   context: int = DEFAULT_CONTEXT_LINES) -> str:
+    """
+    在两种格式之间转换输出中的 editor 调用，其余文本不变
+
+    full -> diff 直接用 original_code 计算 diff；diff -> full 需要查询来取得原始代码。
+    没有 editor 调用或已经是目标格式时原样返回。
+    """
+    if to_format not in EDIT_FORMATS:
+        raise ValueError(f"未知的 editor 格式: {to_format} (可选: {', '.join(EDIT_FORMATS)})")
+    found = find_editor_call(output)
+    if found is None:
+        return output
+    start, end, call = found
+    arguments = call_arguments(call)
+    current = editor_call_format(arguments)
+    if current is None or current == to_format:
+        return output
+
+    if to_format == "diff":
+        new_arguments = {"diff": make_unified_diff(arguments["original_code"], arguments["modified_code"], context)}
+    else:
+        if query is None:
+            raise ValueError("diff -> full 需要查询中的原始代码")
+        original = extract_query_code(query)
+        new_arguments = {"original_code": original, "modified_code": apply_unified_diff(original, arguments["diff"])}
+    new_call = {"name": call["name"], "arguments": new_arguments}
+    return output[:start] + json.dumps(new_call, ensure_ascii=False) + output[end:]
+
+
+def _item_fields(item: Dict) -> Tuple[str, str]:
+    """兼容 alpaca（instruction/output）和 hw3_2（Query/Output）两种数据格式"""
+    if "Output" in item:
+        return "Query", "Output"
+    return "instruction", "output"
+
+
+def convert_dataset(data: List[Dict], to_format: str, tokenizer=None,
+                    context: int = DEFAULT_CONTEXT_LINES) -> Tuple[List[Dict], Dict]:
+    """
+    转换整个数据集
+
+    Returns:
+        tuple: (转换后的数据, 统计)；提供分词器时统计 EDIT 样本转换前后的输出 token 数
+    """
+    converted = []
+    stats = {"total": len(data), "converted": 0, "failed": 0, "tokens_before": 0, "tokens_after": 0, "errors": []}
+    for index, item in enumerate(data):
+        query_key, output_key = _item_fields(item)
+        output = item[output_key]
+        try:
+            new_output = convert_output(output, to_format, item.get(query_key), context)
+        except (ValueError, KeyError, TypeError) as e:
+            stats["failed"] += 1
+            stats["errors"].append({"index": index, "error": str(e)})
+            new_output = output
+        if new_output != output:
+            stats["converted"] += 1
+            if tokenizer is not None:
+                stats["tokens_before"] += len(tokenizer.encode(output, add_special_tokens=False))
+                stats["tokens_after"] += len(tokenizer.encode(new_output, add_special_tokens=False))
+        converted.append(dict(item, **{output_key: new_output}))
+    return converted, stats
+
+
+def print_stats(stats: Dict, to_format: str):
+    print(f"\n✂️  editor 格式转换 (-> {to_format}):")
+    print(f"   总样本数: {stats['total']}  已转换: {stats['converted']}  失败: {stats['failed']}")
+    if stats["tokens_before"]:
+        change = (stats["tokens_after"] - stats["tokens_before"]) / stats["tokens_before"] * 100
+        print(f"   已转换样本的输出 token: {stats['tokens_before']} -> {stats['tokens_after']} ({change:+.1f}%)")
+    for error in stats["errors"][:5]:
+        print(f"   ❌ 样本 {error['index']}: {error['error']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='editor 调用的完整格式与 diff 格式互相转换')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    convert_parser = subparsers.add_parser('convert', help='转换数据文件中的 editor 调用')
+    convert_parser.add_argument('input_file', help='alpaca 格式训练数据或 Query/Output 格式结果文件')
+    convert_parser.add_argument('--to', choices=list(EDIT_FORMATS), default='diff', help='目标格式 (默认: diff)')
+    convert_parser.add_argument('--output', help='输出文件 (默认: <输入文件名>_<格式>.json)')
+    convert_parser.add_argument('--context', type=int, default=DEFAULT_CONTEXT_LINES,
+                                help=f'diff 上下文行数 (默认: {DEFAULT_CONTEXT_LINES})')
+    convert_parser.add_argument('--tokenizer', default="./tokenizer_with_special_tokens",
+                                help='用于统计输出 token 的分词器')
+    convert_parser.add_argument('--no-tokens', action='store_true', help='不统计输出 token')
+    args = parser.parse_args()
+
+    with open(args.input_file, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+
+    tokenizer = None
+    if not args.no_tokens:
+        from tokenizer_registry import get_tokenizer
+        tokenizer = get_tokenizer(args.tokenizer)
+
+    converted, stats = convert_dataset(data, args.to, tokenizer, args.context)
+    print_stats(stats, args.to)
+
+    output_file = args.output or args.input_file.replace('.json', f'_{args.to}.json')
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(converted, f, ensure_ascii=False, indent=2)
+    print(f"💾 已保存到: {output_file}")
+
+
+if __name__ == "__main__":
+    main()
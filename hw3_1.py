@@ -1,104 +1,235 @@
-from transformers import AutoTokenizer
+import argparse
 import json, os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+from token_store import TokenStore, special_token_ids, tokenizer_hash, write_token_store
+from tokenizer_registry import ensure_tokenizer_artifact, get_fast_tokenizer, get_tokenizer
 
 # 模型和文件路径
 MODEL_PATH = "/home/share/models/Qwen3-8B"
 INPUT_JSON = "query_and_output.json"
 OUTPUT_JSON = "outputs/tasks/hw3_1.json"
 TOKENIZER_SAVE_PATH = "./tokenizer_with_special_tokens"  # 保存tokenizer的本地路径
+PACKED_DIR = "outputs/tasks/hw3_1_tokens"  # packed 格式的输出目录
+TEXTS_FILE = "texts.jsonl"  # packed 格式中原文和解码文本的旁路文件
 
-# 1. 加载 tokenizer
-tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH)
-
-# 2. 定义特殊 tokens
+# 定义特殊 tokens
 new_tokens = ["<|AGENT|>", "<|EDIT|>"]
 
-# 3. 添加特殊 tokens
-tokenizer.add_special_tokens({'additional_special_tokens': new_tokens})
-
-# 4. 保存修改后的tokenizer到本地
-tokenizer.save_pretrained(TOKENIZER_SAVE_PATH)
-
-# 5. 读取原始的 Query&Output
-with open(INPUT_JSON, "r", encoding="utf-8") as f:
-    tasks = json.load(f)
-
-# 6. 合并 Query 和 Output，生成输出记录
-records = {
-    "special_tokens": [
-        {
-            "token": token,
-            "id": tokenizer.convert_tokens_to_ids(token)
-        } for token in new_tokens
-    ],
-    "tasks": []
-}
-
-for item in tasks:
-    # 合并字段
-    merged_text = item["Query"].strip() + "\n" + item["Output"].strip()
-    # 编码并获取 token IDs
-    ids = tokenizer.encode(merged_text, add_special_tokens=True)
-    # 解码验证
-    decoded = tokenizer.decode(ids, skip_special_tokens=False)
-    records["tasks"].append({
-        "text": merged_text,
-        "token_ids": ids,
-        "decoded_text": decoded
+def merge_item(item: Dict) -> str:
+    """合并 Query 和 Output（同时支持 alpaca 格式的 instruction/output）"""
+    query = item["Query"] if "Query" in item else item["instruction"]
+    output = item["Output"] if "Output" in item else item["output"]
+    return query.strip() + "\n" + output.strip()
+
+def encode_chunk(tokenizer, texts: List[str]) -> Tuple[List[List[int]], List[str]]:
+    """一次调用快速分词器的批量编码和批量解码（Rust 侧并行）"""
+    ids = tokenizer(texts, add_special_tokens=True)["input_ids"]
+    decoded = tokenizer.batch_decode(ids, skip_special_tokens=False)
+    return ids, decoded
+
+# 多进程分片时每个工作进程持有自己的分词器
+_worker_tokenizer = None
+
+def _init_worker(tokenizer_path: str):
+    global _worker_tokenizer
+    # 进程间已经并行，关闭进程内的 Rust 线程池避免超额订阅
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    _worker_tokenizer = get_tokenizer(tokenizer_path)
+
+def _encode_chunk_in_worker(texts: List[str]) -> Tuple[List[List[int]], List[str]]:
+    return encode_chunk(_worker_tokenizer, texts)
+
+def encode_texts(tokenizer, texts: List[str], batch_size: int = 4096, workers: int = 1) -> Tuple[List[List[int]], List[str]]:
+    """
+    大块批量编码 + 解码
+
+    Args:
+        batch_size: 每次送入分词器的文本数
+        workers: >1 时按块分片到多个进程（工作进程从 TOKENIZER_SAVE_PATH 加载分词器）
+    """
+    chunks = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    all_ids, all_decoded = [], []
+
+    if workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(TOKENIZER_SAVE_PATH,)) as executor:
+            results = executor.map(_encode_chunk_in_worker, chunks)
+            for ids, decoded in results:
+                all_ids.extend(ids)
+                all_decoded.extend(decoded)
+    else:
+        for chunk in chunks:
+            ids, decoded = encode_chunk(tokenizer, chunk)
+            all_ids.extend(ids)
+            all_decoded.extend(decoded)
+
+    return all_ids, all_decoded
+
+def save_packed(store_dir: str, tokenizer, texts: List[str], all_ids: List[List[int]], all_decoded: List[str]) -> Dict:
+    """
+    packed 格式：token ID 写为 uint32 扁平数组 + offsets 索引 + manifest，可直接内存映射切片；
+    原文和解码文本逐行写入 texts.jsonl
+    """
+    manifest = write_token_store(store_dir, all_ids, {
+        "kind": "hw3_1_tokens",
+        "tokenizer_hash": tokenizer_hash(tokenizer),
+        "special_token_ids": {token: tokenizer.convert_tokens_to_ids(token) for token in new_tokens},
+        "additional_special_token_ids": special_token_ids(tokenizer),
     })
+    with open(os.path.join(store_dir, TEXTS_FILE), "w", encoding="utf-8") as f:
+        for text, decoded in zip(texts, all_decoded):
+            f.write(json.dumps({"text": text, "decoded_text": decoded}, ensure_ascii=False) + "\n")
+    return manifest
 
-# 7. 答案写入 JSON
-import os
-os.makedirs(os.path.dirname(OUTPUT_JSON), exist_ok=True)
-with open(OUTPUT_JSON, "w", encoding="utf-8") as f:
-    json.dump(records, f, ensure_ascii=False, indent=2)
+def load_packed_records(store_dir: str) -> Dict:
+    """把 packed 格式还原为原来的 hw3_1.json 结构"""
+    store = TokenStore(store_dir)
+    with open(os.path.join(store_dir, TEXTS_FILE), "r", encoding="utf-8") as f:
+        texts = [json.loads(line) for line in f if line.strip()]
+    if len(texts) != len(store):
+        raise ValueError(f"{TEXTS_FILE} 有 {len(texts)} 条，与 token 存储的 {len(store)} 条不一致")
 
-# 8. 定义打印 token 详情的函数
-def print_token_details(task, title):
+    return {
+        "special_tokens": [
+            {"token": token, "id": token_id}
+            for token, token_id in store.manifest["special_token_ids"].items()
+        ],
+        "tasks": [
+            {
+                "text": item["text"],
+                "token_ids": store[i].tolist(),
+                "decoded_text": item["decoded_text"]
+            } for i, item in enumerate(texts)
+        ]
+    }
+
+def save_json(records: Dict, path: str):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(records, f, ensure_ascii=False, indent=2)
+
+def format_token_text(token_text: str) -> str:
+    """处理特殊字符显示"""
+    if token_text == '\n':
+        return '\\n'
+    elif token_text == '\t':
+        return '\\t'
+    elif token_text == ' ':
+        return '_'  # 用下划线表示空格
+    elif token_text.strip() == '':
+        return f"'{token_text}'"  # 其他空白字符用引号包围
+    return token_text
+
+def print_token_details(tokenizer, task, title):
+    """打印 token 详情：一次调用得到全部 token 和 offset，不再逐个 token 解码"""
     print(f"\n=== {title} ===")
     print(f"\n--- Token详情 (每行一个token和ID) ---")
-    for i, token_id in enumerate(task['token_ids']):
-        # 将单个token ID转换回文字
-        token_text = tokenizer.decode([token_id])
-        
-        # 处理特殊字符显示
-        if token_text == '\n':
-            display_text = '\\n'
-        elif token_text == '\t':
-            display_text = '\\t'
-        elif token_text == ' ':
-            display_text = '_'  # 用下划线表示空格
-        elif token_text.strip() == '':
-            display_text = f"'{token_text}'"  # 其他空白字符用引号包围
-        else:
-            display_text = token_text
-        
+    encoding = tokenizer(task['text'], add_special_tokens=True, return_offsets_mapping=True)
+    tokens = tokenizer.convert_ids_to_tokens(encoding["input_ids"])
+    for i, (token_id, token, (start, end)) in enumerate(zip(encoding["input_ids"], tokens, encoding["offset_mapping"])):
+        # 用 offset 在原文中切出 token 对应的文字；没有 offset 的 token 显示原始 token
+        token_text = task['text'][start:end] if end > start else token
+        display_text = format_token_text(token_text)
         print(f"Token {i:3d}: {display_text:15} | ID: {token_id}")
     print()
 
-# 9. 展示第一条和最后一条数据的结果
-if records["tasks"]:
-    print_token_details(records["tasks"][0], "第一条数据")
-    
-    if len(records["tasks"]) > 1:
-        print_token_details(records["tasks"][-1], "最后一条数据")
-    else:
-        print("\n只有一条数据")
-
-print(f"\n已生成 {OUTPUT_JSON}，共处理 {len(records['tasks'])} 条数据")
-
-# 10. 验证保存的tokenizer
-print(f"\n=== 验证保存的tokenizer ===")
-try:
-    # 重新加载保存的tokenizer
-    loaded_tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_SAVE_PATH)
-    print(f"成功从 {TOKENIZER_SAVE_PATH} 加载tokenizer")
-    
-    # 验证特殊tokens是否正确保存
-    for token in new_tokens:
-        original_id = tokenizer.convert_tokens_to_ids(token)
-        loaded_id = loaded_tokenizer.convert_tokens_to_ids(token)
-        print(f"特殊token '{token}': 原始ID={original_id}, 加载后ID={loaded_id}, 一致性={'✓' if original_id == loaded_id else '✗'}")
-        
-except Exception as e:
-    print(f"加载保存的tokenizer时出错: {e}")
\ No newline at end of file
+def main():
+    parser = argparse.ArgumentParser(description='为 Qwen3-8B 分词器添加特殊词符，并批量分词 Query&Output')
+    parser.add_argument('--input', default=INPUT_JSON, help=f'输入文件 (默认: {INPUT_JSON})')
+    parser.add_argument('--output', default=OUTPUT_JSON, help=f'输出文件 (默认: {OUTPUT_JSON})')
+    parser.add_argument('--batch-size', type=int, default=4096, help='每批分词的文本数 (默认: 4096)')
+    parser.add_argument('--workers', type=int, default=1, help='多进程分片数，超大输入时使用 (默认: 1)')
+    parser.add_argument('--format', choices=['json', 'packed'], default='json',
+                        help='输出格式: json (原 hw3_1.json 结构) 或 packed (uint32 数组 + offsets + manifest)')
+    parser.add_argument('--packed-dir', default=PACKED_DIR, help=f'packed 格式输出目录 (默认: {PACKED_DIR})')
+    parser.add_argument('--to-json', metavar='PACKED_DIR', help='把 packed 目录转换回 JSON 格式（写到 --output）后退出')
+    parser.add_argument('--rebuild-tokenizer', action='store_true', help='忽略分词器产物缓存，强制重建')
+    args = parser.parse_args()
+
+    if args.to_json:
+        records = load_packed_records(args.to_json)
+        save_json(records, args.output)
+        print(f"已将 {args.to_json} 转换为 {args.output}，共 {len(records['tasks'])} 条数据")
+        return
+
+    # 1-3. 加载 tokenizer、添加特殊 tokens 并保存到本地
+    #      基座分词器文件和特殊 tokens 都没变时直接复用已有产物
+    registry, built = ensure_tokenizer_artifact(MODEL_PATH, new_tokens, TOKENIZER_SAVE_PATH,
+                                                force=args.rebuild_tokenizer)
+    print(f"{'已重新构建' if built else '复用已有'}分词器: {TOKENIZER_SAVE_PATH} (键 {(registry.get('key') or 'legacy')[:16]})")
+    tokenizer = get_tokenizer(TOKENIZER_SAVE_PATH)
+
+    # 4. 读取原始的 Query&Output
+    with open(args.input, "r", encoding="utf-8") as f:
+        tasks = json.load(f)
+
+    # 5. 合并 Query 和 Output，批量编码并解码验证
+    texts = [merge_item(item) for item in tasks]
+    start_time = time.time()
+    all_ids, all_decoded = encode_texts(tokenizer, texts, args.batch_size, args.workers)
+    elapsed = time.time() - start_time
+
+    if args.format == 'packed':
+        manifest = save_packed(args.packed_dir, tokenizer, texts, all_ids, all_decoded)
+        output_path = args.packed_dir
+        print(f"packed 格式: {manifest['num_sequences']} 条序列, {manifest['total_tokens']} 个token")
+
+    records = {
+        "special_tokens": [
+            {
+                "token": token,
+                "id": tokenizer.convert_tokens_to_ids(token)
+            } for token in new_tokens
+        ],
+        "tasks": [
+            {
+                "text": text,
+                "token_ids": ids,
+                "decoded_text": decoded
+            } for text, ids, decoded in zip(texts, all_ids, all_decoded)
+        ]
+    }
+
+    # 6. 答案写入 JSON
+    if args.format == 'json':
+        save_json(records, args.output)
+        output_path = args.output
+
+    # 7. 展示第一条和最后一条数据的结果
+    if records["tasks"]:
+        print_token_details(tokenizer, records["tasks"][0], "第一条数据")
+
+        if len(records["tasks"]) > 1:
+            print_token_details(tokenizer, records["tasks"][-1], "最后一条数据")
+        else:
+            print("\n只有一条数据")
+
+    total_tokens = sum(len(ids) for ids in all_ids)
+    print(f"\n已生成 {output_path}，共处理 {len(records['tasks'])} 条数据")
+    print(f"分词耗时 {elapsed:.3f} 秒，共 {total_tokens} 个token ({total_tokens / max(elapsed, 1e-9):.0f} token/s)")
+
+    # 8. 验证保存的tokenizer：与构建时（基座分词器 + 添加的特殊tokens）在 registry 中记录的 ID 对比
+    print(f"\n=== 验证保存的tokenizer ===")
+    try:
+        # 只加载序列化的 tokenizer.json 快速路径，不再完整构造一次 tokenizer
+        loaded_tokenizer = get_fast_tokenizer(TOKENIZER_SAVE_PATH)
+        print(f"成功从 {TOKENIZER_SAVE_PATH} 加载tokenizer")
+        if registry.get('key') is None:
+            print("旧产物没有构建记录，以下 ID 取自产物本身")
+        if registry['added_tokens'] != new_tokens:
+            print(f"添加的特殊tokens不一致: 构建时 {registry['added_tokens']}，当前 {new_tokens}")
+
+        # 验证特殊tokens是否正确保存
+        for token in new_tokens:
+            original_id = registry['special_token_ids'].get(token)
+            loaded_id = loaded_tokenizer.token_to_id(token)
+            print(f"特殊token '{token}': 构建时ID={original_id}, 加载后ID={loaded_id}, 一致性={'✓' if original_id == loaded_id else '✗'}")
+
+    except Exception as e:
+        print(f"加载保存的tokenizer时出错: {e}")
+
+if __name__ == '__main__':
+    main()
@@ -1,87 +1,29 @@
 import os
 import time
 import json
-from typing import List, Dict
-import vllm
-from transformers import AutoTokenizer
-
-# 初始化 vLLM 引擎
-print("=== vLLM 引擎初始化 ===")
-print("正在初始化 vLLM 引擎...")
-print("注意: vLLM 初始化可能需要几分钟时间")
-
-tokenizer = AutoTokenizer.from_pretrained("./tokenizer_with_special_tokens", trust_remote_code=True)
-
-# vLLM 引擎配置
-llm = vllm.LLM(
-    model="/home/share/models/Qwen3-8B",
-    gpu_memory_utilization=0.8, 
-    trust_remote_code=True,
-    enforce_eager=True,
-    max_model_len=4096,
-)
-
-print("vLLM 引擎和分词器初始化完成！")
+import argparse
+from typing import List, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
 
-# 读取查询数据
-with open('query_only.json', 'r', encoding='utf-8') as f:
-    queries = json.load(f)
-
-# 配置采样参数
-sampling_params = vllm.SamplingParams(
-    temperature=0.7,
-    top_p=0.8,
-    max_tokens=2048,
-    stop=None,
+from cpu_quant import QUANTIZATION_MODES
+from inference_backends import DEFAULT_SAMPLING, create_backend, parse_lora_adapters
+from inference_metrics import (
+    MetricsWriter, build_request_record, load_records, print_summary, profile_generation, summarize,
 )
+from prompt_lookup import DEFAULT_MAX_NGRAM, DEFAULT_NUM_DRAFT_TOKENS
+from repair_rounds import print_round_report, run_repair_rounds
+from think_budget import ThinkBudgetEngine, print_think_report, think_report
+from token_validator import VALIDATE_ACTIONS
+from prompt_store import PROMPT_STORE_ROOT, find_prompt_store, open_prompt_store, prepare_prompt_store
+import tokenizer_registry
 
-# 定义工具列表 - 符合Qwen格式
-tools = [
-    {
-        "type": "function",
-        "function": {
-            "name": "python",
-            "description": "Execute Python code for debugging and analysis",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "code": {
-                        "type": "string",
-                        "description": "Python code to execute"
-                    }
-                },
-                "required": ["code"]
-            }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "editor",
-            "description": "Edit and merge code by comparing original and modified versions",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "original_code": {
-                        "type": "string",
-                        "description": "Original code before modification"
-                    },
-                    "modified_code": {
-                        "type": "string",
-                        "description": "Modified code after fixing"
-                    }
-                },
-                "required": ["original_code", "modified_code"]
-            }
-        }
-    }
-]
+# 模型和文件路径
+MODEL_PATH = "/home/share/models/Qwen3-8B"
+TOKENIZER_PATH = "./tokenizer_with_special_tokens"
+QUERY_FILE = 'query_only.json'
+OUTPUT_FILE = 'outputs/tasks/hw3_2.json'
 
-def generate_prompt(query: str) -> str:
-    """
-    为单个查询生成prompt
-    """
-    system_content = """你是一个专业的代码调试助手。请根据用户的问题类型选择合适的处理模式：
+SYSTEM_PROMPT = """你是一个专业的代码调试助手。请根据用户的问题类型选择合适的处理模式：
 
 **处理模式规则：**
 
@@ -102,58 +44,361 @@ def generate_prompt(query: str) -> str:
 
 请严格按照上述格式输出，确保包含<think>部分和相应的特殊词符 <|EDIT|> 或 <|AGENT|>。"""
 
-    messages = [
-        {"role": "system", "content": system_content},
+# 紧凑 editor 格式（见 edit_diff.py）：只输出相对查询中代码的 unified diff
+SYSTEM_PROMPT_DIFF = SYSTEM_PROMPT.replace(
+    '{"name": "editor", "arguments": {"original_code": "原始代码", "modified_code": "修复后的代码"}}',
+    '{"name": "editor", "arguments": {"diff": "@@ -行号,行数 +行号,行数 @@\\n 上下文\\n-删除的行\\n+新增的行"}}'
+)
+
+SYSTEM_PROMPTS = {"full": SYSTEM_PROMPT, "diff": SYSTEM_PROMPT_DIFF}
+
+# 分词器 (延迟初始化)
+tokenizer = None
+
+def get_tokenizer():
+    """获取带特殊词符的分词器，延迟初始化（经 tokenizer_registry 缓存，输入不变时不重建）"""
+    global tokenizer
+    if tokenizer is None:
+        tokenizer = tokenizer_registry.get_tokenizer(TOKENIZER_PATH)
+    return tokenizer
+
+def build_messages(query: str, system_prompt: str = SYSTEM_PROMPT) -> List[Dict]:
+    """为单个查询构造对话消息"""
+    return [
+        {"role": "system", "content": system_prompt},
         {"role": "user", "content": query}
     ]
-    
-    text = tokenizer.apply_chat_template(
-        messages, 
-        tokenize=False, 
-        add_generation_prompt=True
+
+def render_messages(messages: List[Dict], tools: Optional[List[Dict]] = None, chat_tokenizer=None) -> str:
+    """
+    渲染对话模板（离线 run、serve 和检查点对比共用，保证同一查询得到同一个 prompt）
+
+    工具定义只在调用方显式提供时传入模板；默认与基线一致，格式要求全部写在系统提示词中。
+    """
+    extra = {"tools": tools} if tools else {}
+    return (chat_tokenizer or get_tokenizer()).apply_chat_template(
+        messages,
+        tokenize=False,
+        add_generation_prompt=True,
+        **extra
     )
-    
-    return text
-
-# 处理所有查询并生成输出
-print("=== 开始处理查询 ===")
-
-# 第一步：为所有查询生成prompt
-print("正在生成所有查询的prompt...")
-text_list = []
-for i, query_item in enumerate(queries):
-    query = query_item["Query"]
-    prompt = generate_prompt(query)
-    text_list.append(prompt)
-
-print(f"所有prompt生成完成，共{len(text_list)}个")
-
-# 第二步：批量推理
-print("\n开始批量推理...")
-start_time = time.time()
-outputs = llm.generate(text_list, sampling_params)
-end_time = time.time()
-inference_time = end_time - start_time
-print(f"批量推理完成，耗时: {inference_time:.2f} 秒")
-
-# 第三步：整理结果
-print("\n整理结果...")
-results = []
-for i, (query_item, output) in enumerate(zip(queries, outputs)):
-    query = query_item["Query"]
-    response = output.outputs[0].text
-    
-    results.append({
-        "Query": query,
-        "Output": response
-    })
-    
-# 保存结果到文件
-import os
-output_file = 'outputs/tasks/hw3_2.json'
-os.makedirs(os.path.dirname(output_file), exist_ok=True)
-with open(output_file, 'w', encoding='utf-8') as f:
-    json.dump(results, f, ensure_ascii=False, indent=2)
 
-print(f"\n=== 处理完成 ===")
-print(f"结果已保存到: {output_file}")
\ No newline at end of file
+def generate_prompt(query: str, system_prompt: str = SYSTEM_PROMPT) -> str:
+    """
+    为单个查询生成prompt
+    """
+    return render_messages(build_messages(query, system_prompt))
+
+def encode_prompt(prompt: str) -> List[int]:
+    """将渲染好的prompt编码为token ID（模板已包含所有特殊词符）"""
+    return get_tokenizer().encode(prompt, add_special_tokens=False)
+
+def load_queries(query_file: str) -> List[Dict]:
+    """读取查询数据"""
+    with open(query_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_results(results: List[Dict], output_file: str):
+    """保存结果到文件"""
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+def backend_kwargs(args) -> Dict:
+    """按后端类型整理引擎参数"""
+    kwargs = {
+        "speculative": None if args.speculative == 'none' else args.speculative,
+        "num_draft_tokens": args.num_draft_tokens,
+        "prompt_lookup_max": args.prompt_lookup_max,
+        "lora_adapters": parse_lora_adapters(args.lora),
+        "max_lora_rank": args.max_lora_rank,
+    }
+    if args.backend == 'vllm':
+        kwargs.update({
+            "gpu_memory_utilization": args.gpu_memory_utilization,
+            "max_model_len": args.max_model_len,
+        })
+    elif args.backend == 'cpu-quant':
+        kwargs.update({
+            "quantization": args.quantization,
+            "num_threads": args.num_threads,
+            "max_batch_size": args.max_batch_size,
+        })
+    else:
+        kwargs.update({
+            "device": args.device,
+            "dtype": args.dtype,
+            "max_batch_size": args.max_batch_size,
+        })
+    return kwargs
+
+def sampling_from_args(args) -> Dict:
+    """命令行参数 -> 采样参数字典"""
+    return {
+        "temperature": args.temperature,
+        "top_p": args.top_p,
+        "max_tokens": args.max_tokens,
+        "validate": args.validate_tokens,
+        "adapter": args.adapter,
+    }
+
+def load_prompt_ids(args, queries: List[Dict]) -> List:
+    """获取所有查询的prompt token ID：命中预分词存储时直接返回内存映射视图，否则现场渲染并分词"""
+    store = None
+    if args.prompt_store:
+        store = open_prompt_store(args.prompt_store, args.queries, get_tokenizer(), SYSTEM_PROMPTS[args.edit_format])
+        if store is None:
+            print(f"⚠️  prompt存储 {args.prompt_store} 不存在，或与查询文件、分词器、--edit-format 不匹配，改为现场分词")
+    elif not args.no_prompt_store:
+        store = find_prompt_store(args.queries, get_tokenizer(), SYSTEM_PROMPTS[args.edit_format], args.store_root)
+
+    if store is not None:
+        print(f"使用预分词prompt存储: {store.store_dir}")
+        return list(store)
+
+    print("正在生成所有查询的prompt...")
+    system_prompt = SYSTEM_PROMPTS[args.edit_format]
+    return [encode_prompt(generate_prompt(query_item["Query"], system_prompt)) for query_item in queries]
+
+def run_prepare(args):
+    """prepare 模式：渲染并分词所有查询一次，写入内存映射的prompt存储"""
+    print(f"=== 预分词查询文件: {args.queries} ===")
+    start_time = time.time()
+    system_prompt = SYSTEM_PROMPTS[args.edit_format]
+    store_dir, manifest = prepare_prompt_store(
+        args.queries, get_tokenizer(), lambda query: generate_prompt(query, system_prompt), system_prompt,
+        root=args.store_root, batch_size=args.batch_size
+    )
+    elapsed = time.time() - start_time
+    print(f"✅ 已写入 {manifest['num_sequences']} 个prompt，共 {manifest['total_tokens']} 个token，耗时 {elapsed:.2f} 秒")
+    print(f"📁 存储目录: {store_dir}")
+
+def repair_sampling_from_args(args) -> Dict:
+    """修复轮次的采样参数：更低的 temperature + n-best"""
+    return {
+        "temperature": args.repair_temperature,
+        "top_p": args.top_p,
+        "max_tokens": args.max_tokens,
+        "n": args.repair_n,
+        "validate": args.validate_tokens,
+        "adapter": args.adapter,
+    }
+
+def run_offline(args):
+    """离线模式：加载引擎，批量处理整个查询文件"""
+    # 初始化推理引擎
+    print("=== 推理引擎初始化 ===")
+    print(f"正在初始化 {args.backend} 引擎...")
+    print("注意: 引擎初始化可能需要几分钟时间；多次运行请使用 serve 模式保持引擎常驻")
+
+    get_tokenizer()
+    engine = create_backend(args.backend, args.model, TOKENIZER_PATH, **backend_kwargs(args))
+    if args.think_budget:
+        # 两阶段生成：思考部分最多 think_budget 个 token，第二阶段从标记开始
+        engine = ThinkBudgetEngine(engine, get_tokenizer(), args.think_budget)
+
+    print("推理引擎和分词器初始化完成！")
+
+    queries = load_queries(args.queries)
+
+    # 处理所有查询并生成输出
+    print("=== 开始处理查询 ===")
+
+    # 第一步：为所有查询生成prompt（优先读取 prepare 生成的预分词存储）
+    prompt_ids = load_prompt_ids(args, queries)
+    print(f"所有prompt生成完成，共{len(prompt_ids)}个")
+
+    # 第二步：批量推理（边生成边校验，失败的prompt进入修复轮次）
+    print("\n开始批量推理...")
+    metrics_writer = MetricsWriter(args.metrics_file)
+    start_time = time.time()
+    with profile_generation(args.profile):
+        texts, rounds = run_repair_rounds(
+            engine, prompt_ids, sampling_from_args(args), repair_sampling_from_args(args),
+            max_rounds=args.repair_rounds,
+            target_pass_rate=args.target_pass_rate,
+            num_gpus=args.num_gpus,
+            on_result=lambda round_index, index, result: metrics_writer.write(
+                build_request_record(index, result, round_index))
+        )
+    end_time = time.time()
+    inference_time = end_time - start_time
+    print(f"批量推理完成，耗时: {inference_time:.2f} 秒")
+    engine.close()
+    metrics_writer.close()
+    print_round_report(rounds)
+
+    summary = summarize(metrics_writer.records, inference_time)
+    print_summary(summary)
+    if args.metrics_file:
+        summary_file = os.path.splitext(args.metrics_file)[0] + '_summary.json'
+        with open(summary_file, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"📈 单请求指标已保存到: {args.metrics_file}，汇总: {summary_file}")
+
+    if args.think_budget:
+        baseline = None
+        if args.baseline_metrics:
+            baseline = summarize(load_records(args.baseline_metrics))
+        think = think_report(engine.records, args.think_budget, engine.phase_seconds, baseline, inference_time)
+        print_think_report(think)
+        think_file = os.path.join("outputs/reports", os.path.basename(args.output).replace('.json', '_think_report.json'))
+        os.makedirs(os.path.dirname(think_file), exist_ok=True)
+        with open(think_file, 'w', encoding='utf-8') as f:
+            json.dump(think, f, ensure_ascii=False, indent=2)
+        print(f"🧠 思考预算报告已保存到: {think_file}")
+
+    # 第三步：整理结果
+    print("\n整理结果...")
+    results = []
+    for query_item, text in zip(queries, texts):
+        results.append({
+            "Query": query_item["Query"],
+            "Output": text
+        })
+
+    report_file = os.path.join("outputs/reports", os.path.basename(args.output).replace('.json', '_repair_report.json'))
+    os.makedirs(os.path.dirname(report_file), exist_ok=True)
+    with open(report_file, 'w', encoding='utf-8') as f:
+        json.dump({"inference_time": inference_time, "rounds": rounds}, f, ensure_ascii=False, indent=2)
+    print(f"📊 修复轮次报告已保存到: {report_file}")
+
+    save_results(results, args.output)
+
+    print(f"\n=== 处理完成 ===")
+    print(f"结果已保存到: {args.output}")
+
+def run_client(args):
+    """客户端模式：把查询文件作为请求提交给常驻的 serve 服务"""
+    from openai import OpenAI
+
+    client = OpenAI(api_key="EMPTY", base_url=args.server, timeout=args.request_timeout)
+    queries = load_queries(args.queries)
+    sampling = sampling_from_args(args)
+
+    def submit(query_item: Dict) -> str:
+        # 服务端会注入系统提示词和工具定义，这里只发送用户查询
+        response = client.chat.completions.create(
+            # 服务端按 model 字段选择适配器
+            model=args.adapter or args.served_model_name,
+            messages=[{"role": "user", "content": query_item["Query"]}],
+            temperature=sampling["temperature"],
+            top_p=sampling["top_p"],
+            max_tokens=sampling["max_tokens"],
+        )
+        return response.choices[0].message.content or ""
+
+    print(f"=== 提交 {len(queries)} 个查询到 {args.server} (并发 {args.concurrency}) ===")
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        responses = list(executor.map(submit, queries))
+    inference_time = time.time() - start_time
+    print(f"全部请求完成，耗时: {inference_time:.2f} 秒")
+
+    results = [
+        {"Query": query_item["Query"], "Output": response}
+        for query_item, response in zip(queries, responses)
+    ]
+    save_results(results, args.output)
+
+    print(f"\n=== 处理完成 ===")
+    print(f"结果已保存到: {args.output}")
+
+def add_engine_arguments(parser: argparse.ArgumentParser):
+    """推理引擎相关参数（run 和 serve 共用）"""
+    parser.add_argument('--backend', choices=['vllm', 'transformers', 'cpu-quant'], default='vllm',
+                        help='推理后端 (默认: vllm；transformers 可在 CPU 上本地测试；cpu-quant 为无 GPU 机器的 int8 量化推理)')
+    parser.add_argument('--model', default=MODEL_PATH, help=f'模型路径 (默认: {MODEL_PATH})')
+    parser.add_argument('--gpu-memory-utilization', type=float, default=0.8, help='vLLM 显存占用比例')
+    parser.add_argument('--max-model-len', type=int, default=4096, help='vLLM 最大上下文长度')
+    parser.add_argument('--device', default='cpu', help='transformers 后端设备 (默认: cpu)')
+    parser.add_argument('--dtype', default='float32', help='transformers 后端精度 (默认: float32)')
+    parser.add_argument('--max-batch-size', type=int, default=8, help='transformers 后端连续批处理的最大批大小')
+    parser.add_argument('--quantization', choices=list(QUANTIZATION_MODES), default='dynamic',
+                        help='cpu-quant 后端的 Linear 量化方式 (默认: dynamic)')
+    parser.add_argument('--num-threads', type=int, default=None, help='cpu-quant 后端的计算线程数 (默认: 物理核数)')
+    parser.add_argument('--speculative', choices=['none', 'prompt-lookup'], default='none',
+                        help='投机解码模式：prompt-lookup 用prompt中的n-gram匹配作为草稿 (默认: none)')
+    parser.add_argument('--num-draft-tokens', type=int, default=DEFAULT_NUM_DRAFT_TOKENS, help='每轮草稿token数')
+    parser.add_argument('--prompt-lookup-max', type=int, default=DEFAULT_MAX_NGRAM, help='prompt-lookup 最长匹配n-gram')
+    parser.add_argument('--lora', action='append', default=[], metavar='NAME=PATH',
+                        help='在基座模型上加载 LoRA 适配器，可重复指定 (如 ckpt100=saves/Qwen2.5-3B/lora/train_x/checkpoint-100)')
+    parser.add_argument('--max-lora-rank', type=int, default=16, help='vLLM 支持的最大 LoRA rank (默认: 16)')
+
+def add_edit_format_argument(parser: argparse.ArgumentParser):
+    parser.add_argument('--edit-format', choices=list(SYSTEM_PROMPTS), default='full',
+                        help='editor 调用格式：full 输出完整的原始/修改代码，diff 只输出 unified diff (默认: full)')
+
+def add_sampling_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--temperature', type=float, default=DEFAULT_SAMPLING["temperature"])
+    parser.add_argument('--top-p', type=float, default=DEFAULT_SAMPLING["top_p"])
+    parser.add_argument('--max-tokens', type=int, default=DEFAULT_SAMPLING["max_tokens"])
+
+def main():
+    parser = argparse.ArgumentParser(description='使用特殊词符系统提示词进行代码调试推理')
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run', help='批量处理查询文件 (默认)')
+    run_parser.add_argument('--queries', default=QUERY_FILE, help=f'查询文件 (默认: {QUERY_FILE})')
+    run_parser.add_argument('--output', default=OUTPUT_FILE, help=f'输出文件 (默认: {OUTPUT_FILE})')
+    run_parser.add_argument('--server', type=str, default=None,
+                            help='serve 服务地址，如 http://localhost:8000/v1；指定后作为客户端提交请求')
+    run_parser.add_argument('--concurrency', type=int, default=32, help='客户端并发请求数 (默认: 32)')
+    run_parser.add_argument('--request-timeout', type=float, default=600, help='客户端单个请求超时 (秒)')
+    run_parser.add_argument('--served-model-name', default='hw3_2', help='服务端模型名称')
+    run_parser.add_argument('--prompt-store', type=str, default=None, help='指定预分词prompt存储目录')
+    run_parser.add_argument('--no-prompt-store', action='store_true', help='不查找预分词prompt存储，现场分词')
+    run_parser.add_argument('--store-root', default=PROMPT_STORE_ROOT, help=f'prompt存储根目录 (默认: {PROMPT_STORE_ROOT})')
+    run_parser.add_argument('--repair-rounds', type=int, default=0, help='失败输出的修复轮数上限 (默认: 0，不修复)')
+    run_parser.add_argument('--target-pass-rate', type=float, default=1.0, help='达到该通过率后停止修复 (默认: 1.0)')
+    run_parser.add_argument('--repair-temperature', type=float, default=0.3, help='修复轮次的 temperature (默认: 0.3)')
+    run_parser.add_argument('--repair-n', type=int, default=4, help='修复轮次每个prompt的候选数 (默认: 4)')
+    run_parser.add_argument('--num-gpus', type=int, default=1, help='参与推理的GPU数，用于折算GPU小时 (默认: 1)')
+    run_parser.add_argument('--metrics-file', default='outputs/metrics/hw3_2_metrics.jsonl',
+                            help='单请求指标 JSONL 文件 (默认: outputs/metrics/hw3_2_metrics.jsonl)')
+    run_parser.add_argument('--profile', choices=['none', 'torch', 'py-spy'], default='none',
+                            help='对生成调用进行性能剖析 (默认: none)')
+    run_parser.add_argument('--validate-tokens', choices=list(VALIDATE_ACTIONS), default='none',
+                            help='生成过程中按 token ID 校验输出格式: flag 只记录, abort 违规即中止, '
+                                 'steer 可纠正处约束下一个 token (默认: none)')
+    run_parser.add_argument('--think-budget', type=int, default=0,
+                            help='思考部分 token 上限，>0 时两阶段生成：超出即强制 </think>，再从标记开始续写 (默认: 0，不限制)')
+    run_parser.add_argument('--baseline-metrics', type=str, default=None,
+                            help='不限思考预算时的指标 JSONL，用于计算节省的时间')
+    run_parser.add_argument('--adapter', type=str, default=None,
+                            help='使用 --lora 加载的哪个适配器生成 (默认: 基座模型)')
+    add_engine_arguments(run_parser)
+    add_sampling_arguments(run_parser)
+    add_edit_format_argument(run_parser)
+
+    prepare_parser = subparsers.add_parser('prepare', help='预先渲染并分词查询文件，写入内存映射的prompt存储')
+    prepare_parser.add_argument('--queries', default=QUERY_FILE, help=f'查询文件 (默认: {QUERY_FILE})')
+    prepare_parser.add_argument('--store-root', default=PROMPT_STORE_ROOT, help=f'prompt存储根目录 (默认: {PROMPT_STORE_ROOT})')
+    prepare_parser.add_argument('--batch-size', type=int, default=1024, help='每批分词的prompt数 (默认: 1024)')
+    add_edit_format_argument(prepare_parser)
+
+    serve_parser = subparsers.add_parser('serve', help='启动常驻的 OpenAI 兼容推理服务')
+    serve_parser.add_argument('--host', default='0.0.0.0')
+    serve_parser.add_argument('--port', type=int, default=8000)
+    serve_parser.add_argument('--served-model-name', default='hw3_2', help='对外暴露的模型名称')
+    serve_parser.add_argument('--max-pending', type=int, default=1024, help='后端并发请求数和等待队列的上限，队列满时返回 503')
+    add_engine_arguments(serve_parser)
+    add_edit_format_argument(serve_parser)
+
+    # 不带子命令时保持原有行为：批量处理 query_only.json
+    args = parser.parse_args()
+    if args.command is None:
+        args = parser.parse_args(['run'])
+
+    if args.command == 'serve':
+        from inference_server import serve
+        serve(args)
+    elif args.command == 'prepare':
+        run_prepare(args)
+    elif args.server:
+        run_client(args)
+    else:
+        run_offline(args)
+
+if __name__ == '__main__':
+    main()
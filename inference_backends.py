@@ -0,0 +1,975 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+inference_backends.py - hw3_2 推理后端
+
+提供接口一致的推理后端：
+1. vllm: GPU 离线批量推理 (vllm.LLM)
+2. vllm-async: GPU 服务模式 (AsyncLLMEngine，引擎内部做连续批处理)
+3. transformers: CPU/单卡推理，内置 token 级连续批处理调度器，便于本地测试
+4. cpu-quant: 无 GPU 机器上的 int8 量化 CPU 推理，静态批次 + 静态 KV cache（见 cpu_quant.py）
+
+speculative='prompt-lookup' 时启用 n-gram 投机解码（见 prompt_lookup.py）。
+采样参数中 validate='flag'/'abort'/'steer' 时在生成过程中按 token ID 校验输出格式（见 token_validator.py），
+结果的每个 output 附带 "violation"；vLLM 的 abort/steer 依赖逐请求 logits processor（V0 引擎），V1 引擎上降级为 flag。
+
+所有后端都接收 prompt token ID 序列，返回与 vLLM RequestOutput 对齐的字典：
+    {"prompt_tokens": int, "outputs": [{"text": str, "token_ids": [...], "finish_reason": str}],
+     "metrics": {"arrival_time": float, "first_token_time": float, "finished_time": float}}
+
+采样参数统一用字典描述：temperature / top_p / max_tokens / n / stop_token_ids
+
+lora_adapters={名称: 路径} 时在同一个常驻基座模型上加载多个 LoRA 适配器，采样参数中的 "adapter"
+（或 generate / generate_iter 的逐 prompt 参数 adapters）为每个请求选择适配器，None 表示基座模型：
+vLLM 使用 LoRARequest，transformers 后端使用 peft 的混合适配器批处理（同一批次内各行使用不同适配器）。
+"""
+
+import asyncio
+import contextlib
+import inspect
+import itertools
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, as_completed
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from prompt_lookup import (
+    DEFAULT_MAX_NGRAM, DEFAULT_NUM_DRAFT_TOKENS, prompt_lookup_generate, vllm_prompt_lookup_kwargs,
+)
+from token_validator import TokenFormatSpec, TokenFormatValidator, validate_token_ids
+
+# 默认采样参数，与 hw3_2.py 原有的 vllm.SamplingParams 保持一致
+DEFAULT_SAMPLING = {
+    "temperature": 0.7,
+    "top_p": 0.8,
+    "max_tokens": 2048,
+    "n": 1,
+}
+
+
+def _as_int_list(token_ids: Sequence[int]) -> List[int]:
+    """将 token ID 序列（list / numpy 视图）转换为 Python int 列表"""
+    if hasattr(token_ids, 'tolist'):
+        return token_ids.tolist()
+    return list(token_ids)
+
+
+def _merge_sampling(sampling: Optional[Dict]) -> Dict:
+    """在默认采样参数上覆盖调用方给出的参数"""
+    merged = dict(DEFAULT_SAMPLING)
+    if sampling:
+        merged.update({k: v for k, v in sampling.items() if v is not None})
+    return merged
+
+
+def parse_lora_adapters(specs: Optional[Sequence[str]]) -> Dict[str, str]:
+    """
+    解析命令行的适配器列表：'名称=路径' 或只给路径（以目录名作为名称）
+
+    Returns:
+        dict: {名称: 路径}，保持给出的顺序
+    """
+    adapters = {}
+    for spec in specs or []:
+        name, sep, path = spec.partition("=")
+        if not sep:
+            path = spec
+            name = os.path.basename(os.path.normpath(spec))
+        if name in adapters:
+            raise ValueError(f"适配器名称重复: {name}")
+        adapters[name] = path
+    return adapters
+
+
+def _with_adapters(sampling: Optional[Dict], adapters: Optional[Sequence[Optional[str]]],
+                   count: int) -> List[Optional[Dict]]:
+    """逐 prompt 的采样参数：adapters 给出时覆盖 sampling 中的 adapter"""
+    if adapters is None:
+        return [sampling] * count
+    if len(adapters) != count:
+        raise ValueError(f"adapters 数量 ({len(adapters)}) 与 prompt 数量 ({count}) 不一致")
+    return [dict(sampling or {}, adapter=adapter) for adapter in adapters]
+
+
+def _validate_action(sampling: Optional[Dict]) -> Optional[str]:
+    """采样参数中的格式校验动作，'none' 视为不校验"""
+    action = (sampling or {}).get("validate")
+    return None if action in (None, "none") else action
+
+
+def supports_steer(engine) -> bool:
+    """后端能否在生成过程中逐 token 中止/约束（validate='abort'/'steer'），不能时只能回放校验 (flag)"""
+    check = getattr(engine, "supports_steer", None)
+    return bool(check()) if check is not None else False
+
+
+# ==================== vLLM 后端 ====================
+
+def _vllm_sampling_params(vllm, sampling: Dict, format_spec: Optional[TokenFormatSpec] = None,
+                          prompt_ids: Optional[Sequence[int]] = None):
+    """
+    把采样参数字典转换为 vllm.SamplingParams
+
+    validate 为 abort/steer 时挂上逐请求的格式校验 logits processor（n > 1 时 vLLM 会逐序列克隆）
+    """
+    sampling = _merge_sampling(sampling)
+    extra = {}
+    action = _validate_action(sampling)
+    if action in ("abort", "steer") and format_spec is not None:
+        extra["logits_processors"] = [TokenFormatValidator(format_spec, action, prompt_ids)]
+    return vllm.SamplingParams(
+        temperature=sampling["temperature"],
+        top_p=sampling["top_p"],
+        max_tokens=sampling["max_tokens"],
+        n=sampling["n"],
+        stop_token_ids=sampling.get("stop_token_ids"),
+        # 特殊词符 <|AGENT|>/<|EDIT|> 是 special token，必须保留在输出文本中
+        skip_special_tokens=False,
+        **extra,
+    )
+
+
+def _convert_vllm_output(request_output, metrics: Optional[Dict] = None,
+                         format_spec: Optional[TokenFormatSpec] = None, action: Optional[str] = None) -> Dict:
+    """把 vLLM RequestOutput 转换为统一的结果字典；需要校验时回放状态机得到违规"""
+    outputs = []
+    for completion in request_output.outputs:
+        output = {
+            "text": completion.text,
+            "token_ids": list(completion.token_ids),
+            "finish_reason": completion.finish_reason or "stop",
+        }
+        if action and format_spec is not None:
+            output["violation"] = validate_token_ids(format_spec, output["token_ids"],
+                                                     request_output.prompt_token_ids)
+            # logits processor 中止时是强制输出 eos 结束的
+            if output["violation"] and action in ("abort", "steer"):
+                output["finish_reason"] = "abort"
+        outputs.append(output)
+    return {
+        "metrics": metrics or {},
+        "prompt_tokens": len(request_output.prompt_token_ids or []),
+        "outputs": outputs,
+    }
+
+
+class _VLLMFormatSpecMixin:
+    """vLLM 后端共用：按需构造格式校验常量，按名称查找 LoRA 请求"""
+
+    _format_spec: Optional[TokenFormatSpec] = None
+    _lora_requests: Dict[str, object] = {}
+    _warned_validate = False
+
+    def _init_lora(self, lora_adapters: Optional[Dict[str, str]], max_lora_rank: int, engine_kwargs: Dict):
+        """开启 vLLM 的多 LoRA 支持，每个适配器分配一个固定的整数 ID"""
+        if not lora_adapters:
+            return
+        from vllm.lora.request import LoRARequest
+
+        engine_kwargs.update({"enable_lora": True, "max_loras": len(lora_adapters), "max_lora_rank": max_lora_rank})
+        self._lora_requests = {
+            name: LoRARequest(name, lora_id, path)
+            for lora_id, (name, path) in enumerate(lora_adapters.items(), start=1)
+        }
+
+    def _lora_request(self, sampling: Optional[Dict]):
+        name = (sampling or {}).get("adapter")
+        if name is None:
+            return None
+        if name not in self._lora_requests:
+            raise ValueError(f"未加载的适配器: {name} (已加载: {', '.join(self._lora_requests) or '无'})")
+        return self._lora_requests[name]
+
+    def format_spec(self) -> TokenFormatSpec:
+        if self._format_spec is None:
+            from tokenizer_registry import get_tokenizer
+
+            self._format_spec = TokenFormatSpec(get_tokenizer(self.tokenizer_path))
+        return self._format_spec
+
+    def _params(self, sampling: Optional[Dict], prompt_ids: Optional[Sequence[int]] = None):
+        spec = self.format_spec() if _validate_action(sampling) else None
+        return _vllm_sampling_params(self.vllm, sampling, spec, prompt_ids)
+
+    def _vllm_engine(self):
+        return self.llm.llm_engine
+
+    def supports_steer(self) -> bool:
+        """逐请求 logits processor 只有 V0 引擎支持，V1 引擎 (vllm.v1) 会忽略或拒绝"""
+        return not type(self._vllm_engine()).__module__.startswith("vllm.v1")
+
+    def _check_validate(self, sampling: Optional[Dict]) -> Optional[Dict]:
+        """引擎不支持逐请求 logits processor 时把 abort/steer 降级为 flag（生成后回放校验）"""
+        action = _validate_action(sampling)
+        if action in ("abort", "steer") and not self.supports_steer():
+            if not self._warned_validate:
+                print(f"⚠️  当前 vLLM 引擎不支持逐请求 logits processor，--validate-tokens {action} 改为 flag 校验")
+                self._warned_validate = True
+            return dict(sampling, validate="flag")
+        return sampling
+
+
+def _release_vllm_memory():
+    """拆除 vLLM 的分布式状态并清空 CUDA 缓存"""
+    import gc
+
+    try:
+        from vllm.distributed.parallel_state import destroy_distributed_environment, destroy_model_parallel
+    except ImportError:
+        destroy_model_parallel = destroy_distributed_environment = None
+    if destroy_model_parallel is not None:
+        destroy_model_parallel()
+        destroy_distributed_environment()
+    gc.collect()
+    import torch
+
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+class VLLMBackend(_VLLMFormatSpecMixin):
+    """vLLM 离线批量推理后端"""
+
+    def __init__(self, model_path: str, tokenizer_path: str,
+                 gpu_memory_utilization: float = 0.8, max_model_len: int = 4096,
+                 speculative: Optional[str] = None, num_draft_tokens: int = DEFAULT_NUM_DRAFT_TOKENS,
+                 prompt_lookup_max: int = DEFAULT_MAX_NGRAM, lora_adapters: Optional[Dict[str, str]] = None,
+                 max_lora_rank: int = 16, **engine_kwargs):
+        import vllm
+
+        self.vllm = vllm
+        self.tokenizer_path = tokenizer_path
+        if speculative == "prompt-lookup":
+            engine_kwargs.update(vllm_prompt_lookup_kwargs(num_draft_tokens, prompt_lookup_max))
+        self._init_lora(lora_adapters, max_lora_rank, engine_kwargs)
+        self.llm = vllm.LLM(
+            model=model_path,
+            tokenizer=tokenizer_path,
+            gpu_memory_utilization=gpu_memory_utilization,
+            trust_remote_code=True,
+            enforce_eager=True,
+            max_model_len=max_model_len,
+            **engine_kwargs,
+        )
+        self._request_counter = itertools.count()
+
+    def generate(self, prompts: List[Sequence[int]], sampling: Optional[Dict] = None,
+                 adapters: Optional[Sequence[Optional[str]]] = None) -> List[Dict]:
+        """批量生成，返回与 prompts 一一对应的结果"""
+        inputs = [{"prompt_token_ids": _as_int_list(ids)} for ids in prompts]
+        sampling = self._check_validate(sampling)
+        action = _validate_action(sampling)
+        if action:
+            # 每个请求一份有状态的校验器
+            params = [self._params(sampling, item["prompt_token_ids"]) for item in inputs]
+        else:
+            params = self._params(sampling)
+        lora_requests = [self._lora_request(s) for s in _with_adapters(sampling, adapters, len(inputs))]
+        outputs = self.llm.generate(inputs, params, lora_request=lora_requests if any(lora_requests) else None)
+        spec = self.format_spec() if action else None
+        return [_convert_vllm_output(output, None, spec, action) for output in outputs]
+
+    def generate_iter(self, prompts: List[Sequence[int]], sampling: Optional[Dict] = None,
+                      adapters: Optional[Sequence[Optional[str]]] = None) -> Iterator[Tuple[int, Dict]]:
+        """逐步驱动引擎，每个请求一结束就产出 (prompt 下标, 结果)，调用方可以边生成边校验"""
+        engine = self.llm.llm_engine
+        sampling = self._check_validate(sampling)
+        action = _validate_action(sampling)
+        spec = self.format_spec() if action else None
+        shared_params = None if action else self._params(sampling)
+        per_prompt = _with_adapters(sampling, adapters, len(prompts))
+        request_index = {}
+        request_metrics = {}
+        for index, ids in enumerate(prompts):
+            request_id = f"hw3_2-{next(self._request_counter)}"
+            ids = _as_int_list(ids)
+            params = shared_params or self._params(sampling, ids)
+            engine.add_request(request_id, {"prompt_token_ids": ids}, params,
+                               lora_request=self._lora_request(per_prompt[index]))
+            request_index[request_id] = index
+            request_metrics[request_id] = {"arrival_time": time.time(), "first_token_time": None}
+
+        while engine.has_unfinished_requests():
+            for output in engine.step():
+                metrics = request_metrics[output.request_id]
+                now = time.time()
+                if metrics["first_token_time"] is None and any(c.token_ids for c in output.outputs):
+                    metrics["first_token_time"] = now
+                if output.finished:
+                    metrics["finished_time"] = now
+                    yield request_index[output.request_id], _convert_vllm_output(output, metrics, spec, action)
+
+    def close(self):
+        """释放引擎占用的显存，同一进程中可以再创建新的 vLLM 引擎（如 prompt_lookup bench）"""
+        if getattr(self, "llm", None) is None:
+            return
+        engine_core = getattr(self.llm.llm_engine, "engine_core", None)
+        if engine_core is not None and hasattr(engine_core, "shutdown"):
+            # V1 引擎的 EngineCore 运行在子进程中
+            engine_core.shutdown()
+        del self.llm
+        self.llm = None
+        _release_vllm_memory()
+
+
+class VLLMAsyncBackend(_VLLMFormatSpecMixin):
+    """vLLM 服务模式后端：AsyncLLMEngine 常驻，请求随到随进批次（连续批处理）"""
+
+    def __init__(self, model_path: str, tokenizer_path: str,
+                 gpu_memory_utilization: float = 0.8, max_model_len: int = 4096,
+                 speculative: Optional[str] = None, num_draft_tokens: int = DEFAULT_NUM_DRAFT_TOKENS,
+                 prompt_lookup_max: int = DEFAULT_MAX_NGRAM, lora_adapters: Optional[Dict[str, str]] = None,
+                 max_lora_rank: int = 16, **engine_kwargs):
+        import vllm
+        from vllm.engine.arg_utils import AsyncEngineArgs
+        from vllm.engine.async_llm_engine import AsyncLLMEngine
+
+        self.vllm = vllm
+        self.tokenizer_path = tokenizer_path
+        if speculative == "prompt-lookup":
+            engine_kwargs.update(vllm_prompt_lookup_kwargs(num_draft_tokens, prompt_lookup_max))
+        self._init_lora(lora_adapters, max_lora_rank, engine_kwargs)
+        engine_args = AsyncEngineArgs(
+            model=model_path,
+            tokenizer=tokenizer_path,
+            gpu_memory_utilization=gpu_memory_utilization,
+            trust_remote_code=True,
+            enforce_eager=True,
+            max_model_len=max_model_len,
+            **engine_kwargs,
+        )
+        self.engine = AsyncLLMEngine.from_engine_args(engine_args)
+
+    def _vllm_engine(self):
+        return self.engine
+
+    async def generate_async(self, prompt_ids: Sequence[int], sampling: Optional[Dict],
+                             request_id: str) -> Dict:
+        """提交单个请求并等待其完成"""
+        metrics = {"arrival_time": time.time(), "first_token_time": None}
+        final_output = None
+        prompt_ids = _as_int_list(prompt_ids)
+        sampling = self._check_validate(sampling)
+        action = _validate_action(sampling)
+        async for output in self.engine.generate(
+            {"prompt_token_ids": prompt_ids},
+            self._params(sampling, prompt_ids),
+            request_id,
+            lora_request=self._lora_request(sampling),
+        ):
+            if metrics["first_token_time"] is None and any(c.token_ids for c in output.outputs):
+                metrics["first_token_time"] = time.time()
+            final_output = output
+        metrics["finished_time"] = time.time()
+        return _convert_vllm_output(final_output, metrics, self.format_spec() if action else None, action)
+
+    def close(self):
+        pass
+
+
+# ==================== transformers 后端 ====================
+
+class _RequestGroup:
+    """一个请求的 n 个采样序列，全部结束后一次性完成 Future"""
+
+    def __init__(self, prompt_ids: List[int], sampling: Dict, future: Future):
+        self.prompt_ids = prompt_ids
+        self.sampling = sampling
+        self.future = future
+        self.outputs: List[Optional[Dict]] = [None] * sampling["n"]
+        self.remaining = sampling["n"]
+        self.metrics = {"arrival_time": time.time(), "first_token_time": None}
+
+    def complete(self, index: int, output: Dict):
+        self.outputs[index] = output
+        self.remaining -= 1
+        if self.remaining == 0 and not self.future.done():
+            self.metrics["finished_time"] = time.time()
+            self.future.set_result({
+                "prompt_tokens": len(self.prompt_ids),
+                "outputs": self.outputs,
+                "metrics": self.metrics,
+            })
+
+    def fail(self, error: Exception):
+        if not self.future.done():
+            self.future.set_exception(error)
+
+
+class _Sequence:
+    """调度器中的单条生成序列"""
+
+    def __init__(self, group: _RequestGroup, index: int, validator: Optional[TokenFormatValidator] = None):
+        self.group = group
+        self.index = index
+        self.output_ids: List[int] = []
+        self.finish_reason: Optional[str] = None
+        self.validator = validator
+
+    @property
+    def sampling(self) -> Dict:
+        return self.group.sampling
+
+    @property
+    def all_ids(self) -> List[int]:
+        return self.group.prompt_ids + self.output_ids
+
+
+class ContinuousBatcher:
+    """
+    基于 transformers 的 token 级连续批处理调度器
+
+    每个解码步对所有活跃序列做一次前向：
+    - 新请求在下一步加入批次，此时对整批做一次左填充的重新预填充 (prefill)
+    - 完成的序列立即离开批次，并从 KV cache 中剔除，不必等待整批结束
+    - 开启格式校验的序列每步更新状态机，违规即中止（立即让出批次位置），引导时在采样前屏蔽 logits
+    - 模型是带多个 LoRA 适配器的 PeftModel 时，每步前向传入逐行的 adapter_names，不同适配器的请求共享批次
+    """
+
+    def __init__(self, model, tokenizer, eos_token_ids: Sequence[int],
+                 max_batch_size: int = 8, seed: Optional[int] = None,
+                 format_spec: Optional[TokenFormatSpec] = None, adapter_names: Sequence[str] = ()):
+        import torch
+
+        self.torch = torch
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = next(model.parameters()).device
+        self.eos_token_ids = set(eos_token_ids)
+        self.max_batch_size = max_batch_size
+        self.format_spec = format_spec
+        self.adapter_names = set(adapter_names)
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+        self.generator = torch.Generator(device=self.device)
+        if seed is not None:
+            self.generator.manual_seed(seed)
+
+        # 预填充时只计算最后一个位置的 logits，避免 (B, L, V) 的大张量
+        # （PeftModel.forward 只有 **kwargs，按底层模型的签名判断）
+        base_model = model.get_base_model() if hasattr(model, "get_base_model") else model
+        forward_params = inspect.signature(base_model.forward).parameters
+        self._logits_kwargs = {}
+        for name in ("logits_to_keep", "num_logits_to_keep"):
+            if name in forward_params:
+                self._logits_kwargs = {name: 1}
+                break
+
+        self._queue: "queue.Queue[_Sequence]" = queue.Queue()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="continuous-batcher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, prompt_ids: Sequence[int], sampling: Optional[Dict] = None) -> Future:
+        """提交一个请求，返回在所有 n 个序列结束后完成的 Future"""
+        adapter = (sampling or {}).get("adapter")
+        if adapter is not None and adapter not in self.adapter_names:
+            raise ValueError(f"未加载的适配器: {adapter} (已加载: {', '.join(sorted(self.adapter_names)) or '无'})")
+        self.start()
+        future: Future = Future()
+        group = _RequestGroup(_as_int_list(prompt_ids), _merge_sampling(sampling), future)
+        action = _validate_action(group.sampling) if self.format_spec is not None else None
+        for index in range(group.sampling["n"]):
+            validator = TokenFormatValidator(self.format_spec, action, group.prompt_ids) if action else None
+            self._queue.put(_Sequence(group, index, validator))
+        return future
+
+    # ---------- 调度循环 ----------
+
+    def _admit(self, active: List[_Sequence]) -> bool:
+        """从队列中接纳新序列，返回是否有新序列加入"""
+        admitted = False
+        if not active:
+            try:
+                active.append(self._queue.get(timeout=0.1))
+                admitted = True
+            except queue.Empty:
+                return False
+        while len(active) < self.max_batch_size:
+            try:
+                active.append(self._queue.get_nowait())
+                admitted = True
+            except queue.Empty:
+                break
+        return admitted
+
+    def _loop(self):
+        torch = self.torch
+        active: List[_Sequence] = []
+        cache = None
+        attention_mask = None
+
+        while not self._stopped.is_set():
+            needs_prefill = self._admit(active)
+            if not active:
+                continue
+
+            try:
+                with torch.no_grad():
+                    if needs_prefill:
+                        logits, cache, attention_mask = self._prefill(active)
+                    else:
+                        logits, cache, attention_mask = self._decode(active, cache, attention_mask)
+                next_tokens = self._sample(logits, active)
+            except Exception as e:
+                for seq in active:
+                    seq.group.fail(e)
+                active, cache, attention_mask = [], None, None
+                continue
+
+            keep = []
+            now = time.time()
+            for i, (seq, token_id) in enumerate(zip(active, next_tokens)):
+                seq.output_ids.append(token_id)
+                if seq.group.metrics["first_token_time"] is None:
+                    seq.group.metrics["first_token_time"] = now
+                if seq.validator is not None:
+                    seq.validator.step(token_id)
+                seq.finish_reason = self._finish_reason(seq, token_id)
+                if seq.finish_reason:
+                    seq.group.complete(seq.index, self._build_output(seq))
+                else:
+                    keep.append(i)
+
+            if len(keep) < len(active):
+                active = [active[i] for i in keep]
+                if active:
+                    keep_index = torch.tensor(keep, device=self.device)
+                    cache = _select_cache(cache, keep_index)
+                    attention_mask = attention_mask[keep_index]
+                else:
+                    cache, attention_mask = None, None
+
+    def _prefill(self, active: List[_Sequence]):
+        """对整批序列（prompt + 已生成部分）做左填充预填充"""
+        torch = self.torch
+        sequences = [seq.all_ids for seq in active]
+        max_len = max(len(ids) for ids in sequences)
+        input_ids = torch.full((len(sequences), max_len), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(sequences), max_len), dtype=torch.long)
+        for row, ids in enumerate(sequences):
+            input_ids[row, max_len - len(ids):] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, max_len - len(ids):] = 1
+        input_ids = input_ids.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+
+        out = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            use_cache=True,
+            **self._logits_kwargs,
+            **self._adapter_kwargs(active),
+        )
+        return out.logits[:, -1, :], out.past_key_values, attention_mask
+
+    def _decode(self, active: List[_Sequence], cache, attention_mask):
+        """增量解码一步：每条序列只输入上一步采样出的 token"""
+        torch = self.torch
+        input_ids = torch.tensor([[seq.output_ids[-1]] for seq in active],
+                                 dtype=torch.long, device=self.device)
+        ones = torch.ones((len(active), 1), dtype=attention_mask.dtype, device=self.device)
+        attention_mask = torch.cat([attention_mask, ones], dim=-1)
+        position_ids = attention_mask.sum(-1, keepdim=True) - 1
+
+        out = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=cache,
+            use_cache=True,
+            **self._adapter_kwargs(active),
+        )
+        return out.logits[:, -1, :], out.past_key_values, attention_mask
+
+    def _adapter_kwargs(self, active: List[_Sequence]) -> Dict:
+        """peft 混合适配器批处理：逐行的适配器名称，"__base__" 表示不使用适配器"""
+        if not self.adapter_names:
+            return {}
+        return {"adapter_names": [seq.sampling.get("adapter") or "__base__" for seq in active]}
+
+    def _sample(self, logits, active: List[_Sequence]) -> List[int]:
+        """按每条序列各自的 temperature / top_p 采样下一个 token"""
+        torch = self.torch
+        logits = logits.float()
+        if self.format_spec is not None:
+            logits = self._apply_constraints(logits, active)
+        temperatures = torch.tensor([seq.sampling["temperature"] for seq in active],
+                                    device=logits.device).unsqueeze(1)
+        top_ps = torch.tensor([seq.sampling["top_p"] for seq in active],
+                              device=logits.device).unsqueeze(1)
+
+        greedy_tokens = logits.argmax(-1)
+        probs = torch.softmax(logits / temperatures.clamp(min=1e-5), dim=-1)
+        sorted_probs, sorted_index = probs.sort(dim=-1, descending=True)
+        cumulative = sorted_probs.cumsum(dim=-1)
+        sorted_probs[(cumulative - sorted_probs) > top_ps] = 0.0
+        choice = torch.multinomial(sorted_probs, 1, generator=self.generator)
+        sampled_tokens = sorted_index.gather(-1, choice).squeeze(-1)
+
+        greedy = temperatures.squeeze(1) <= 0
+        return torch.where(greedy, greedy_tokens, sampled_tokens).tolist()
+
+    def _apply_constraints(self, logits, active: List[_Sequence]):
+        """steer 模式下只保留状态机允许的 token"""
+        for row, seq in enumerate(active):
+            allowed = seq.validator.allowed_token_ids() if seq.validator is not None else None
+            if allowed is not None:
+                keep = logits[row, allowed].clone()
+                logits[row] = float("-inf")
+                logits[row, allowed] = keep
+        return logits
+
+    def _finish_reason(self, seq: _Sequence, token_id: int) -> Optional[str]:
+        if seq.validator is not None and seq.validator.should_abort:
+            return "abort"
+        stop_ids = self.eos_token_ids | set(seq.sampling.get("stop_token_ids") or [])
+        if token_id in stop_ids:
+            return "stop"
+        if len(seq.output_ids) >= seq.sampling["max_tokens"]:
+            return "length"
+        return None
+
+    def _build_output(self, seq: _Sequence) -> Dict:
+        text_ids = seq.output_ids
+        if seq.finish_reason == "stop" and text_ids and text_ids[-1] in self.eos_token_ids:
+            text_ids = text_ids[:-1]
+        output = {
+            "text": self.tokenizer.decode(text_ids, skip_special_tokens=False),
+            "token_ids": list(seq.output_ids),
+            "finish_reason": seq.finish_reason,
+        }
+        if seq.validator is not None:
+            seq.validator.finish()
+            output["violation"] = seq.validator.violation
+        return output
+
+
+def _model_eos_token_ids(model, tokenizer) -> List[int]:
+    """generation_config 和分词器中的所有结束 token"""
+    eos_ids = set()
+    config_eos = model.generation_config.eos_token_id
+    if isinstance(config_eos, int):
+        eos_ids.add(config_eos)
+    elif config_eos:
+        eos_ids.update(config_eos)
+    if tokenizer.eos_token_id is not None:
+        eos_ids.add(tokenizer.eos_token_id)
+    return sorted(eos_ids)
+
+
+def _select_cache(cache, keep_index):
+    """只保留 keep_index 指定的批次行"""
+    if hasattr(cache, "batch_select_indices"):
+        cache.batch_select_indices(keep_index)
+        return cache
+    return tuple(tuple(tensor[keep_index] for tensor in layer) for layer in cache)
+
+
+class TransformersBackend:
+    """transformers 推理后端（默认 CPU），通过 ContinuousBatcher 调度"""
+
+    def __init__(self, model_path: str, tokenizer_path: str, device: str = "cpu",
+                 dtype: str = "float32", max_batch_size: int = 8, seed: Optional[int] = None,
+                 speculative: Optional[str] = None, num_draft_tokens: int = DEFAULT_NUM_DRAFT_TOKENS,
+                 prompt_lookup_max: int = DEFAULT_MAX_NGRAM, lora_adapters: Optional[Dict[str, str]] = None,
+                 max_lora_rank: Optional[int] = None):
+        import torch
+        from transformers import AutoModelForCausalLM
+
+        from tokenizer_registry import get_tokenizer
+
+        self.torch = torch
+        self.speculative = speculative
+        self.num_draft_tokens = num_draft_tokens
+        self.prompt_lookup_max = prompt_lookup_max
+        # 投机解码逐条执行，模型不能被多个线程同时调用
+        self._speculative_lock = threading.Lock()
+        self.tokenizer = get_tokenizer(tokenizer_path)
+        self.model = AutoModelForCausalLM.from_pretrained(
+            model_path,
+            torch_dtype=getattr(torch, dtype),
+            trust_remote_code=True,
+        ).to(device)
+        self.model.eval()
+
+        # 小模型词表可能放不下 <|AGENT|>/<|EDIT|>，需要扩展 embedding
+        if self.model.get_input_embeddings().num_embeddings < len(self.tokenizer):
+            self.model.resize_token_embeddings(len(self.tokenizer))
+
+        # 多个 LoRA 适配器挂在同一个基座上（max_lora_rank 只对 vLLM 有意义）
+        self.adapter_names = list(lora_adapters or {})
+        if lora_adapters:
+            from peft import PeftModel
+
+            for name, path in lora_adapters.items():
+                if isinstance(self.model, PeftModel):
+                    self.model.load_adapter(path, adapter_name=name)
+                else:
+                    self.model = PeftModel.from_pretrained(self.model, path, adapter_name=name)
+            self.model.eval()
+
+        self.batcher = ContinuousBatcher(
+            self.model,
+            self.tokenizer,
+            eos_token_ids=self._eos_token_ids(),
+            max_batch_size=max_batch_size,
+            seed=seed,
+            format_spec=TokenFormatSpec(self.tokenizer, self._eos_token_ids()),
+            adapter_names=self.adapter_names,
+        )
+
+    def _eos_token_ids(self) -> List[int]:
+        return _model_eos_token_ids(self.model, self.tokenizer)
+
+    def generate(self, prompts: List[Sequence[int]], sampling: Optional[Dict] = None,
+                 adapters: Optional[Sequence[Optional[str]]] = None) -> List[Dict]:
+        """批量生成：全部提交给调度器，按提交顺序返回结果"""
+        per_prompt = _with_adapters(sampling, adapters, len(prompts))
+        if self.speculative:
+            return [self._generate_prompt_lookup(ids, s) for ids, s in zip(prompts, per_prompt)]
+        futures = [self.batcher.submit(ids, s) for ids, s in zip(prompts, per_prompt)]
+        return [future.result() for future in futures]
+
+    def generate_iter(self, prompts: List[Sequence[int]], sampling: Optional[Dict] = None,
+                      adapters: Optional[Sequence[Optional[str]]] = None) -> Iterator[Tuple[int, Dict]]:
+        """按完成顺序产出 (prompt 下标, 结果)"""
+        per_prompt = _with_adapters(sampling, adapters, len(prompts))
+        if self.speculative:
+            for index, ids in enumerate(prompts):
+                yield index, self._generate_prompt_lookup(ids, per_prompt[index])
+            return
+        futures = {self.batcher.submit(ids, per_prompt[index]): index for index, ids in enumerate(prompts)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+    async def generate_async(self, prompt_ids: Sequence[int], sampling: Optional[Dict],
+                             request_id: str) -> Dict:
+        if self.speculative:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self._generate_prompt_lookup, prompt_ids, sampling)
+        return await asyncio.wrap_future(self.batcher.submit(prompt_ids, sampling))
+
+    def _generate_prompt_lookup(self, prompt_ids: Sequence[int], sampling: Optional[Dict]) -> Dict:
+        """prompt-lookup 投机解码（batch=1），结果附带草稿接受统计"""
+        sampling = _merge_sampling(sampling)
+        prompt_ids = _as_int_list(prompt_ids)
+        eos_ids = self.batcher.eos_token_ids
+        metrics = {"arrival_time": time.time(), "first_token_time": None}
+        outputs = []
+        speculative = {"output_tokens": 0, "proposed": 0, "accepted": 0, "forward_passes": 0}
+
+        with self._speculative_lock, self._use_adapter(sampling.get("adapter")):
+            for _ in range(sampling["n"]):
+                result = prompt_lookup_generate(
+                    self.model, prompt_ids, eos_ids,
+                    max_tokens=sampling["max_tokens"],
+                    temperature=sampling["temperature"],
+                    top_p=sampling["top_p"],
+                    num_draft=self.num_draft_tokens,
+                    max_ngram=self.prompt_lookup_max,
+                    stop_token_ids=sampling.get("stop_token_ids"),
+                    generator=self.batcher.generator,
+                )
+                if metrics["first_token_time"] is None:
+                    metrics["first_token_time"] = result["first_token_time"]
+                for key in ("proposed", "accepted", "forward_passes"):
+                    speculative[key] += result[key]
+                speculative["output_tokens"] += len(result["token_ids"])
+
+                text_ids = result["token_ids"]
+                if result["finish_reason"] == "stop" and text_ids and text_ids[-1] in eos_ids:
+                    text_ids = text_ids[:-1]
+                outputs.append({
+                    "text": self.tokenizer.decode(text_ids, skip_special_tokens=False),
+                    "token_ids": result["token_ids"],
+                    "finish_reason": result["finish_reason"],
+                })
+
+        metrics["finished_time"] = time.time()
+        return {
+            "prompt_tokens": len(prompt_ids),
+            "outputs": outputs,
+            "metrics": metrics,
+            "speculative": speculative,
+        }
+
+    def _use_adapter(self, name: Optional[str]):
+        """投机解码逐条调用模型，不能传逐行适配器，改为切换当前适配器"""
+        if not self.adapter_names:
+            if name is not None:
+                raise ValueError(f"未加载的适配器: {name} (已加载: 无)")
+            return contextlib.nullcontext()
+        if name is None:
+            return self.model.disable_adapter()
+        if name not in self.adapter_names:
+            raise ValueError(f"未加载的适配器: {name} (已加载: {', '.join(self.adapter_names)})")
+        self.model.set_adapter(name)
+        return contextlib.nullcontext()
+
+    def supports_steer(self) -> bool:
+        return True
+
+    def close(self):
+        self.batcher.stop()
+
+
+class CPUQuantizedBackend:
+    """
+    量化 CPU 推理后端（见 cpu_quant.py）
+
+    Linear 层 int8 量化，线程数为物理核数；按 max_batch_size 把请求分成静态批次，
+    每批左填充后用 generate(cache_implementation="static") 生成，KV cache 一次性预分配。
+    格式校验只在生成结束后回放（flag），不做逐 token 的中止和引导。
+    """
+
+    def __init__(self, model_path: str, tokenizer_path: str, quantization: str = "dynamic",
+                 num_threads: Optional[int] = None, max_batch_size: int = 8, seed: Optional[int] = None,
+                 **unused_kwargs):
+        import torch
+        from transformers import AutoModelForCausalLM
+
+        from cpu_quant import configure_threads, quantize_model
+        from tokenizer_registry import get_tokenizer
+
+        if unused_kwargs.get("lora_adapters"):
+            raise ValueError("cpu-quant 后端不支持 LoRA 适配器，请先用 lora_export.py 合并后再量化")
+        if unused_kwargs.get("speculative"):
+            raise ValueError("cpu-quant 后端不支持投机解码")
+
+        self.torch = torch
+        self.num_threads = configure_threads(num_threads)
+        self.max_batch_size = max_batch_size
+        self.quantization = quantization
+        self.tokenizer = get_tokenizer(tokenizer_path)
+        model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=torch.float32, trust_remote_code=True)
+        if model.get_input_embeddings().num_embeddings < len(self.tokenizer):
+            model.resize_token_embeddings(len(self.tokenizer))
+        model.eval()
+        self.model = quantize_model(model, quantization)
+        self.pad_token_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else 0
+        self.eos_token_ids = _model_eos_token_ids(self.model, self.tokenizer)
+        self.format_spec = TokenFormatSpec(self.tokenizer, self.eos_token_ids)
+        if seed is not None:
+            torch.manual_seed(seed)
+        # generate 不是线程安全的（服务模式下多个请求并发）
+        self._lock = threading.Lock()
+
+    def _generate_batch(self, prompts: List[List[int]], sampling: Dict) -> List[Dict]:
+        torch = self.torch
+        arrival = time.time()
+        max_len = max(len(ids) for ids in prompts)
+        input_ids = torch.full((len(prompts), max_len), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(prompts), max_len), dtype=torch.long)
+        for row, ids in enumerate(prompts):
+            input_ids[row, max_len - len(ids):] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, max_len - len(ids):] = 1
+
+        do_sample = sampling["temperature"] > 0
+        sample_kwargs = {"temperature": sampling["temperature"], "top_p": sampling["top_p"]} if do_sample else {}
+        eos_ids = sorted(set(self.eos_token_ids) | set(sampling.get("stop_token_ids") or []))
+        with self._lock, torch.no_grad():
+            sequences = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                max_new_tokens=sampling["max_tokens"],
+                do_sample=do_sample,
+                num_return_sequences=sampling["n"],
+                eos_token_id=eos_ids,
+                pad_token_id=self.pad_token_id,
+                cache_implementation="static",
+                **sample_kwargs,
+            )
+        finished = time.time()
+
+        action = _validate_action(sampling)
+        results = []
+        for row, ids in enumerate(prompts):
+            outputs = []
+            for k in range(sampling["n"]):
+                generated = sequences[row * sampling["n"] + k, max_len:].tolist()
+                finish_reason = "length"
+                for end, token_id in enumerate(generated):
+                    if token_id in eos_ids:
+                        generated, finish_reason = generated[:end + 1], "stop"
+                        break
+                text_ids = generated
+                if finish_reason == "stop" and generated[-1] in self.eos_token_ids:
+                    text_ids = generated[:-1]
+                output = {
+                    "text": self.tokenizer.decode(text_ids, skip_special_tokens=False),
+                    "token_ids": generated,
+                    "finish_reason": finish_reason,
+                }
+                if action:
+                    output["violation"] = validate_token_ids(self.format_spec, generated, ids)
+                outputs.append(output)
+            # 静态批次内无法区分各请求的首 token 时间
+            results.append({"prompt_tokens": len(ids), "outputs": outputs,
+                            "metrics": {"arrival_time": arrival, "first_token_time": None, "finished_time": finished}})
+        return results
+
+    def generate(self, prompts: List[Sequence[int]], sampling: Optional[Dict] = None) -> List[Dict]:
+        results = [None] * len(prompts)
+        for index, result in self.generate_iter(prompts, sampling):
+            results[index] = result
+        return results
+
+    def generate_iter(self, prompts: List[Sequence[int]],
+                      sampling: Optional[Dict] = None) -> Iterator[Tuple[int, Dict]]:
+        """按长度排序后分成静态批次（减少左填充），每批结束后产出"""
+        sampling = _merge_sampling(sampling)
+        prompts = [_as_int_list(ids) for ids in prompts]
+        order = sorted(range(len(prompts)), key=lambda i: len(prompts[i]))
+        for start in range(0, len(order), self.max_batch_size):
+            batch = order[start:start + self.max_batch_size]
+            for index, result in zip(batch, self._generate_batch([prompts[i] for i in batch], sampling)):
+                yield index, result
+
+    async def generate_async(self, prompt_ids: Sequence[int], sampling: Optional[Dict],
+                             request_id: str) -> Dict:
+        loop = asyncio.get_running_loop()
+        results = await loop.run_in_executor(None, self._generate_batch, [_as_int_list(prompt_ids)],
+                                             _merge_sampling(sampling))
+        return results[0]
+
+    def supports_steer(self) -> bool:
+        return False
+
+    def close(self):
+        pass
+
+
+BACKENDS = {
+    "vllm": VLLMBackend,
+    "vllm-async": VLLMAsyncBackend,
+    "transformers": TransformersBackend,
+    "cpu-quant": CPUQuantizedBackend,
+}
+
+
+def create_backend(name: str, model_path: str, tokenizer_path: str, serving: bool = False, **kwargs):
+    """
+    根据名称创建推理后端
+
+    Args:
+        name: 'vllm'、'transformers' 或 'cpu-quant'
+        serving: 服务模式下 vllm 使用 AsyncLLMEngine
+    """
+    if name == "vllm" and serving:
+        name = "vllm-async"
+    if name not in BACKENDS:
+        raise ValueError(f"未知的推理后端: {name} (可选: vllm, transformers, cpu-quant)")
+    return BACKENDS[name](model_path, tokenizer_path, **kwargs)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+inference_metrics.py - hw3_2 单请求推理遥测
+
+每个请求记录一行 JSONL：
+    prompt_tokens / generated_tokens / ttft_s（首 token 延迟）/ e2e_s（端到端延迟）/
+    decode_tokens_per_s（首 token 之后的解码速度）/ finish_reason / mode (AGENT/EDIT/NONE) /
+    violation（开启 token 级格式校验时的违规类型）/ think_tokens（开启思考预算时的思考长度）
+汇总时给出各项的 p50/p90/p99 和总体吞吐，并可选用 torch.profiler 或 py-spy
+对生成调用做性能剖析，便于比较不同后端、批大小和检查点。
+
+使用方法：
+    python hw3_2.py run --metrics-file outputs/metrics/hw3_2_metrics.jsonl --profile torch
+    python inference_metrics.py outputs/metrics/hw3_2_metrics.jsonl      # 重新汇总已有的指标文件
+"""
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from output_checker import check_special_markers, extract_think_content
+
+PERCENTILES = (50, 90, 99)
+
+
+def detect_mode(text: str) -> str:
+    """根据非 think 部分的特殊词符判断输出模式"""
+    _, non_think_content = extract_think_content(text)
+    return check_special_markers(non_think_content)[1]
+
+
+def build_request_record(index: int, result: Dict, round_index: int = 0) -> Dict:
+    """由后端返回的结果构造单请求指标（n > 1 时统计第一个候选，token 数为所有候选之和）"""
+    metrics = result.get("metrics") or {}
+    first_output = result["outputs"][0]
+    generated_tokens = sum(len(output["token_ids"]) for output in result["outputs"])
+
+    arrival = metrics.get("arrival_time")
+    first_token = metrics.get("first_token_time")
+    finished = metrics.get("finished_time")
+
+    ttft = first_token - arrival if arrival is not None and first_token is not None else None
+    e2e = finished - arrival if arrival is not None and finished is not None else None
+    decode_tps = None
+    if first_token is not None and finished is not None and finished > first_token:
+        decode_tps = (len(first_output["token_ids"]) - 1) / (finished - first_token)
+
+    return {
+        "index": index,
+        "round": round_index,
+        "prompt_tokens": result["prompt_tokens"],
+        "generated_tokens": generated_tokens,
+        "ttft_s": ttft,
+        "e2e_s": e2e,
+        "decode_tokens_per_s": decode_tps,
+        "finish_reason": first_output["finish_reason"],
+        "mode": detect_mode(first_output["text"]),
+        "violation": (first_output.get("violation") or {}).get("type"),
+        "think_tokens": first_output.get("think_tokens"),
+        "arrival_time": arrival,
+        "finished_time": finished,
+    }
+
+
+class MetricsWriter:
+    """逐条追加写入指标 JSONL，同时保留在内存中用于汇总"""
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.records: List[Dict] = []
+        self._file = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._file = open(path, "w", encoding="utf-8")
+
+    def write(self, record: Dict):
+        self.records.append(record)
+        if self._file:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+def load_records(path: str) -> List[Dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _percentiles(values: List[Optional[float]]) -> Optional[Dict]:
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    array = np.asarray(values, dtype=np.float64)
+    summary = {f"p{p}": float(np.percentile(array, p)) for p in PERCENTILES}
+    summary["mean"] = float(array.mean())
+    return summary
+
+
+def summarize(records: List[Dict], wall_time: Optional[float] = None) -> Dict:
+    """汇总指标：分位数 + 总体吞吐 + 模式/结束原因分布"""
+    if wall_time is None:
+        # 没有墙钟时间时用最早到达到最晚完成的跨度（适用于重新汇总已有文件）
+        arrivals = [r["arrival_time"] for r in records if r.get("arrival_time") is not None]
+        finishes = [r["finished_time"] for r in records if r.get("finished_time") is not None]
+        wall_time = max(finishes) - min(arrivals) if arrivals and finishes else 0.0
+
+    total_generated = sum(r["generated_tokens"] for r in records)
+    total_prompt = sum(r["prompt_tokens"] for r in records)
+    summary = {
+        "requests": len(records),
+        "wall_time_s": wall_time,
+        "total_prompt_tokens": total_prompt,
+        "total_generated_tokens": total_generated,
+        "generated_tokens_per_s": total_generated / wall_time if wall_time else None,
+        "requests_per_s": len(records) / wall_time if wall_time else None,
+        "ttft_s": _percentiles([r["ttft_s"] for r in records]),
+        "e2e_s": _percentiles([r["e2e_s"] for r in records]),
+        "decode_tokens_per_s": _percentiles([r["decode_tokens_per_s"] for r in records]),
+        "generated_tokens": _percentiles([r["generated_tokens"] for r in records]),
+        "modes": {},
+        "finish_reasons": {},
+        "violations": {},
+    }
+    for r in records:
+        summary["modes"][r["mode"]] = summary["modes"].get(r["mode"], 0) + 1
+        summary["finish_reasons"][r["finish_reason"]] = summary["finish_reasons"].get(r["finish_reason"], 0) + 1
+        if r.get("violation"):
+            summary["violations"][r["violation"]] = summary["violations"].get(r["violation"], 0) + 1
+    return summary
+
+
+def print_summary(summary: Dict):
+    """打印指标汇总"""
+    print("\n📈 推理指标汇总:")
+    print(f"   请求数: {summary['requests']}")
+    print(f"   prompt token: {summary['total_prompt_tokens']}  生成 token: {summary['total_generated_tokens']}")
+    if summary["generated_tokens_per_s"]:
+        print(f"   总体吞吐: {summary['generated_tokens_per_s']:.1f} token/s, {summary['requests_per_s']:.2f} 请求/s")
+    for key, label in (("ttft_s", "首token延迟(s)"), ("e2e_s", "端到端延迟(s)"),
+                       ("decode_tokens_per_s", "解码速度(token/s)"), ("generated_tokens", "生成长度(token)")):
+        stats = summary[key]
+        if stats:
+            values = "  ".join(f"p{p}={stats[f'p{p}']:.3f}" for p in PERCENTILES)
+            print(f"   {label}: {values}  mean={stats['mean']:.3f}")
+    print(f"   模式分布: {summary['modes']}")
+    print(f"   结束原因: {summary['finish_reasons']}")
+    if summary.get("violations"):
+        print(f"   格式违规: {summary['violations']}")
+
+
+@contextmanager
+def profile_generation(kind: Optional[str], output_dir: str = "outputs/profiles"):
+    """
+    可选的性能剖析钩子，包裹生成调用
+
+    Args:
+        kind: None / 'torch'（导出 chrome trace）/ 'py-spy'（生成火焰图 svg）
+    """
+    if not kind or kind == "none":
+        yield
+        return
+
+    os.makedirs(output_dir, exist_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+
+    if kind == "torch":
+        import torch
+        from torch.profiler import ProfilerActivity, profile
+
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        trace_file = os.path.join(output_dir, f"torch_trace_{stamp}.json")
+        with profile(activities=activities, record_shapes=True) as prof:
+            yield
+        prof.export_chrome_trace(trace_file)
+        print(f"🔬 torch profiler trace 已保存到: {trace_file}")
+    elif kind == "py-spy":
+        svg_file = os.path.join(output_dir, f"py_spy_{stamp}.svg")
+        process = subprocess.Popen(
+            ["py-spy", "record", "--pid", str(os.getpid()), "--output", svg_file, "--rate", "100"]
+        )
+        try:
+            yield
+        finally:
+            # SIGINT 让 py-spy 停止采样并写出火焰图
+            process.send_signal(signal.SIGINT)
+            process.wait()
+        print(f"🔬 py-spy 火焰图已保存到: {svg_file}")
+    else:
+        raise ValueError(f"未知的 profile 类型: {kind} (可选: none, torch, py-spy)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='汇总 hw3_2 推理指标 JSONL')
+    parser.add_argument('metrics_file', help='hw3_2.py run 写出的指标文件')
+    parser.add_argument('--wall-time', type=float, default=None, help='推理墙钟时间（秒），用于计算总体吞吐')
+    parser.add_argument('--json', action='store_true', help='以 JSON 输出汇总')
+    args = parser.parse_args()
+
+    summary = summarize(load_records(args.metrics_file), args.wall_time)
+    if args.json:
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+    else:
+        print_summary(summary)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+inference_server.py - hw3_2 常驻推理服务 (OpenAI 兼容接口)
+
+推理引擎和带特殊词符的分词器在进程内常驻，避免每次运行都重新初始化：
+- POST /v1/chat/completions  缺少 system 消息时注入 hw3_2.py 的系统提示词，prompt 与离线 run 一致
+- GET  /v1/models           基座模型 + --lora 加载的适配器；请求的 model 字段选择适配器
+- GET  /health
+
+请求先进入 asyncio 队列，由调度协程取出后提交给后端；连续批处理由后端完成
+（vLLM AsyncLLMEngine / transformers ContinuousBatcher）。后端中同时执行的请求不超过 max_pending，
+之后的请求在队列中等待，队列也满时返回 503。
+
+使用方法：
+    python hw3_2.py serve                                                   # vLLM (GPU)
+    python hw3_2.py serve --backend transformers --model /path/to/tiny-model # CPU 本地测试
+    python hw3_2.py run --server http://localhost:8000/v1                   # 批量文件作为客户端提交
+    python hw3_2.py serve --lora ckpt100=saves/.../checkpoint-100 --lora final=saves/...  # 多 LoRA
+"""
+
+import asyncio
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Sequence
+
+from hw3_2 import SYSTEM_PROMPTS, TOKENIZER_PATH, backend_kwargs, get_tokenizer, render_messages
+from inference_backends import create_backend, parse_lora_adapters
+
+
+def _message_text(content) -> str:
+    """OpenAI 消息内容可能是字符串，也可能是 [{"type": "text", "text": ...}] 列表"""
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content or ""
+
+
+def _error_body(message: str, error_type: str, code: int) -> Dict:
+    return {"error": {"message": message, "type": error_type, "code": code}}
+
+
+class InferenceServer:
+    """持有常驻引擎、分词器和请求队列"""
+
+    def __init__(self, engine, tokenizer, model_name: str, max_pending: int = 1024, edit_format: str = "full",
+                 adapter_names: Sequence[str] = ()):
+        self.engine = engine
+        self.tokenizer = tokenizer
+        self.model_name = model_name
+        # 请求的 model 字段等于适配器名称时使用该适配器，否则使用基座模型
+        self.adapter_names = list(adapter_names)
+        self.max_pending = max_pending
+        self.system_prompt = SYSTEM_PROMPTS[edit_format]
+        self.queue: Optional[asyncio.Queue] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._inflight = set()
+
+    # ---------- 生命周期 ----------
+
+    def start(self):
+        """在服务事件循环中创建队列、并发槽位和调度协程"""
+        self.queue = asyncio.Queue(maxsize=self.max_pending)
+        self._slots = asyncio.Semaphore(self.max_pending)
+        self._dispatcher = asyncio.create_task(self._dispatch_loop())
+
+    async def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+        for task in list(self._inflight):
+            task.cancel()
+        self.engine.close()
+
+    # ---------- 请求调度 ----------
+
+    async def _dispatch_loop(self):
+        """
+        有空闲槽位时才从队列取出请求提交给后端，由后端在下一个解码步并入批次；
+        槽位用完时请求留在队列中，队列满后 chat_completion 得到 QueueFull (503)
+        """
+        while True:
+            await self._slots.acquire()
+            request_id, prompt_ids, sampling, future = await self.queue.get()
+            task = asyncio.create_task(self._run_request(request_id, prompt_ids, sampling, future))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _run_request(self, request_id: str, prompt_ids: List[int], sampling: Dict,
+                           future: asyncio.Future):
+        try:
+            result = await self.engine.generate_async(prompt_ids, sampling, request_id)
+            if not future.done():
+                future.set_result(result)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            self.queue.task_done()
+            self._slots.release()
+
+    # ---------- OpenAI 接口 ----------
+
+    def render_prompt(self, body: Dict) -> List[int]:
+        """渲染对话模板：缺少 system 消息时注入系统提示词；与离线 run 共用 hw3_2.render_messages"""
+        messages = body.get("messages")
+        if not messages:
+            raise ValueError("messages 不能为空")
+
+        messages = [
+            {"role": message["role"], "content": _message_text(message.get("content"))}
+            for message in messages
+        ]
+        if messages[0]["role"] != "system":
+            messages.insert(0, {"role": "system", "content": self.system_prompt})
+
+        text = render_messages(messages, body.get("tools"), self.tokenizer)
+        return self.tokenizer.encode(text, add_special_tokens=False)
+
+    def sampling_from_body(self, body: Dict) -> Dict:
+        return {
+            "temperature": body.get("temperature"),
+            "top_p": body.get("top_p"),
+            "max_tokens": body.get("max_completion_tokens") or body.get("max_tokens"),
+            "n": body.get("n"),
+            "adapter": body.get("model") if body.get("model") in self.adapter_names else None,
+        }
+
+    async def chat_completion(self, body: Dict) -> Dict:
+        request_id = f"chatcmpl-{uuid.uuid4().hex}"
+        prompt_ids = self.render_prompt(body)
+        future = asyncio.get_running_loop().create_future()
+        # 队列已满时抛出 asyncio.QueueFull，由路由层转换为 503
+        self.queue.put_nowait((request_id, prompt_ids, self.sampling_from_body(body), future))
+        result = await future
+
+        completion_tokens = sum(len(output["token_ids"]) for output in result["outputs"])
+        return {
+            "id": request_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model") if body.get("model") in self.adapter_names else self.model_name,
+            "choices": [
+                {
+                    "index": index,
+                    "message": {"role": "assistant", "content": output["text"]},
+                    "finish_reason": output["finish_reason"],
+                }
+                for index, output in enumerate(result["outputs"])
+            ],
+            "usage": {
+                "prompt_tokens": result["prompt_tokens"],
+                "completion_tokens": completion_tokens,
+                "total_tokens": result["prompt_tokens"] + completion_tokens,
+            },
+        }
+
+
+def create_app(server: InferenceServer):
+    """创建 FastAPI 应用"""
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse
+
+    @asynccontextmanager
+    async def lifespan(app):
+        server.start()
+        yield
+        await server.shutdown()
+
+    app = FastAPI(title="hw3_2 inference server", lifespan=lifespan)
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok", "pending": server.queue.qsize() if server.queue else 0}
+
+    @app.get("/v1/models")
+    async def list_models():
+        return {
+            "object": "list",
+            "data": [{"id": name, "object": "model", "owned_by": "local"}
+                     for name in [server.model_name] + server.adapter_names],
+        }
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        if body.get("stream"):
+            return JSONResponse(status_code=400,
+                                content=_error_body("暂不支持 stream=true", "invalid_request_error", 400))
+        try:
+            return await server.chat_completion(body)
+        except asyncio.QueueFull:
+            return JSONResponse(status_code=503,
+                                content=_error_body("请求队列已满，请稍后重试", "server_overloaded", 503))
+        except (ValueError, KeyError) as e:
+            return JSONResponse(status_code=400,
+                                content=_error_body(str(e), "invalid_request_error", 400))
+
+    return app
+
+
+def serve(args):
+    """hw3_2.py serve 入口：初始化引擎后启动 HTTP 服务"""
+    import uvicorn
+
+    print("=== 推理服务初始化 ===")
+    print(f"正在初始化 {args.backend} 引擎 (仅在启动时进行一次)...")
+    tokenizer = get_tokenizer()
+    engine = create_backend(args.backend, args.model, TOKENIZER_PATH, serving=True, **backend_kwargs(args))
+    server = InferenceServer(engine, tokenizer, args.served_model_name, max_pending=args.max_pending,
+                             edit_format=args.edit_format, adapter_names=list(parse_lora_adapters(args.lora)))
+    print(f"推理引擎和分词器初始化完成，服务地址: http://{args.host}:{args.port}/v1")
+
+    uvicorn.run(create_app(server), host=args.host, port=args.port)
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+length_sampler.py - 按 token 预算分组的训练批采样器
+
+固定 per_device_train_batch_size 时长短样本混在一批，短样本被填充到批内最长。
+TokenBudgetBatchSampler 改为按 token 预算组批：
+- 样本长度只计算一次：直接取 token 存储的 offsets 差（sequence_packing.py 的 samples/）
+  或已分词数据集的 input_ids 长度
+- 分桶边界取自实测长度分布的分位数，长度相近的样本落在同一个桶
+- 桶内打乱后依次组批，保证 批内最长 × 条数 <= max_tokens，再打乱批的顺序
+
+使用方法：
+    # 离线比较填充率（可选 --model 实测前向+反向的 token/s）
+    python length_sampler.py outputs/packed/<name>-2048/samples --max-tokens 16384 --batch-size 8
+
+    # 训练：代替 llamafactory-cli train，其余参数原样传给 LLaMA-Factory
+    python length_sampler.py train --max-tokens 16384 --stage sft --dataset ... --cutoff_len 2048 ...
+    TOKEN_BUDGET=16384 ./script/run_train.sh
+    python pipeline.py --token-budget 16384
+
+    # 在其他基于 Trainer 的训练代码中替换 dataloader
+    from length_sampler import install_token_budget_sampler
+    install_token_budget_sampler(trainer, lengths, max_tokens=16384)
+"""
+
+import argparse
+import json
+import sys
+import time
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+from token_store import TokenStore
+
+DEFAULT_MAX_TOKENS = 16384
+DEFAULT_NUM_BUCKETS = 8
+
+
+def dataset_lengths(dataset, column: str = "input_ids") -> np.ndarray:
+    """已分词数据集（HF datasets 或 list[dict]）每条样本的 token 数"""
+    if hasattr(dataset, "column_names"):
+        return np.fromiter((len(ids) for ids in dataset[column]), dtype=np.int64)
+    return np.fromiter((len(item[column]) for item in dataset), dtype=np.int64)
+
+
+def quantile_boundaries(lengths: np.ndarray, num_buckets: int) -> np.ndarray:
+    """按长度分布的分位数确定分桶边界（去重后升序）"""
+    quantiles = np.linspace(0, 1, num_buckets + 1)[1:-1]
+    return np.unique(np.quantile(lengths, quantiles).astype(np.int64))
+
+
+class TokenBudgetBatchSampler:
+    """
+    token 预算批采样器（可作为 DataLoader 的 batch_sampler）
+
+    Args:
+        lengths: 每条样本的 token 数
+        max_tokens: 每批 token 上限（按填充到批内最长计算）
+        num_buckets: 分桶数，边界取长度分布的分位数
+        max_batch_size: 每批样本数上限（可选）
+        shuffle: 每个 epoch 是否打乱桶内样本和批的顺序
+        seed: 随机种子，配合 set_epoch 保证各 epoch 可复现
+    """
+
+    def __init__(self, lengths: Sequence[int], max_tokens: int = DEFAULT_MAX_TOKENS,
+                 num_buckets: int = DEFAULT_NUM_BUCKETS, max_batch_size: Optional[int] = None,
+                 shuffle: bool = True, seed: int = 42):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        if len(self.lengths) and self.lengths.max() > max_tokens:
+            raise ValueError(f"最长样本 {self.lengths.max()} token 超过 max_tokens={max_tokens}")
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+        self.boundaries = quantile_boundaries(self.lengths, num_buckets) if len(self.lengths) else np.zeros(0, np.int64)
+        bucket_ids = np.searchsorted(self.boundaries, self.lengths, side="left")
+        self.buckets = [np.flatnonzero(bucket_ids == b) for b in range(len(self.boundaries) + 1)]
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _batches(self) -> List[List[int]]:
+        rng = np.random.default_rng(self.seed + self.epoch)
+        batches = []
+        for bucket in self.buckets:
+            indices = rng.permutation(bucket) if self.shuffle else bucket
+            batch: List[int] = []
+            batch_max = 0
+            for index in indices:
+                length = int(self.lengths[index])
+                new_max = max(batch_max, length)
+                full = self.max_batch_size is not None and len(batch) >= self.max_batch_size
+                if batch and (new_max * (len(batch) + 1) > self.max_tokens or full):
+                    batches.append(batch)
+                    batch, new_max = [], length
+                batch.append(int(index))
+                batch_max = new_max
+            if batch:
+                batches.append(batch)
+        if self.shuffle:
+            order = rng.permutation(len(batches))
+            batches = [batches[i] for i in order]
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        yield from self._batches()
+
+    def __len__(self) -> int:
+        return len(self._batches())
+
+
+def fixed_batches(num_samples: int, batch_size: int, shuffle: bool = True, seed: int = 42) -> List[List[int]]:
+    """基线：固定样本数组批（与 per_device_train_batch_size 相同）"""
+    indices = np.random.default_rng(seed).permutation(num_samples) if shuffle else np.arange(num_samples)
+    return [indices[i:i + batch_size].tolist() for i in range(0, num_samples, batch_size)]
+
+
+def padding_stats(lengths: np.ndarray, batches: List[List[int]]) -> Dict:
+    """填充到批内最长时的 token 统计"""
+    real = padded = 0
+    for batch in batches:
+        batch_lengths = lengths[batch]
+        real += int(batch_lengths.sum())
+        padded += int(batch_lengths.max()) * len(batch)
+    return {
+        "batches": len(batches),
+        "real_tokens": real,
+        "padded_tokens": padded,
+        "padding_ratio": 1 - real / padded if padded else 0.0,
+        "mean_batch_size": sum(len(b) for b in batches) / len(batches) if batches else 0.0,
+    }
+
+
+def install_token_budget_sampler(trainer, lengths: Sequence[int], max_tokens: int = DEFAULT_MAX_TOKENS,
+                                 num_buckets: int = DEFAULT_NUM_BUCKETS, max_batch_size: Optional[int] = None):
+    """
+    让 transformers.Trainer 使用 token 预算采样器
+
+    替换 trainer.get_train_dataloader；lengths 必须与 trainer.train_dataset 的顺序一一对应。
+    accelerate 的 DataLoader.set_epoch 会转发到 batch_sampler.set_epoch，每个 epoch 重新打乱。
+    """
+    from torch.utils.data import DataLoader
+
+    sampler = TokenBudgetBatchSampler(lengths, max_tokens, num_buckets, max_batch_size, seed=trainer.args.seed)
+
+    def get_train_dataloader():
+        dataset = trainer.train_dataset
+        if hasattr(trainer, "_remove_unused_columns"):
+            dataset = trainer._remove_unused_columns(dataset, description="training")
+        dataloader = DataLoader(
+            dataset,
+            batch_sampler=sampler,
+            collate_fn=trainer.data_collator,
+            num_workers=trainer.args.dataloader_num_workers,
+            pin_memory=trainer.args.dataloader_pin_memory,
+        )
+        return trainer.accelerator.prepare(dataloader)
+
+    trainer.get_train_dataloader = get_train_dataloader
+    return sampler
+
+
+def train(argv: List[str]):
+    """
+    llamafactory-cli train 的替代入口：LLaMA-Factory 参数原样透传，训练 dataloader 改用 token 预算采样器
+
+    样本长度取自 LLaMA-Factory 分词后训练集的 input_ids，只计算一次；
+    per_device_train_batch_size 不再决定每批条数（可用 --max-batch-size 限制）。
+    """
+    parser = argparse.ArgumentParser(prog='length_sampler.py train', allow_abbrev=False,
+                                     description='按 token 预算组批训练，其余参数传给 LLaMA-Factory')
+    parser.add_argument('--max-tokens', type=int, default=DEFAULT_MAX_TOKENS, help='每批 token 预算 (默认: 16384)')
+    parser.add_argument('--num-buckets', type=int, default=DEFAULT_NUM_BUCKETS, help='分位数分桶数 (默认: 8)')
+    parser.add_argument('--max-batch-size', type=int, default=None, help='每批样本数上限 (默认: 不限)')
+    args, llamafactory_args = parser.parse_known_args(argv)
+
+    from llamafactory.train.sft.trainer import CustomSeq2SeqTrainer
+    from llamafactory.train.tuner import run_exp
+
+    original_init = CustomSeq2SeqTrainer.__init__
+
+    def init_with_sampler(trainer, *init_args, **init_kwargs):
+        original_init(trainer, *init_args, **init_kwargs)
+        if trainer.train_dataset is None:
+            return
+        lengths = dataset_lengths(trainer.train_dataset)
+        sampler = install_token_budget_sampler(trainer, lengths, args.max_tokens, args.num_buckets,
+                                               args.max_batch_size)
+        stats = padding_stats(lengths, sampler._batches())
+        print(f"🪣 token 预算采样器: {len(lengths)} 条样本, {stats['batches']} 批/epoch, "
+              f"平均 {stats['mean_batch_size']:.1f} 条/批, 填充率 {stats['padding_ratio'] * 100:.1f}%")
+
+    CustomSeq2SeqTrainer.__init__ = init_with_sampler
+    # run_exp 从 sys.argv 读取 LLaMA-Factory 参数
+    original_argv = sys.argv
+    sys.argv = [sys.argv[0]] + llamafactory_args
+    try:
+        run_exp()
+    finally:
+        CustomSeq2SeqTrainer.__init__ = original_init
+        sys.argv = original_argv
+
+
+def measure_throughput(model, store: TokenStore, batches: List[List[int]], pad_token_id: int,
+                       max_steps: int) -> Dict:
+    """对前 max_steps 个批实测前向 + 反向，返回真实 token/s"""
+    import torch
+
+    device = next(model.parameters()).device
+    model.train()
+    real_tokens = 0
+    steps = batches[:max_steps]
+    start_time = time.time()
+    for batch in steps:
+        sequences = [store[i] for i in batch]
+        width = max(len(s) for s in sequences)
+        input_ids = torch.full((len(batch), width), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch), width), dtype=torch.long)
+        for row, ids in enumerate(sequences):
+            input_ids[row, :len(ids)] = torch.as_tensor(ids.astype(np.int64))
+            attention_mask[row, :len(ids)] = 1
+        input_ids, attention_mask = input_ids.to(device), attention_mask.to(device)
+        labels = input_ids.masked_fill(attention_mask == 0, -100)
+        loss = model(input_ids=input_ids, attention_mask=attention_mask, labels=labels).loss
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+        real_tokens += int(attention_mask.sum())
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    elapsed = time.time() - start_time
+    return {"steps": len(steps), "elapsed_seconds": elapsed,
+            "tokens_per_s": real_tokens / elapsed if elapsed > 0 else 0.0}
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "train":
+        train(sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(description='比较 token 预算采样与固定批大小的填充率和吞吐 '
+                                                 '(训练: length_sampler.py train ...)')
+    parser.add_argument('samples_dir', help='样本级 token 存储 (sequence_packing.py 输出的 samples/)')
+    parser.add_argument('--max-tokens', type=int, default=DEFAULT_MAX_TOKENS, help='每批 token 预算 (默认: 16384)')
+    parser.add_argument('--num-buckets', type=int, default=DEFAULT_NUM_BUCKETS, help='分位数分桶数 (默认: 8)')
+    parser.add_argument('--batch-size', type=int, default=8, help='基线 per_device_train_batch_size (默认: 8)')
+    parser.add_argument('--model', help='可选：实测吞吐用的模型路径')
+    parser.add_argument('--max-steps', type=int, default=10, help='实测吞吐的批数 (默认: 10)')
+    parser.add_argument('--json', action='store_true', help='以 JSON 输出')
+    args = parser.parse_args()
+
+    store = TokenStore(args.samples_dir)
+    lengths = store.lengths()
+    budget_batches = list(TokenBudgetBatchSampler(lengths, args.max_tokens, args.num_buckets))
+    baseline_batches = fixed_batches(len(lengths), args.batch_size)
+
+    report = {
+        "samples": int(len(lengths)),
+        "max_tokens": args.max_tokens,
+        "fixed_batch": padding_stats(lengths, baseline_batches),
+        "token_budget": padding_stats(lengths, budget_batches),
+    }
+
+    if args.model:
+        import torch
+        from transformers import AutoModelForCausalLM
+
+        model = AutoModelForCausalLM.from_pretrained(args.model, torch_dtype="auto")
+        if torch.cuda.is_available():
+            model = model.cuda()
+        pad_token_id = model.config.pad_token_id if model.config.pad_token_id is not None else 0
+        for key, batches in (("fixed_batch", baseline_batches), ("token_budget", budget_batches)):
+            report[key].update(measure_throughput(model, store, batches, pad_token_id, args.max_steps))
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+
+    print(f"\n📊 采样器对比 ({report['samples']} 条样本, 预算 {args.max_tokens} token/批):")
+    for key, label in (("fixed_batch", f"固定批大小 {args.batch_size}"), ("token_budget", "token 预算")):
+        stats = report[key]
+        line = (f"   {label:12}: {stats['batches']:>5} 批, 平均 {stats['mean_batch_size']:.1f} 条/批, "
+                f"填充率 {stats['padding_ratio']*100:.1f}%")
+        if "tokens_per_s" in stats:
+            line += f", {stats['tokens_per_s']:.0f} token/s"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+lora_export.py - 把 LoRA 适配器合并进基座权重并导出
+
+未合并的适配器在每个解码步、每一层都要多做两次小矩阵乘法。导出流程：
+1. 加载基座模型，把词表扩展到带 <|AGENT|>/<|EDIT|> 的分词器大小
+   （适配器中保存了扩展后的 embed_tokens/lm_head 时以其大小为准）
+2. 加载适配器，记录未合并模型在若干查询上的 logits 和解码延迟
+3. merge_and_unload 合并权重，再次计算 logits 和解码延迟，做数值一致性检查
+4. 写出分片的 safetensors + 带特殊词符的分词器 + export_info.json
+
+导出目录可以直接作为 hw3_2.py 的 --model 使用。
+
+使用方法：
+    python lora_export.py saves/Qwen2.5-3B/lora/train_2025-07-18-01-18-07
+    python lora_export.py saves/.../checkpoint-100 --base /path/to/tiny-model --output outputs/merged/tiny
+    python hw3_2.py run --model outputs/merged/train_2025-07-18-01-18-07
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import time
+from typing import Dict, List, Optional
+
+from tokenizer_registry import ARTIFACT_DIR, get_tokenizer
+
+MERGED_ROOT = "outputs/merged"
+ADAPTER_WEIGHT_FILES = ("adapter_model.safetensors", "adapter_model.bin")
+EXPORT_INFO_FILE = "export_info.json"
+
+
+def adapter_config(adapter_path: str) -> Dict:
+    with open(os.path.join(adapter_path, "adapter_config.json"), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def adapter_vocab_size(adapter_path: str) -> Optional[int]:
+    """适配器中保存的完整 embed_tokens / lm_head 的行数（训练时扩展过词表才会有）"""
+    path = os.path.join(adapter_path, ADAPTER_WEIGHT_FILES[0])
+    if os.path.exists(path):
+        from safetensors import safe_open
+
+        with safe_open(path, framework="pt") as f:
+            for key in f.keys():
+                if ("embed_tokens" in key or "lm_head" in key) and "lora_" not in key:
+                    return f.get_slice(key).get_shape()[0]
+        return None
+    path = os.path.join(adapter_path, ADAPTER_WEIGHT_FILES[1])
+    if os.path.exists(path):
+        import torch
+
+        state = torch.load(path, map_location="cpu", weights_only=True)
+        for key, tensor in state.items():
+            if ("embed_tokens" in key or "lm_head" in key) and "lora_" not in key:
+                return tensor.shape[0]
+    return None
+
+
+def parity_prompts(tokenizer, query_file: str, num_prompts: int, max_len: int) -> List[List[int]]:
+    """用 hw3_2 的系统提示词渲染前 num_prompts 个查询（截断到 max_len 个 token）"""
+    from hw3_2 import build_messages, load_queries, render_messages
+
+    prompts = []
+    for item in load_queries(query_file)[:num_prompts]:
+        text = render_messages(build_messages(item["Query"]), chat_tokenizer=tokenizer)
+        prompts.append(tokenizer.encode(text, add_special_tokens=False)[-max_len:])
+    return prompts
+
+
+def compute_logits(model, prompts: List[List[int]]):
+    """逐条前向，返回每条 prompt 所有位置的 logits（float32，CPU）"""
+    import torch
+
+    device = next(model.parameters()).device
+    outputs = []
+    with torch.no_grad():
+        for ids in prompts:
+            input_ids = torch.tensor([ids], dtype=torch.long, device=device)
+            outputs.append(model(input_ids=input_ids).logits[0].float().cpu())
+    return outputs
+
+
+def decode_latency(model, prompt_ids: List[int], steps: int) -> Dict:
+    """贪心解码 steps 步（带 KV cache），返回每步平均耗时"""
+    import torch
+
+    device = next(model.parameters()).device
+    with torch.no_grad():
+        input_ids = torch.tensor([prompt_ids], dtype=torch.long, device=device)
+        out = model(input_ids=input_ids, use_cache=True)
+        cache = out.past_key_values
+        token = out.logits[:, -1:].argmax(-1)
+        # 第一步不计时（预热）
+        out = model(input_ids=token, past_key_values=cache, use_cache=True)
+        cache, token = out.past_key_values, out.logits[:, -1:].argmax(-1)
+
+        start_time = time.perf_counter()
+        for _ in range(steps):
+            out = model(input_ids=token, past_key_values=cache, use_cache=True)
+            cache, token = out.past_key_values, out.logits[:, -1:].argmax(-1)
+        elapsed = time.perf_counter() - start_time
+    return {"steps": steps, "ms_per_token": elapsed / steps * 1000, "tokens_per_s": steps / elapsed}
+
+
+def compare_logits(reference, merged, atol: float) -> Dict:
+    """
+    逐位置比较合并前后的 logits
+
+    只按 max|Δ| <= atol 判定通过；低精度下接近并列的 logits 会因舍入交换 top-1，
+    top-1 一致率仅供参考。
+    """
+    max_diff = max(float((a - b).abs().max()) for a, b in zip(reference, merged))
+    mean_diff = sum(float((a - b).abs().mean()) for a, b in zip(reference, merged)) / len(reference)
+    positions = sum(a.shape[0] for a in reference)
+    top1 = sum(int((a.argmax(-1) == b.argmax(-1)).sum()) for a, b in zip(reference, merged))
+    return {
+        "prompts": len(reference),
+        "positions": positions,
+        "max_abs_diff": max_diff,
+        "mean_abs_diff": mean_diff,
+        "top1_agreement": top1 / positions if positions else 1.0,
+        "atol": atol,
+        "passed": math.isfinite(max_diff) and max_diff <= atol,
+    }
+
+
+def export_merged(adapter_path: str, base_path: str, tokenizer_path: str, output_dir: str,
+                  dtype: str = "bfloat16", device: str = "cpu", max_shard_size: str = "2GB",
+                  query_file: str = "query_only.json", num_prompts: int = 4, max_prompt_len: int = 256,
+                  latency_steps: int = 32, atol: float = 1e-3, check: bool = True) -> Dict:
+    """合并并导出，返回 export_info（含一致性检查和延迟对比）"""
+    import torch
+    from peft import PeftModel
+    from transformers import AutoModelForCausalLM
+
+    tokenizer = get_tokenizer(tokenizer_path)
+    model = AutoModelForCausalLM.from_pretrained(
+        base_path, torch_dtype=getattr(torch, dtype), trust_remote_code=True
+    ).to(device)
+    model.eval()
+
+    # 先扩展词表再加载适配器，否则适配器中扩展过的 embed_tokens/lm_head 形状对不上
+    base_vocab = model.get_input_embeddings().num_embeddings
+    target_vocab = max(len(tokenizer), adapter_vocab_size(adapter_path) or 0)
+    if base_vocab < target_vocab:
+        print(f"📐 扩展词表: {base_vocab} -> {target_vocab}")
+        model.resize_token_embeddings(target_vocab)
+
+    model = PeftModel.from_pretrained(model, adapter_path)
+    model.eval()
+
+    info = {
+        "adapter": adapter_path,
+        "base_model": base_path,
+        "tokenizer": tokenizer_path,
+        "dtype": dtype,
+        "vocab_size": model.get_input_embeddings().num_embeddings,
+        "special_token_ids": {token: tokenizer.convert_tokens_to_ids(token) for token in ("<|AGENT|>", "<|EDIT|>")},
+    }
+
+    reference = None
+    if check:
+        prompts = parity_prompts(tokenizer, query_file, num_prompts, max_prompt_len)
+        print(f"🔬 计算未合并模型的 logits ({len(prompts)} 个 prompt) 和解码延迟...")
+        reference = compute_logits(model, prompts)
+        info["latency_unmerged"] = decode_latency(model, prompts[0], latency_steps)
+
+    print("🔗 合并 LoRA 权重...")
+    model = model.merge_and_unload()
+    model.eval()
+
+    if check:
+        merged_logits = compute_logits(model, prompts)
+        info["latency_merged"] = decode_latency(model, prompts[0], latency_steps)
+        info["parity"] = compare_logits(reference, merged_logits, atol)
+        info["speedup"] = info["latency_unmerged"]["ms_per_token"] / info["latency_merged"]["ms_per_token"]
+
+    print(f"💾 写出分片 safetensors 到 {output_dir} (max_shard_size={max_shard_size})...")
+    os.makedirs(output_dir, exist_ok=True)
+    model.save_pretrained(output_dir, max_shard_size=max_shard_size, safe_serialization=True)
+    tokenizer.save_pretrained(output_dir)
+    with open(os.path.join(output_dir, EXPORT_INFO_FILE), 'w', encoding='utf-8') as f:
+        json.dump(info, f, ensure_ascii=False, indent=2)
+    return info
+
+
+def print_export_info(info: Dict):
+    print(f"\n📦 导出完成: 词表 {info['vocab_size']}，特殊词符 {info['special_token_ids']}")
+    if "parity" in info:
+        parity = info["parity"]
+        status = "✅ 通过" if parity["passed"] else "❌ 未通过"
+        print(f"   数值一致性: {status}  max|Δ|={parity['max_abs_diff']:.2e} (atol {parity['atol']:.0e})  "
+              f"mean|Δ|={parity['mean_abs_diff']:.2e}  top-1 一致 {parity['top1_agreement'] * 100:.2f}%")
+        print(f"   解码延迟: 未合并 {info['latency_unmerged']['ms_per_token']:.2f} ms/token -> "
+              f"合并后 {info['latency_merged']['ms_per_token']:.2f} ms/token ({info['speedup']:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='合并 LoRA 适配器并导出可直接推理的模型')
+    parser.add_argument('adapter', help='适配器目录 (saves/.../lora/<run> 或其中的 checkpoint-N)')
+    parser.add_argument('--base', default=None, help='基座模型路径 (默认: adapter_config.json 中的路径)')
+    parser.add_argument('--tokenizer', default=ARTIFACT_DIR, help=f'带特殊词符的分词器 (默认: {ARTIFACT_DIR})')
+    parser.add_argument('--output', default=None, help=f'导出目录 (默认: {MERGED_ROOT}/<适配器目录名>)')
+    parser.add_argument('--dtype', default='bfloat16', help='导出精度 (默认: bfloat16；CPU 小模型测试可用 float32)')
+    parser.add_argument('--device', default='cpu', help='合并所用设备 (默认: cpu)')
+    parser.add_argument('--max-shard-size', default='2GB', help='safetensors 分片大小 (默认: 2GB)')
+    parser.add_argument('--queries', default='query_only.json', help='一致性检查用的查询文件')
+    parser.add_argument('--num-prompts', type=int, default=4, help='一致性检查的 prompt 数 (默认: 4)')
+    parser.add_argument('--max-prompt-len', type=int, default=256, help='一致性检查的 prompt 截断长度')
+    parser.add_argument('--latency-steps', type=int, default=32, help='解码延迟测量的步数 (默认: 32)')
+    parser.add_argument('--atol', type=float, default=None,
+                        help='logits 最大允许差异 (默认: float32 为 1e-3，其他精度为 5e-2)')
+    parser.add_argument('--skip-check', action='store_true', help='跳过一致性检查和延迟对比')
+    args = parser.parse_args()
+
+    base_path = args.base or adapter_config(args.adapter).get("base_model_name_or_path")
+    if not base_path:
+        parser.error("adapter_config.json 中没有基座模型路径，请用 --base 指定")
+    output_dir = args.output or os.path.join(MERGED_ROOT, os.path.basename(os.path.normpath(args.adapter)))
+    atol = args.atol if args.atol is not None else (1e-3 if args.dtype == 'float32' else 5e-2)
+
+    print(f"🔧 基座模型: {base_path}")
+    print(f"🔧 适配器: {args.adapter}")
+    info = export_merged(
+        args.adapter, base_path, args.tokenizer, output_dir,
+        dtype=args.dtype, device=args.device, max_shard_size=args.max_shard_size,
+        query_file=args.queries, num_prompts=args.num_prompts, max_prompt_len=args.max_prompt_len,
+        latency_steps=args.latency_steps, atol=atol, check=not args.skip_check,
+    )
+    print_export_info(info)
+    print(f"\n🚀 推理: python hw3_2.py run --model {output_dir}")
+
+    if "parity" in info and not info["parity"]["passed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+mock_openai.py - 本地 OpenAI 兼容桩服务 + data_constructor.py 压测
+
+调 --threads、重试、对冲、配额等参数不应该花真实的 API 费用。桩服务模拟：
+- 延迟：对数正态分布的首 token 延迟 + 按输出 token 数计算的解码时间，少量请求拖到 --slow-latency
+- 错误注入：按比例返回 500 / 429
+- 速率限制：按 prompt token + max_tokens 的令牌桶 (TPM)，超出时返回 429 和 Retry-After
+- 预置回复：生成错误代码的请求返回代码块；生成输出的请求按 instruction 中是否带报错信息
+  返回 AGENT/EDIT 格式的输出，--malformed-rate 比例的输出故意不符合 validate_output 的检查
+  （缺少 <think>、缺少特殊词符或调用了错误的函数）；超过 max_tokens 时截断并返回 finish_reason=length
+
+使用方法：
+    python mock_openai.py serve --port 8100 --latency-median 1.5 --error-rate 0.02 --tpm 200000
+    OPENAI_BASE_URL=http://127.0.0.1:8100/v1 OPENAI_API_KEY=mock python data_constructor.py --samples 32
+
+    python mock_openai.py loadtest --threads 4 8 16 32 --samples 64 --tpm 300000
+    python mock_openai.py loadtest --threads 16 --constructor-args="--hedge"
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import shlex
+import subprocess
+import sys
+import time
+import urllib.request
+import uuid
+from typing import Dict, List, Optional
+
+from token_budget import count_tokens
+
+MOCK_MODEL = "gpt-4.1"
+LOADTEST_DIR = "outputs/loadtest"
+
+BUGGY_CODE_TEMPLATE = '''def solve(nums):
+    total = 0
+    for i in range(1, len(nums)):
+        total += nums[i]
+    return total
+
+
+if __name__ == "__main__":
+    n = int(input())
+    nums = list(map(int, input().split()))
+    print(solve(nums))'''
+
+
+def default_config() -> Dict:
+    return {
+        "latency_median": 1.0,      # 首 token 延迟中位数 (秒)
+        "latency_sigma": 0.5,       # 对数正态分布的 sigma
+        "tokens_per_s": 80.0,       # 解码速度，0 表示不计解码时间
+        "slow_rate": 0.01,          # 拖到 slow_latency 的请求比例
+        "slow_latency": 30.0,
+        "error_rate": 0.0,          # 500 比例
+        "rate_limit_rate": 0.0,     # 随机 429 比例
+        "tpm": 0,                   # 每分钟 token 上限 (prompt + max_tokens)，0 表示不限
+        "malformed_rate": 0.1,      # 不符合格式的输出比例
+        "seed": None,
+    }
+
+
+# ==================== 预置回复 ====================
+
+def _instruction_code(instruction: str) -> str:
+    """data_constructor.create_instruction 的格式：说明文字 + 空行 + 代码"""
+    _, _, code = instruction.partition("\n\n")
+    return code.strip() or BUGGY_CODE_TEMPLATE
+
+
+def _is_edit_instruction(instruction: str) -> bool:
+    """EDIT 指令带有具体的异常类型 (如 IndexError)，AGENT 指令只描述现象"""
+    return "Error" in instruction.partition("\n\n")[0]
+
+
+def canned_output(instruction: str, malformed: bool, rng: random.Random) -> str:
+    """按 instruction 类型给出 AGENT/EDIT 输出；malformed 时随机制造一种 validate_output 能发现的问题"""
+    code = _instruction_code(instruction)
+    if _is_edit_instruction(instruction):
+        think = "<think> 用户给出了明确的报错信息，循环起始下标错误，可以直接修复。 </think>"
+        marker = "<|EDIT|>"
+        call = {"name": "editor", "arguments": {
+            "original_code": code, "modified_code": code.replace("range(1, len(nums))", "range(len(nums))")}}
+        text = "我会使用编辑模式修复问题"
+    else:
+        think = "<think> 用户没有提供具体的错误信息，需要先运行代码观察行为。 </think>"
+        marker = "<|AGENT|>"
+        call = {"name": "python", "arguments": {"code": code}}
+        text = "我会使用代理模式进行处理"
+
+    if malformed:
+        defect = rng.choice(["no_think", "no_marker", "wrong_function"])
+        if defect == "no_think":
+            think = ""
+        elif defect == "no_marker":
+            marker = ""
+        else:
+            call["name"] = "python" if call["name"] == "editor" else "editor"
+    return f"{think}\n{marker}\n{text}{json.dumps(call, ensure_ascii=False)}".lstrip("\n")
+
+
+def canned_response(messages: List[Dict], malformed: bool, rng: random.Random) -> str:
+    user = next((m.get("content") or "" for m in reversed(messages) if m.get("role") == "user"), "")
+    if len(messages) == 1 and "包含小错误" in user:
+        return f"```python\n{BUGGY_CODE_TEMPLATE}\n```" if not malformed else "抱歉，我无法生成这段代码。"
+    return canned_output(user, malformed, rng)
+
+
+# ==================== 桩服务 ====================
+
+class MockState:
+    """配置、随机数、TPM 令牌桶和统计计数（在事件循环中访问，无需加锁）"""
+
+    def __init__(self, config: Dict):
+        self.config = config
+        self.rng = random.Random(config.get("seed"))
+        self.bucket = float(config["tpm"])
+        self.bucket_time = time.monotonic()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {"requests": 0, "status": {}, "prompt_tokens": 0, "completion_tokens": 0,
+                      "malformed": 0, "truncated": 0, "started_at": time.time()}
+
+    def count(self, status: int):
+        self.stats["status"][str(status)] = self.stats["status"].get(str(status), 0) + 1
+
+    def take_tokens(self, cost: int) -> Optional[float]:
+        """从令牌桶扣除 cost；不足时返回需要等待的秒数"""
+        tpm = self.config["tpm"]
+        if not tpm:
+            return None
+        now = time.monotonic()
+        self.bucket = min(tpm, self.bucket + (now - self.bucket_time) * tpm / 60)
+        self.bucket_time = now
+        if cost > self.bucket:
+            return (cost - self.bucket) * 60 / tpm
+        self.bucket -= cost
+        return None
+
+    def sample_latency(self, completion_tokens: int) -> float:
+        config = self.config
+        if self.rng.random() < config["slow_rate"]:
+            return config["slow_latency"]
+        latency = self.rng.lognormvariate(math.log(max(config["latency_median"], 1e-6)), config["latency_sigma"])
+        if config["tokens_per_s"]:
+            latency += completion_tokens / config["tokens_per_s"]
+        return latency
+
+
+def create_app(state: MockState):
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse
+
+    app = FastAPI(title="mock openai")
+
+    def error(status: int, message: str, error_type: str, headers: Optional[Dict] = None):
+        state.count(status)
+        return JSONResponse(status_code=status, headers=headers,
+                            content={"error": {"message": message, "type": error_type, "code": status}})
+
+    @app.get("/v1/models")
+    async def list_models():
+        return {"object": "list", "data": [{"id": MOCK_MODEL, "object": "model", "owned_by": "mock"}]}
+
+    @app.get("/mock/stats")
+    async def stats():
+        return state.stats
+
+    @app.post("/mock/reset")
+    async def reset():
+        state.reset_stats()
+        return {"status": "ok"}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        state.stats["requests"] += 1
+        config, rng = state.config, state.rng
+        messages = body.get("messages") or []
+        prompt_tokens = sum(count_tokens(m.get("content") or "") for m in messages)
+        max_tokens = body.get("max_completion_tokens") or body.get("max_tokens") or 4096
+
+        wait = state.take_tokens(prompt_tokens + max_tokens)
+        if wait is not None:
+            return error(429, "Rate limit reached for tokens per min (TPM)", "rate_limit_exceeded",
+                         headers={"retry-after": str(max(1, math.ceil(wait)))})
+        if rng.random() < config["rate_limit_rate"]:
+            return error(429, "Rate limit reached (injected)", "rate_limit_exceeded", headers={"retry-after": "1"})
+        if rng.random() < config["error_rate"]:
+            await asyncio.sleep(state.sample_latency(0))
+            return error(500, "Internal server error (injected)", "server_error")
+
+        malformed = rng.random() < config["malformed_rate"]
+        content = canned_response(messages, malformed, rng)
+        completion_tokens = count_tokens(content)
+        finish_reason = "stop"
+        if completion_tokens > max_tokens:
+            # 按比例截断到 max_tokens
+            content = content[:int(len(content) * max_tokens / completion_tokens)]
+            completion_tokens, finish_reason = max_tokens, "length"
+            state.stats["truncated"] += 1
+
+        await asyncio.sleep(state.sample_latency(completion_tokens))
+        state.count(200)
+        state.stats["malformed"] += int(malformed)
+        state.stats["prompt_tokens"] += prompt_tokens
+        state.stats["completion_tokens"] += completion_tokens
+        return {
+            "id": f"chatcmpl-mock-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model") or MOCK_MODEL,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                         "finish_reason": finish_reason}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    return app
+
+
+def config_from_args(args) -> Dict:
+    config = default_config()
+    for key in config:
+        value = getattr(args, key, None)
+        if value is not None:
+            config[key] = value
+    return config
+
+
+def serve(args):
+    import uvicorn
+
+    config = config_from_args(args)
+    print(f"🧪 mock OpenAI 服务: http://{args.host}:{args.port}/v1")
+    print(f"   配置: {json.dumps(config, ensure_ascii=False)}")
+    uvicorn.run(create_app(MockState(config)), host=args.host, port=args.port, log_level="warning")
+
+
+# ==================== 压测 ====================
+
+def _http_json(url: str, method: str = "GET") -> Dict:
+    request = urllib.request.Request(url, method=method, data=b"" if method == "POST" else None)
+    with urllib.request.urlopen(request, timeout=5) as response:
+        return json.loads(response.read().decode("utf-8"))
+
+
+def start_mock_server(args) -> subprocess.Popen:
+    """以子进程启动桩服务（与压测使用同一组配置参数），等待其就绪"""
+    command = [sys.executable, os.path.abspath(__file__), "serve", "--host", args.host, "--port", str(args.port)]
+    for key, value in config_from_args(args).items():
+        if value is not None:
+            command += [f"--{key.replace('_', '-')}", str(value)]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    base = f"http://{args.host}:{args.port}"
+    for _ in range(100):
+        if process.poll() is not None:
+            raise RuntimeError("mock 服务启动失败")
+        try:
+            _http_json(f"{base}/v1/models")
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("mock 服务启动超时")
+
+
+def synthetic_problems(path: str, count: int):
+    """压测用的编程问题（不依赖 parquet 数据）"""
+    problems = [{
+        "question_id": f"mock-{index}",
+        "question_title": f"mock problem {index}",
+        "problem_description": f"给定 n 个整数，输出它们的和。(测试问题 {index})\n" + "约束: 1 <= n <= 10^5。\n" * (index % 5),
+        "original_text": "",
+    } for index in range(count)]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(problems, f, ensure_ascii=False, indent=2)
+
+
+def run_setting(args, threads: int, base_url: str, problems_file: str) -> Dict:
+    """以给定线程数运行一次 data_constructor.py，返回吞吐、错误率和有效率"""
+    _http_json(f"{base_url}/mock/reset", method="POST")
+    output = os.path.join(LOADTEST_DIR, f"threads_{threads}.json")
+    command = [sys.executable, "data_constructor.py", "--samples", str(args.samples), "--threads", str(threads),
+               "--output", output, "--problems", problems_file] + shlex.split(args.constructor_args)
+    env = dict(os.environ, OPENAI_BASE_URL=f"{base_url}/v1", OPENAI_API_KEY="mock")
+    log_file = os.path.join(LOADTEST_DIR, f"threads_{threads}.log")
+    start_time = time.time()
+    with open(log_file, 'w', encoding='utf-8') as log:
+        returncode = subprocess.call(command, env=env, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+    wall_time = time.time() - start_time
+
+    stats = _http_json(f"{base_url}/mock/stats")
+    results = []
+    if os.path.exists(output):
+        with open(output, 'r', encoding='utf-8') as f:
+            results = json.load(f)
+    valid = sum(1 for item in results if item.get("valid"))
+    errors = stats["requests"] - stats["status"].get("200", 0)
+    return {
+        "threads": threads,
+        "returncode": returncode,
+        "wall_time_s": wall_time,
+        "requests": stats["requests"],
+        "requests_per_s": stats["requests"] / wall_time if wall_time else 0.0,
+        "error_rate": errors / stats["requests"] if stats["requests"] else 0.0,
+        "status": stats["status"],
+        "samples": len(results),
+        "valid": valid,
+        "valid_per_s": valid / wall_time if wall_time else 0.0,
+        "valid_rate": valid / args.samples if args.samples else 0.0,
+        "tokens": stats["prompt_tokens"] + stats["completion_tokens"],
+        "log": log_file,
+    }
+
+
+def print_loadtest(rows: List[Dict]):
+    print(f"\n📊 压测结果:")
+    print(f"{'线程数':<8}{'耗时(s)':>10}{'请求/s':>10}{'错误率':>10}{'样本':>8}{'有效率':>10}{'有效/s':>10}")
+    print("-" * 66)
+    for row in rows:
+        print(f"{row['threads']:<8}{row['wall_time_s']:>10.1f}{row['requests_per_s']:>10.2f}"
+              f"{row['error_rate'] * 100:>9.1f}%{row['samples']:>8}{row['valid_rate'] * 100:>9.1f}%"
+              f"{row['valid_per_s']:>10.2f}")
+    best = max(rows, key=lambda row: row["valid_per_s"])
+    print(f"🏆 有效样本吞吐最高: --threads {best['threads']} ({best['valid_per_s']:.2f} 个/s)")
+
+
+def loadtest(args):
+    os.makedirs(LOADTEST_DIR, exist_ok=True)
+    problems_file = args.problems or os.path.join(LOADTEST_DIR, "problems.json")
+    if not args.problems:
+        synthetic_problems(problems_file, min(args.samples, 128))
+
+    print(f"🧪 启动 mock 服务 (端口 {args.port})...")
+    server = start_mock_server(args)
+    base_url = f"http://{args.host}:{args.port}"
+    rows = []
+    try:
+        for threads in args.threads:
+            print(f"▶️  --threads {threads}, --samples {args.samples} {args.constructor_args}")
+            row = run_setting(args, threads, base_url, problems_file)
+            print(f"   {row['wall_time_s']:.1f}s, {row['requests']} 个请求, 错误率 {row['error_rate'] * 100:.1f}%, "
+                  f"有效 {row['valid']}/{args.samples}")
+            rows.append(row)
+    finally:
+        server.terminate()
+        server.wait()
+
+    print_loadtest(rows)
+    os.makedirs(os.path.dirname(args.report) or ".", exist_ok=True)
+    with open(args.report, 'w', encoding='utf-8') as f:
+        json.dump({"config": config_from_args(args), "samples": args.samples,
+                   "constructor_args": args.constructor_args, "settings": rows}, f, ensure_ascii=False, indent=2)
+    print(f"💾 压测报告: {args.report}")
+
+
+def add_mock_arguments(parser: argparse.ArgumentParser):
+    defaults = default_config()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--latency-median', type=float, default=defaults["latency_median"],
+                        help='首 token 延迟中位数，秒 (默认: 1.0)')
+    parser.add_argument('--latency-sigma', type=float, default=defaults["latency_sigma"],
+                        help='延迟对数正态分布的 sigma (默认: 0.5)')
+    parser.add_argument('--tokens-per-s', type=float, default=defaults["tokens_per_s"],
+                        help='模拟解码速度，0 表示不计 (默认: 80)')
+    parser.add_argument('--slow-rate', type=float, default=defaults["slow_rate"], help='慢请求比例 (默认: 0.01)')
+    parser.add_argument('--slow-latency', type=float, default=defaults["slow_latency"], help='慢请求延迟 (默认: 30)')
+    parser.add_argument('--error-rate', type=float, default=defaults["error_rate"], help='500 错误比例 (默认: 0)')
+    parser.add_argument('--rate-limit-rate', type=float, default=defaults["rate_limit_rate"],
+                        help='随机 429 比例 (默认: 0)')
+    parser.add_argument('--tpm', type=int, default=defaults["tpm"],
+                        help='每分钟 token 上限 (prompt + max_tokens)，0 表示不限 (默认: 0)')
+    parser.add_argument('--malformed-rate', type=float, default=defaults["malformed_rate"],
+                        help='不符合格式的输出比例 (默认: 0.1)')
+    parser.add_argument('--seed', type=int, default=None, help='随机种子')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地 OpenAI 兼容桩服务与 data_constructor.py 压测')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help='启动桩服务')
+    add_mock_arguments(serve_parser)
+
+    loadtest_parser = subparsers.add_parser('loadtest', help='在桩服务上扫描 data_constructor.py 的并发设置')
+    add_mock_arguments(loadtest_parser)
+    loadtest_parser.add_argument('--threads', type=int, nargs='+', default=[4, 8, 16, 32],
+                                 help='要扫描的 --threads 取值 (默认: 4 8 16 32)')
+    loadtest_parser.add_argument('--samples', type=int, default=64, help='每个设置的样本数 (默认: 64)')
+    loadtest_parser.add_argument('--problems', default=None, help='问题 JSON (默认: 生成合成问题)')
+    loadtest_parser.add_argument('--constructor-args', default='',
+                                 help='传给 data_constructor.py 的其他参数，需用等号传入，如 --constructor-args="--hedge --edit-format diff"')
+    loadtest_parser.add_argument('--report', default='outputs/reports/loadtest.json', help='压测报告路径')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args)
+    elif args.command == 'loadtest':
+        loadtest(args)
+
+
+if __name__ == "__main__":
+    main()
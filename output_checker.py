@@ -8,6 +8,8 @@ hw3_checker.py - 检查 hw3_2.json 格式数据的 Output 字段
 2. 除think外展示给用户的部分，是否含有特殊词符 <|EDIT|> 和 <|AGENT|> 之一
 3. <|AGENT|> 后是否正确调用函数 python
 4. <|EDIT|> 后是否调用函数 editor
+5. diff 格式的 editor 参数（见 edit_diff.py）能否应用到 Query 中的代码上；
+   完整格式（original_code/modified_code）不额外检查
 
 使用方法：
     python hw3_checker.py [文件路径]
@@ -19,7 +21,9 @@ import json
 import re
 import sys
 import argparse
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
+
+from edit_diff import check_editor_call
 
 def extract_think_content(output: str) -> Tuple[str, str]:
     """
@@ -83,13 +87,14 @@ def check_function_call(content: str, expected_function: str) -> Tuple[bool, str
     else:
         return False, f"未找到{expected_function}函数调用"
 
-def check_single_output(output: str, index: int) -> Dict:
+def check_single_output(output: str, index: int, query: Optional[str] = None) -> Dict:
     """
     检查单个输出项
     
     Args:
         output: 输出字符串
         index: 项目索引
+        query: 对应的查询（用于检查 diff 格式的 editor 调用能否应用）
         
     Returns:
         dict: 检查结果
@@ -137,6 +142,13 @@ def check_single_output(output: str, index: int) -> Dict:
         
         if not has_correct_call:
             result['issues'].append('<|EDIT|> 后未正确调用 editor 函数')
+        else:
+            # 4. 检查 editor 参数（完整格式或 diff 格式）
+            args_ok, args_details = check_editor_call(non_think_content, query)
+            result['editor_args_valid'] = args_ok
+            result['function_call_details'] += f"，{args_details}"
+            if not args_ok:
+                result['issues'].append(f'editor 参数错误: {args_details}')
     
     return result
 
@@ -169,7 +181,8 @@ def check_query_output_file(file_path: str) -> Dict:
         'summary': {
             'missing_think': 0,
             'missing_markers': 0,
-            'wrong_function_calls': 0
+            'wrong_function_calls': 0,
+            'invalid_editor_args': 0
         }
     }
     
@@ -183,7 +196,7 @@ def check_query_output_file(file_path: str) -> Dict:
             continue
         
         output = item['Output']
-        check_result = check_single_output(output, i)
+        check_result = check_single_output(output, i, item.get('Query'))
         results['details'].append(check_result)
         
         # 统计
@@ -195,6 +208,8 @@ def check_query_output_file(file_path: str) -> Dict:
                 results['summary']['missing_markers'] += 1
             if not check_result['correct_function_call'] and check_result['marker_type'] != 'NONE':
                 results['summary']['wrong_function_calls'] += 1
+            if check_result.get('editor_args_valid') is False:
+                results['summary']['invalid_editor_args'] += 1
         else:
             results['passed_items'] += 1
     
@@ -234,6 +249,8 @@ def print_results(results: Dict, verbose: bool = False):
             print(f"   缺少特殊词符: {summary['missing_markers']} 项")
         if summary['wrong_function_calls'] > 0:
             print(f"   函数调用错误: {summary['wrong_function_calls']} 项")
+        if summary['invalid_editor_args'] > 0:
+            print(f"   editor 参数错误: {summary['invalid_editor_args']} 项")
         print()
     
     # 详细结果
@@ -274,6 +291,7 @@ def main():
 2. 除think外展示给用户的部分，是否含有特殊词符 <|EDIT|> 和 <|AGENT|> 之一
 3. <|AGENT|> 后是否正确调用函数 python
 4. <|EDIT|> 后是否调用函数 editor
+5. diff 格式的 editor 参数能否应用
 
 示例：
     python hw3_checker.py                           # 检查默认文件
@@ -306,4 +324,4 @@ def main():
     print_results(results, verbose=args.verbose)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
\ No newline at end of file
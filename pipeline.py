@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+pipeline.py - 按内容哈希缓存的数据/训练流水线 (替代 script/run_full.sh)
+
+阶段组成有向无环图：
+
+    load_problems -> generate -> validate -> export ─┐
+                                          └> pack ───┴> register -> train
+
+- 每个阶段的缓存键 = 阶段参数/命令 + 相关代码文件哈希 + 输入文件哈希（上游输出即下游输入）；
+  代码文件由入口脚本的导入关系（含函数内的延迟导入）递归得到，改动任何被用到的模块都会使缓存失效
+- 键未变且输出文件与上次记录一致时跳过该阶段；否则重跑，下游的键随之变化
+- 依赖已满足的阶段并行执行（export 与 pack）
+- 不交互，子进程输出写入 outputs/pipeline/logs/<阶段>.log，适合定时任务；失败时退出码非 0
+- 结束时打印每个阶段的状态和耗时，并写入 outputs/pipeline/last_run.json
+
+使用方法：
+    python pipeline.py --samples 128 --name training_data_full_128
+    python pipeline.py --until register              # 不训练
+    python pipeline.py --dry-run                     # 只显示哪些阶段会执行
+    python pipeline.py --force validate              # 强制重跑某个阶段（及其下游）
+"""
+
+import argparse
+import ast
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional
+
+from token_store import sha256_file, sha256_text
+
+PIPELINE_ROOT = "outputs/pipeline"
+TRAIN_SCRIPT = "script/run_train.sh"
+DATASET_DIR = "training_data"
+PYTHON = sys.executable or "python3"
+REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+# ==================== 哈希与缓存 ====================
+
+def hash_path(path: str) -> Optional[str]:
+    """文件取内容哈希，目录取所有文件（相对路径 + 内容）的组合哈希，不存在返回 None"""
+    if os.path.isfile(path):
+        return sha256_file(path)
+    if os.path.isdir(path):
+        entries = []
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                full = os.path.join(root, name)
+                entries.append(f"{os.path.relpath(full, path)}:{sha256_file(full)}")
+        return sha256_text("\n".join(entries))
+    return None
+
+
+def local_modules(*entries: str) -> List[str]:
+    """入口脚本及其递归导入的仓库内模块（包括函数内的延迟导入），按文件名排序"""
+    found, pending = set(), list(entries)
+    while pending:
+        name = pending.pop()
+        path = os.path.join(REPO_ROOT, name)
+        if name in found or not os.path.isfile(path):
+            continue
+        found.add(name)
+        with open(path, 'r', encoding='utf-8') as f:
+            tree = ast.parse(f.read(), filename=name)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                modules = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and not node.level and node.module:
+                modules = [node.module]
+            else:
+                continue
+            pending.extend(f"{module.split('.')[0]}.py" for module in modules)
+    return sorted(found)
+
+
+def stage_key(stage: Dict) -> str:
+    """阶段缓存键：参数 + 命令 + 代码 + 输入"""
+    payload = {
+        "name": stage["name"],
+        "params": stage.get("params", {}),
+        "command": stage.get("command"),
+        "code": {path: hash_path(path) for path in stage.get("code", [])},
+        "inputs": {path: hash_path(path) for path in stage.get("inputs", [])},
+    }
+    return sha256_text(json.dumps(payload, sort_keys=True, ensure_ascii=False))
+
+
+def stamp_path(stage_name: str) -> str:
+    return os.path.join(PIPELINE_ROOT, "stamps", f"{stage_name}.json")
+
+
+def is_cached(stage: Dict, key: str) -> bool:
+    """上次成功时的键相同，且输出仍与当时记录的哈希一致"""
+    path = stamp_path(stage["name"])
+    if not os.path.exists(path):
+        return False
+    with open(path, 'r', encoding='utf-8') as f:
+        stamp = json.load(f)
+    if stamp.get("key") != key:
+        return False
+    return all(hash_path(output) == digest and digest is not None
+               for output, digest in stamp.get("outputs", {}).items())
+
+
+def write_stamp(stage: Dict, key: str, seconds: float):
+    path = stamp_path(stage["name"])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({
+            "key": key,
+            "outputs": {output: hash_path(output) for output in stage.get("outputs", [])},
+            "seconds": seconds,
+            "finished_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }, f, ensure_ascii=False, indent=2)
+
+
+# ==================== 阶段定义 ====================
+
+def load_train_args(script_path: str = TRAIN_SCRIPT) -> Dict[str, str]:
+    """从 run_train.sh 中读取 llamafactory-cli train 的 --key value 参数，保证与手动训练一致"""
+    with open(script_path, 'r', encoding='utf-8') as f:
+        tokens = shlex.split(f.read().replace("\\\n", " "), comments=True)
+    args = {}
+    for index, token in enumerate(tokens):
+        if token.startswith("--") and index + 1 < len(tokens) and not tokens[index + 1].startswith("--"):
+            args[token[2:]] = tokens[index + 1]
+    return args
+
+
+def _load_problems(stage: Dict):
+    from data_constructor import PARQUET_FILE, load_programming_problems
+
+    problems = load_programming_problems(PARQUET_FILE)
+    if not problems:
+        raise RuntimeError(f"无法从 {PARQUET_FILE} 加载编程问题")
+    output = stage["outputs"][0]
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(problems, f, ensure_ascii=False, indent=2)
+
+
+def _export(stage: Dict):
+    source, target = stage["inputs"][0], stage["outputs"][0]
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    shutil.copyfile(source, target)
+
+
+def _register(stage: Dict):
+    from sequence_packing import register_dataset
+
+    params = stage["params"]
+    dataset_info = stage["outputs"][0]
+    alpaca_file, pack_dir = stage["inputs"][0], stage["inputs"][1]
+    with open(os.path.join(pack_dir, "packing_report.json"), 'r', encoding='utf-8') as f:
+        report = json.load(f)
+
+    # 未打包的数据集条目（run_train.sh 使用），再登记打包版本
+    info = {}
+    if os.path.exists(dataset_info):
+        with open(dataset_info, 'r', encoding='utf-8') as f:
+            info = json.load(f)
+    info[params["dataset"]] = {
+        "file_name": os.path.relpath(alpaca_file, os.path.dirname(dataset_info)),
+        "columns": {"prompt": "instruction", "response": "output"},
+    }
+    with open(dataset_info, 'w', encoding='utf-8') as f:
+        json.dump(info, f, ensure_ascii=False, indent=2)
+    tokenized = os.path.join(pack_dir, "tokenized")
+    register_dataset(dataset_info, f"{params['dataset']}_packed", alpaca_file,
+                     tokenized if os.path.isdir(tokenized) else None, report,
+                     params["template"], params["cutoff_len"])
+
+
+def build_stages(args) -> List[Dict]:
+    """按命令行参数构造阶段列表（顺序即拓扑序）"""
+    name = args.name
+    problems_file = os.path.join(PIPELINE_ROOT, "problems.json")
+    raw_file = f"outputs/training_data/{name}.json"
+    valid_file = f"outputs/validation/{name}_valid_alpaca.json"
+    export_file = os.path.join(DATASET_DIR, f"{name}_alpaca.json")
+    pack_dir = f"outputs/packed/{name}-{args.cutoff_len}"
+    dataset_info = os.path.join(DATASET_DIR, "dataset_info.json")
+
+    train_args = load_train_args()
+    train_args.update({
+        "dataset_dir": DATASET_DIR,
+        "dataset": args.dataset,
+        "template": args.template,
+        "cutoff_len": str(args.cutoff_len),
+    })
+    train_command = ["llamafactory-cli", "train"]
+    if args.token_budget:
+        # 按 token 预算组批（length_sampler.py），LLaMA-Factory 参数不变
+        train_command = [PYTHON, "length_sampler.py", "train", "--max-tokens", str(args.token_budget)]
+    for key, value in train_args.items():
+        if key != "output_dir":
+            train_command += [f"--{key}", value]
+
+    stages = [
+        {
+            "name": "load_problems",
+            "deps": [],
+            "inputs": ["data/test-00000-of-00001.parquet"],
+            "code": local_modules("data_constructor.py", "pipeline.py"),
+            "outputs": [problems_file],
+            "run": _load_problems,
+        },
+        {
+            "name": "generate",
+            "deps": ["load_problems"],
+            "inputs": [problems_file],
+            "code": local_modules("data_constructor.py"),
+            "params": {"samples": args.samples, "edit_format": args.edit_format, "seed": args.seed},
+            "command": [PYTHON, "data_constructor.py", "--samples", str(args.samples), "--threads", str(args.threads),
+                        "--output", raw_file, "--problems", problems_file, "--edit-format", args.edit_format,
+                        "--seed", str(args.seed)],
+            "env": ["OPENAI_API_KEY"],
+            "outputs": [raw_file],
+        },
+        {
+            "name": "validate",
+            "deps": ["generate"],
+            "inputs": [raw_file],
+            "code": local_modules("batch_validator.py"),
+            "command": [PYTHON, "batch_validator.py", raw_file, "--output", valid_file],
+            "outputs": [valid_file],
+        },
+        {
+            "name": "export",
+            "deps": ["validate"],
+            "inputs": [valid_file],
+            "code": ["pipeline.py"],
+            "outputs": [export_file],
+            "run": _export,
+        },
+        {
+            "name": "pack",
+            "deps": ["validate"],
+            "inputs": [valid_file],
+            "code": local_modules("sequence_packing.py"),
+            "params": {"tokenizer": args.tokenizer},
+            "command": [PYTHON, "sequence_packing.py", valid_file, "--tokenizer", args.tokenizer,
+                        "--template", args.template, "--cutoff-len", str(args.cutoff_len), "--output-dir", pack_dir],
+            "outputs": [pack_dir],
+        },
+        {
+            "name": "register",
+            "deps": ["export", "pack"],
+            "inputs": [export_file, pack_dir],
+            "code": local_modules("sequence_packing.py", "pipeline.py"),
+            "params": {"dataset": args.dataset, "template": args.template, "cutoff_len": args.cutoff_len},
+            "outputs": [dataset_info],
+            "run": _register,
+        },
+        {
+            "name": "train",
+            "deps": ["register"],
+            "inputs": [export_file, dataset_info, TRAIN_SCRIPT],
+            "code": local_modules("length_sampler.py") if args.token_budget else [],
+            "command": train_command,
+            "outputs": [],
+        },
+    ]
+    # 训练输出目录按数据集名区分，不覆盖 run_train.sh 手动训练的结果
+    train = stages[-1]
+    train["output_dir"] = os.path.join(os.path.dirname(train_args.get("output_dir", "saves/lora/run")),
+                                       f"pipeline-{name}")
+    train["outputs"] = [train["output_dir"]]
+    return stages
+
+
+def select_stages(stages: List[Dict], until: Optional[str]) -> List[Dict]:
+    """只保留 until 及其上游"""
+    if until is None:
+        return stages
+    by_name = {stage["name"]: stage for stage in stages}
+    if until not in by_name:
+        raise ValueError(f"未知的阶段: {until} (可选: {', '.join(by_name)})")
+    keep, pending = set(), [until]
+    while pending:
+        name = pending.pop()
+        if name not in keep:
+            keep.add(name)
+            pending.extend(by_name[name]["deps"])
+    return [stage for stage in stages if stage["name"] in keep]
+
+
+# ==================== 执行 ====================
+
+def run_stage(stage: Dict, key: str) -> float:
+    """执行单个阶段，返回耗时；失败时抛出异常"""
+    missing = [name for name in stage.get("env", []) if not os.getenv(name)]
+    if missing:
+        raise RuntimeError(f"缺少环境变量: {', '.join(missing)}")
+
+    start_time = time.time()
+    if "run" in stage:
+        stage["run"](stage)
+    else:
+        command = list(stage["command"])
+        if stage["name"] == "train":
+            command += ["--output_dir", stage["output_dir"]]
+        log_file = os.path.join(PIPELINE_ROOT, "logs", f"{stage['name']}.log")
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        with open(log_file, 'w', encoding='utf-8') as log:
+            returncode = subprocess.call(command, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+        if returncode != 0:
+            raise RuntimeError(f"命令退出码 {returncode}，日志: {log_file}")
+    missing_outputs = [output for output in stage.get("outputs", []) if hash_path(output) is None]
+    if missing_outputs:
+        raise RuntimeError(f"阶段完成但缺少输出: {', '.join(missing_outputs)}")
+    seconds = time.time() - start_time
+    write_stamp(stage, key, seconds)
+    return seconds
+
+
+def run_pipeline(stages: List[Dict], jobs: int = 2, force: Optional[List[str]] = None,
+                 dry_run: bool = False, log: Callable[[str], None] = print) -> List[Dict]:
+    """
+    按依赖调度阶段：依赖全部完成的阶段并行执行
+
+    缓存键在依赖完成后才计算（上游输出是下游输入），上游重跑但输出不变时下游仍可跳过。
+    Returns:
+        list: 每个阶段的 {name, status, seconds, key}，status 为 cached/ran/failed/skipped/planned
+    """
+    force = set(force or [])
+    by_name = {stage["name"]: stage for stage in stages}
+    results = {name: {"name": name, "status": None, "seconds": 0.0, "key": None} for name in by_name}
+    done, failed = set(), set()
+    rerun = set()
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while len(done) + len(failed) < len(stages):
+            for stage in stages:
+                name = stage["name"]
+                if name in done or name in failed or name in running.values():
+                    continue
+                deps = [dep for dep in stage["deps"] if dep in by_name]
+                if any(dep in failed for dep in deps):
+                    results[name]["status"] = "skipped"
+                    failed.add(name)
+                    continue
+                if not all(dep in done for dep in deps):
+                    continue
+
+                key = stage_key(stage)
+                results[name]["key"] = key
+                # 上游在 --force 中或 dry-run 中将执行时输出尚未更新，不能按缓存判断
+                if any(dep in rerun for dep in deps) or name in force:
+                    rerun.add(name)
+                if name not in rerun and is_cached(stage, key):
+                    results[name]["status"] = "cached"
+                    log(f"⏭️  {name}: 输入未变，跳过")
+                    done.add(name)
+                    continue
+                if dry_run:
+                    results[name]["status"] = "planned"
+                    log(f"📋 {name}: 将执行")
+                    rerun.add(name)
+                    done.add(name)
+                    continue
+                log(f"▶️  {name}: 开始")
+                running[executor.submit(run_stage, stage, key)] = name
+
+            if not running:
+                continue
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    results[name]["seconds"] = future.result()
+                    results[name]["status"] = "ran"
+                    done.add(name)
+                    log(f"✅ {name}: 完成 ({results[name]['seconds']:.1f}s)")
+                except Exception as e:
+                    results[name]["status"] = "failed"
+                    results[name]["error"] = str(e)
+                    failed.add(name)
+                    log(f"❌ {name}: {e}")
+    return [results[stage["name"]] for stage in stages]
+
+
+def print_timing(results: List[Dict], wall_time: float):
+    labels = {"cached": "跳过(缓存)", "ran": "已执行", "failed": "失败", "skipped": "未执行(上游失败)",
+              "planned": "将执行"}
+    print(f"\n⏱️  流水线阶段耗时 (墙钟 {wall_time:.1f}s):")
+    for result in results:
+        print(f"   {result['name']:<14}{labels[result['status']]:<16}{result['seconds']:>8.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='按内容哈希缓存的数据生成/验证/打包/训练流水线')
+    parser.add_argument('--name', default='training_data_full_128', help='数据集文件名前缀 (默认: training_data_full_128)')
+    parser.add_argument('--dataset', default='training_data_livebench_code',
+                        help='登记到 dataset_info.json 并用于训练的数据集名 (默认: training_data_livebench_code)')
+    parser.add_argument('--samples', type=int, default=128, help='生成样本数 (默认: 128)')
+    parser.add_argument('--threads', type=int, default=32, help='生成线程数，不影响缓存 (默认: 32)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='生成随机种子 (data_constructor.py --seed)，改变它会重新生成 (默认: 0)')
+    parser.add_argument('--edit-format', choices=['full', 'diff'], default='full', help='editor 调用格式 (默认: full)')
+    parser.add_argument('--tokenizer', default='/home/share/models/Qwen2.5-3B', help='打包用的分词器')
+    parser.add_argument('--template', choices=['default', 'qwen'], default='default', help='训练模板 (默认: default)')
+    parser.add_argument('--cutoff-len', type=int, default=2048, help='训练 cutoff_len (默认: 2048)')
+    parser.add_argument('--token-budget', type=int, default=0,
+                        help='>0 时训练按每批 token 预算组批 (length_sampler.py train)，默认使用固定批大小')
+    parser.add_argument('--until', default=None, help='只执行到该阶段（含上游），如 register')
+    parser.add_argument('--force', nargs='*', default=[], help='强制重跑的阶段（下游随之重跑）')
+    parser.add_argument('--jobs', type=int, default=2, help='最大并行阶段数 (默认: 2)')
+    parser.add_argument('--dry-run', action='store_true', help='只显示各阶段是否会执行')
+    args = parser.parse_args()
+
+    stages = select_stages(build_stages(args), args.until)
+    print(f"🚀 流水线: {' -> '.join(stage['name'] for stage in stages)}")
+    start_time = time.time()
+    results = run_pipeline(stages, args.jobs, args.force, args.dry_run)
+    wall_time = time.time() - start_time
+    print_timing(results, wall_time)
+
+    os.makedirs(PIPELINE_ROOT, exist_ok=True)
+    with open(os.path.join(PIPELINE_ROOT, "last_run.json"), 'w', encoding='utf-8') as f:
+        json.dump({"args": vars(args), "wall_time_s": wall_time, "stages": results}, f, ensure_ascii=False, indent=2)
+
+    if any(result["status"] in ("failed", "skipped") for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+prompt_lookup.py - Prompt-lookup (n-gram) 投机解码
+
+EDIT 模式的 original_code / modified_code 几乎是用户查询中代码的原样拷贝，
+逐 token 解码这部分内容完全受显存带宽限制。Prompt-lookup 用上下文中最近一次
+匹配当前结尾 n-gram 的位置之后的 token 作为草稿，一次前向同时验证所有草稿 token：
+- transformers 后端：本模块的 prompt_lookup_generate（batch=1，支持贪心和采样，采样时按
+  投机采样规则接受，输出分布与普通解码一致）
+- vLLM 后端：使用引擎内置的 ngram 投机解码
+
+使用方法：
+    python prompt_lookup.py estimate hw3_2.json                    # 只用分词器，估算已有输出上的接受率
+    python prompt_lookup.py bench --backend transformers --model /path/to/model --queries hw3_2.json
+    python hw3_2.py run --speculative prompt-lookup                # 推理时启用
+"""
+
+import argparse
+import dataclasses
+import json
+import time
+from typing import Dict, List, Optional, Sequence
+
+DEFAULT_NUM_DRAFT_TOKENS = 10
+DEFAULT_MAX_NGRAM = 3
+
+
+def find_draft_tokens(token_ids: Sequence[int], max_ngram: int = DEFAULT_MAX_NGRAM,
+                      num_draft: int = DEFAULT_NUM_DRAFT_TOKENS, min_ngram: int = 1) -> List[int]:
+    """
+    在上下文中查找与结尾 n-gram 相同的最近一次出现，返回其后的 token 作为草稿
+
+    优先匹配更长的 n-gram；找不到时返回空列表。
+    """
+    length = len(token_ids)
+    for n in range(min(max_ngram, length - 1), min_ngram - 1, -1):
+        pattern = list(token_ids[length - n:])
+        # 从后往前找：最近的上下文更可能是正在拷贝的那段代码
+        for start in range(length - n - 1, -1, -1):
+            if token_ids[start] == pattern[0] and list(token_ids[start:start + n]) == pattern:
+                draft = list(token_ids[start + n:start + n + num_draft])
+                if draft:
+                    return draft
+    return []
+
+
+def estimate_acceptance(prompt_ids: Sequence[int], output_ids: Sequence[int],
+                        max_ngram: int = DEFAULT_MAX_NGRAM,
+                        num_draft: int = DEFAULT_NUM_DRAFT_TOKENS) -> Dict:
+    """
+    在已知输出上回放 prompt-lookup：统计草稿数、接受数和所需前向次数
+
+    对贪心解码这就是真实的接受情况；与后端无关，可用于 vLLM 结果和已有的 hw3_2.json。
+    """
+    context = list(prompt_ids)
+    output = list(output_ids)
+    position = proposed = accepted = forward_passes = 0
+
+    while position < len(output):
+        draft = find_draft_tokens(context + output[:position], max_ngram, num_draft)
+        matched = 0
+        for draft_token, actual_token in zip(draft, output[position:]):
+            if draft_token != actual_token:
+                break
+            matched += 1
+        proposed += len(draft)
+        accepted += matched
+        # 一次前向：接受 matched 个草稿 token，再额外产出 1 个 token
+        position += matched + 1
+        forward_passes += 1
+
+    return {
+        "output_tokens": len(output),
+        "proposed": proposed,
+        "accepted": accepted,
+        "forward_passes": forward_passes,
+    }
+
+
+def summarize_acceptance(stats: List[Dict]) -> Dict:
+    """汇总多条序列的接受情况；tokens_per_pass 即不计验证开销时的理论加速比"""
+    output_tokens = sum(s["output_tokens"] for s in stats)
+    proposed = sum(s["proposed"] for s in stats)
+    accepted = sum(s["accepted"] for s in stats)
+    passes = sum(s["forward_passes"] for s in stats)
+    return {
+        "sequences": len(stats),
+        "output_tokens": output_tokens,
+        "proposed": proposed,
+        "accepted": accepted,
+        "acceptance_rate": accepted / proposed if proposed else 0.0,
+        "tokens_per_pass": output_tokens / passes if passes else 0.0,
+    }
+
+
+# ==================== transformers 实现 ====================
+
+def _crop_cache(cache, max_length: int):
+    """丢弃 KV cache 中 max_length 之后的位置（被拒绝的草稿）"""
+    if hasattr(cache, "crop"):
+        cache.crop(max_length)
+        return cache
+    return tuple(tuple(tensor[..., :max_length, :] for tensor in layer) for layer in cache)
+
+
+def _filtered_probs(torch, logits, temperature: float, top_p: float):
+    """temperature + top-p 过滤后的概率分布 (..., V)"""
+    probs = torch.softmax(logits.float() / max(temperature, 1e-5), dim=-1)
+    sorted_probs, sorted_index = probs.sort(dim=-1, descending=True)
+    cumulative = sorted_probs.cumsum(dim=-1)
+    sorted_probs[(cumulative - sorted_probs) > top_p] = 0.0
+    filtered = torch.zeros_like(probs).scatter(-1, sorted_index, sorted_probs)
+    return filtered / filtered.sum(dim=-1, keepdim=True)
+
+
+def prompt_lookup_generate(model, prompt_ids: Sequence[int], eos_token_ids: Sequence[int],
+                           max_tokens: int = 2048, temperature: float = 0.0, top_p: float = 1.0,
+                           num_draft: int = DEFAULT_NUM_DRAFT_TOKENS, max_ngram: int = DEFAULT_MAX_NGRAM,
+                           stop_token_ids: Optional[Sequence[int]] = None, generator=None) -> Dict:
+    """
+    单条序列的 prompt-lookup 投机解码
+
+    每轮把"上一个未进入 cache 的 token + 草稿"一次送入模型，得到 k+1 个位置的分布：
+    - 贪心：草稿 token 等于 argmax 即接受
+    - 采样：以目标概率 p(draft) 接受；拒绝时从去掉该 token 后重新归一化的分布中采样
+    第一个被拒绝的位置之后的草稿和 KV cache 全部丢弃。
+
+    Returns:
+        dict: {"token_ids", "finish_reason", "proposed", "accepted", "forward_passes", "first_token_time"}
+    """
+    import torch
+
+    device = next(model.parameters()).device
+    stop_ids = set(eos_token_ids) | set(stop_token_ids or [])
+    tokens = list(prompt_ids)
+    prompt_len = len(tokens)
+    cache = None
+    proposed = accepted = forward_passes = 0
+    first_token_time = None
+    finish_reason = "length"
+
+    with torch.no_grad():
+        # 预填充除最后一个 token 外的 prompt，最后一个 token 在第一轮与草稿一起送入
+        if prompt_len > 1:
+            out = model(input_ids=torch.tensor([tokens[:-1]], device=device), use_cache=True)
+            cache = out.past_key_values
+
+        while len(tokens) - prompt_len < max_tokens:
+            remaining = max_tokens - (len(tokens) - prompt_len)
+            draft = find_draft_tokens(tokens, max_ngram, min(num_draft, remaining - 1)) if remaining > 1 else []
+            step_input = torch.tensor([[tokens[-1]] + draft], device=device)
+            out = model(input_ids=step_input, past_key_values=cache, use_cache=True)
+            cache = out.past_key_values
+            logits = out.logits[0]  # (1 + k, V)
+            forward_passes += 1
+            proposed += len(draft)
+
+            if temperature <= 0:
+                targets = logits.argmax(dim=-1).tolist()
+                matched = 0
+                while matched < len(draft) and draft[matched] == targets[matched]:
+                    matched += 1
+                next_token = targets[matched]
+            else:
+                probs = _filtered_probs(torch, logits, temperature, top_p)
+                matched = 0
+                while matched < len(draft):
+                    p_draft = probs[matched, draft[matched]].item()
+                    if torch.rand(1, generator=generator, device=probs.device).item() >= p_draft:
+                        break
+                    matched += 1
+                residual = probs[matched].clone()
+                if matched < len(draft):
+                    residual[draft[matched]] = 0.0
+                    residual = residual / residual.sum() if residual.sum() > 0 else probs[matched]
+                next_token = torch.multinomial(residual, 1, generator=generator).item()
+
+            accepted += matched
+            # cache 中保留 "已有 token + 接受的草稿"，next_token 作为下一轮的输入
+            cache = _crop_cache(cache, len(tokens) + matched)
+            new_tokens = draft[:matched] + [next_token]
+            if first_token_time is None:
+                first_token_time = time.time()
+
+            stopped = False
+            for token_id in new_tokens:
+                tokens.append(token_id)
+                if token_id in stop_ids:
+                    finish_reason, stopped = "stop", True
+                    break
+                if len(tokens) - prompt_len >= max_tokens:
+                    break
+            if stopped:
+                break
+
+    return {
+        "token_ids": tokens[prompt_len:],
+        "finish_reason": finish_reason,
+        "proposed": proposed,
+        "accepted": accepted,
+        "forward_passes": forward_passes,
+        "first_token_time": first_token_time,
+    }
+
+
+# ==================== vLLM 配置 ====================
+
+def vllm_prompt_lookup_kwargs(num_draft: int = DEFAULT_NUM_DRAFT_TOKENS,
+                              max_ngram: int = DEFAULT_MAX_NGRAM) -> Dict:
+    """生成 vLLM ngram 投机解码的引擎参数，兼容新旧两种参数形式"""
+    from vllm.engine.arg_utils import EngineArgs
+
+    fields = {field.name for field in dataclasses.fields(EngineArgs)}
+    if "speculative_model" in fields:
+        # 旧版本 (<= 0.8)
+        return {
+            "speculative_model": "[ngram]",
+            "num_speculative_tokens": num_draft,
+            "ngram_prompt_lookup_max": max_ngram,
+        }
+    return {
+        "speculative_config": {
+            "method": "ngram",
+            "num_speculative_tokens": num_draft,
+            "prompt_lookup_max": max_ngram,
+            "prompt_lookup_min": 1,
+        }
+    }
+
+
+# ==================== 命令行 ====================
+
+def _load_workload(path: str) -> List[Dict]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _print_acceptance(title: str, summary: Dict):
+    print(f"   {title}: 序列 {summary['sequences']}, 输出 {summary['output_tokens']} token, "
+          f"接受率 {summary['acceptance_rate']*100:.1f}%, 每次前向 {summary['tokens_per_pass']:.2f} token")
+
+
+def run_estimate(args):
+    """用已有的 Query/Output 回放 prompt-lookup，按 AGENT/EDIT 模式统计接受率"""
+    from hw3_2 import encode_prompt, generate_prompt, get_tokenizer
+    from inference_metrics import detect_mode
+
+    tokenizer = get_tokenizer()
+    by_mode: Dict[str, List[Dict]] = {}
+    for item in _load_workload(args.workload):
+        prompt_ids = encode_prompt(generate_prompt(item["Query"]))
+        output_ids = tokenizer.encode(item["Output"], add_special_tokens=False)
+        stats = estimate_acceptance(prompt_ids, output_ids, args.prompt_lookup_max, args.num_draft_tokens)
+        by_mode.setdefault(detect_mode(item["Output"]), []).append(stats)
+
+    print(f"📊 Prompt-lookup 接受率估算 ({args.workload}, 草稿 {args.num_draft_tokens}, n-gram ≤ {args.prompt_lookup_max}):")
+    for mode, stats in sorted(by_mode.items()):
+        _print_acceptance(mode, summarize_acceptance(stats))
+    _print_acceptance("ALL", summarize_acceptance([s for stats in by_mode.values() for s in stats]))
+
+
+def run_bench(args):
+    """在同一批查询上对比普通解码与 prompt-lookup 解码的墙钟时间"""
+    from hw3_2 import TOKENIZER_PATH, encode_prompt, generate_prompt, get_tokenizer
+    from inference_backends import create_backend
+
+    workload = _load_workload(args.queries)
+    prompt_ids = [encode_prompt(generate_prompt(item["Query"])) for item in workload]
+    sampling = {"temperature": args.temperature, "top_p": args.top_p, "max_tokens": args.max_tokens}
+    get_tokenizer()
+    timings = {}
+
+    for speculative in (None, "prompt-lookup"):
+        label = speculative or "baseline"
+        kwargs = {"speculative": speculative, "num_draft_tokens": args.num_draft_tokens,
+                  "prompt_lookup_max": args.prompt_lookup_max}
+        if args.backend == "transformers":
+            kwargs.update({"device": args.device, "dtype": args.dtype})
+        engine = create_backend(args.backend, args.model, TOKENIZER_PATH, **kwargs)
+        start_time = time.time()
+        results = engine.generate(prompt_ids, sampling)
+        elapsed = time.time() - start_time
+        engine.close()
+
+        output_tokens = sum(len(r["outputs"][0]["token_ids"]) for r in results)
+        timings[label] = elapsed
+        print(f"⏱️  {label}: {elapsed:.2f} 秒, {output_tokens / elapsed:.1f} token/s")
+
+        if speculative is None:
+            # 基线输出上回放草稿匹配，得到与后端无关的接受率（贪心时精确）
+            replay = [
+                estimate_acceptance(ids, r["outputs"][0]["token_ids"], args.prompt_lookup_max, args.num_draft_tokens)
+                for ids, r in zip(prompt_ids, results)
+            ]
+            _print_acceptance("回放估算", summarize_acceptance(replay))
+        elif results and "speculative" in results[0]:
+            measured = [r["speculative"] for r in results]
+            _print_acceptance("实测", summarize_acceptance(measured))
+
+    print(f"🚀 加速比: {timings['baseline'] / timings['prompt-lookup']:.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prompt-lookup (n-gram) 投机解码：接受率估算与加速对比')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    estimate_parser = subparsers.add_parser('estimate', help='在已有输出上估算接受率（只需分词器）')
+    estimate_parser.add_argument('workload', nargs='?', default='hw3_2.json', help='Query/Output 文件 (默认: hw3_2.json)')
+
+    bench_parser = subparsers.add_parser('bench', help='实际运行普通解码和投机解码并对比')
+    bench_parser.add_argument('--backend', choices=['vllm', 'transformers'], default='vllm')
+    bench_parser.add_argument('--model', required=True, help='模型路径')
+    bench_parser.add_argument('--queries', default='hw3_2.json', help='查询文件 (默认: hw3_2.json)')
+    bench_parser.add_argument('--device', default='cpu')
+    bench_parser.add_argument('--dtype', default='float32')
+    bench_parser.add_argument('--temperature', type=float, default=0.0, help='默认贪心，便于对比')
+    bench_parser.add_argument('--top-p', type=float, default=1.0)
+    bench_parser.add_argument('--max-tokens', type=int, default=2048)
+
+    for sub in (estimate_parser, bench_parser):
+        sub.add_argument('--num-draft-tokens', type=int, default=DEFAULT_NUM_DRAFT_TOKENS, help='每轮草稿 token 数')
+        sub.add_argument('--prompt-lookup-max', type=int, default=DEFAULT_MAX_NGRAM, help='最长匹配 n-gram')
+
+    args = parser.parse_args()
+    if args.command == 'estimate':
+        run_estimate(args)
+    else:
+        run_bench(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+prompt_store.py - hw3_2 预分词 prompt 存储
+
+prepare 步骤把每个查询渲染为对话模板，并用 tokenizer_with_special_tokens 分批分词一次，
+结果写入 token_store（扁平 uint32 + offsets 索引），目录按分词器哈希和模板哈希区分：
+    outputs/prompt_store/<查询文件名>-<分词器哈希[:12]>-<模板哈希[:12]>/
+
+推理时直接从内存映射数组读取 prompt_token_ids，跳过模板渲染和分词。
+"""
+
+import json
+import os
+from typing import Callable, Dict, List, Optional, Tuple
+
+from token_store import (
+    TokenStore, read_manifest, sha256_file, sha256_text,
+    special_token_ids, tokenizer_hash, write_token_store,
+)
+
+PROMPT_STORE_ROOT = "outputs/prompt_store"
+
+
+def template_hash(tokenizer, system_prompt: str, tools: Optional[List[Dict]] = None) -> str:
+    """对话模板 + 系统提示词 (+ 工具定义) 的哈希，任何一项变化都会得到新的存储"""
+    payload = {
+        "chat_template": getattr(tokenizer, "chat_template", None),
+        "system_prompt": system_prompt,
+        "tools": tools,
+    }
+    return sha256_text(json.dumps(payload, ensure_ascii=False, sort_keys=True))
+
+
+def prompt_store_dir(query_file: str, tok_hash: str, tpl_hash: str, root: str = PROMPT_STORE_ROOT) -> str:
+    stem = os.path.splitext(os.path.basename(query_file))[0]
+    return os.path.join(root, f"{stem}-{tok_hash[:12]}-{tpl_hash[:12]}")
+
+
+def prepare_prompt_store(query_file: str, tokenizer, render_prompt: Callable[[str], str],
+                         system_prompt: str, root: str = PROMPT_STORE_ROOT,
+                         batch_size: int = 1024) -> Tuple[str, Dict]:
+    """
+    渲染并分词查询文件中的所有查询，写入 prompt 存储
+
+    Args:
+        query_file: 查询文件 (hw3_2 格式，[{"Query": ...}])
+        tokenizer: 带特殊词符的分词器
+        render_prompt: 查询 -> 渲染后的 prompt 文本
+        system_prompt: 系统提示词（参与模板哈希）
+        batch_size: 每批送入快速分词器的 prompt 数
+
+    Returns:
+        tuple: (存储目录, manifest)
+    """
+    with open(query_file, 'r', encoding='utf-8') as f:
+        queries = json.load(f)
+
+    tok_hash = tokenizer_hash(tokenizer)
+    tpl_hash = template_hash(tokenizer, system_prompt)
+    store_dir = prompt_store_dir(query_file, tok_hash, tpl_hash, root)
+
+    def encoded_prompts():
+        for start in range(0, len(queries), batch_size):
+            texts = [render_prompt(item["Query"]) for item in queries[start:start + batch_size]]
+            # 快速分词器的批量接口在 Rust 侧并行分词
+            yield from tokenizer(texts, add_special_tokens=False)["input_ids"]
+
+    manifest = write_token_store(store_dir, encoded_prompts(), {
+        "kind": "prompt_store",
+        "query_file": query_file,
+        "query_sha256": sha256_file(query_file),
+        "tokenizer_hash": tok_hash,
+        "template_hash": tpl_hash,
+        "special_token_ids": special_token_ids(tokenizer),
+    })
+    return store_dir, manifest
+
+
+def find_prompt_store(query_file: str, tokenizer, system_prompt: str,
+                      root: str = PROMPT_STORE_ROOT) -> Optional[TokenStore]:
+    """查找与查询文件、分词器、模板都匹配的 prompt 存储，找不到或已过期时返回 None"""
+    tok_hash = tokenizer_hash(tokenizer)
+    tpl_hash = template_hash(tokenizer, system_prompt)
+    return open_prompt_store(prompt_store_dir(query_file, tok_hash, tpl_hash, root), query_file,
+                             tokenizer, system_prompt)
+
+
+def open_prompt_store(store_dir: str, query_file: str, tokenizer, system_prompt: str) -> Optional[TokenStore]:
+    """
+    打开指定的 prompt 存储，并确认它是由当前内容的查询文件、当前分词器和模板生成的
+
+    目录名只包含哈希前缀，显式指定的目录也可能来自其他 --edit-format 或分词器，因此总是核对 manifest。
+    """
+    manifest = read_manifest(store_dir)
+    if manifest is None or manifest.get("query_sha256") != sha256_file(query_file):
+        return None
+    if manifest.get("tokenizer_hash") != tokenizer_hash(tokenizer):
+        return None
+    if manifest.get("template_hash") != template_hash(tokenizer, system_prompt):
+        return None
+    return TokenStore(store_dir)
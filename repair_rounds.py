@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+repair_rounds.py - 校验在环的批量修复轮次
+
+每个输出一生成完就用 output_checker.check_single_output 校验：
+- 第 0 轮：所有 prompt 按原采样参数生成
+- 第 1..N 轮：只重新提交未通过的 prompt，使用更低的 temperature 和 n-best 采样，
+  取第一个通过校验的候选
+直到通过率达到目标或达到轮数上限。每一轮记录生成 token 数、耗时和
+"有效输出 / GPU 小时"，用于衡量修复的成本。
+"""
+
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from output_checker import check_single_output
+
+
+def is_valid_output(text: str) -> bool:
+    """通过 output_checker 的全部检查项即为有效"""
+    return not check_single_output(text, 0)['issues']
+
+
+def run_repair_rounds(engine, prompt_ids: List[Sequence[int]], base_sampling: Dict, repair_sampling: Dict,
+                      max_rounds: int = 0, target_pass_rate: float = 1.0,
+                      num_gpus: int = 1,
+                      on_result: Optional[Callable[[int, int, Dict], None]] = None) -> Tuple[List[str], List[Dict]]:
+    """
+    批量生成并对失败的 prompt 进行多轮修复
+
+    Args:
+        engine: 推理后端（需要支持 generate_iter）
+        prompt_ids: 所有 prompt 的 token ID
+        base_sampling: 第 0 轮采样参数
+        repair_sampling: 修复轮采样参数（通常更低 temperature、n > 1）
+        max_rounds: 修复轮数上限，0 表示只生成不修复
+        target_pass_rate: 达到该通过率后停止修复
+        num_gpus: 参与推理的 GPU 数，用于折算 GPU 小时
+        on_result: 每个请求完成时回调 (轮次, prompt 下标, 结果)，用于记录遥测
+
+    Returns:
+        tuple: (每个 prompt 的最终输出文本, 每一轮的统计)
+    """
+    total = len(prompt_ids)
+    texts = [''] * total
+    passed = [False] * total
+    pending = list(range(total))
+    rounds = []
+    total_elapsed = 0.0
+
+    for round_index in range(max_rounds + 1):
+        sampling = base_sampling if round_index == 0 else repair_sampling
+        start_time = time.time()
+        generated_tokens = 0
+        candidates = 0
+        repaired = 0
+
+        for local_index, result in engine.generate_iter([prompt_ids[i] for i in pending], sampling):
+            index = pending[local_index]
+            if on_result is not None:
+                on_result(round_index, index, result)
+            outputs = result["outputs"]
+            candidates += len(outputs)
+            generated_tokens += sum(len(output["token_ids"]) for output in outputs)
+
+            chosen = next((output for output in outputs if is_valid_output(output["text"])), None)
+            if chosen is not None:
+                texts[index] = chosen["text"]
+                passed[index] = True
+                repaired += 1
+            elif round_index == 0:
+                # 第 0 轮即使未通过也保留输出；后续轮次失败时保留之前的结果
+                texts[index] = outputs[0]["text"]
+
+        elapsed = time.time() - start_time
+        total_elapsed += elapsed
+        passed_count = sum(passed)
+        gpu_hours = total_elapsed * num_gpus / 3600
+        rounds.append({
+            "round": round_index,
+            "submitted": len(pending),
+            "candidates": candidates,
+            "passed": repaired,
+            "generated_tokens": generated_tokens,
+            "elapsed_seconds": round(elapsed, 3),
+            "cumulative_pass_rate": passed_count / total if total else 0.0,
+            "cumulative_gpu_hours": gpu_hours,
+            "valid_per_gpu_hour": passed_count / gpu_hours if gpu_hours > 0 else 0.0,
+        })
+
+        pending = [index for index in pending if not passed[index]]
+        if not pending or passed_count / total >= target_pass_rate:
+            break
+
+    return texts, rounds
+
+
+def print_round_report(rounds: List[Dict]):
+    """打印每一轮的成本和收益"""
+    print("\n📊 修复轮次统计:")
+    print(f"   {'轮次':>4} {'提交':>6} {'候选':>6} {'通过':>6} {'生成token':>10} {'耗时(s)':>9} {'累计通过率':>10} {'有效/GPU时':>11}")
+    for r in rounds:
+        print(f"   {r['round']:>4} {r['submitted']:>6} {r['candidates']:>6} {r['passed']:>6} "
+              f"{r['generated_tokens']:>10} {r['elapsed_seconds']:>9.2f} "
+              f"{r['cumulative_pass_rate']*100:>9.1f}% {r['valid_per_gpu_hour']:>11.1f}")
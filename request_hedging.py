@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+request_hedging.py - API 请求对冲 (hedged requests)，降低数据生成的尾延迟
+
+少数 GPT 调用会一直拖到 30 秒超时，整批生成要等它们结束。开启对冲后：
+- 按阶段（生成错误代码 / 生成输出）实时统计最近请求的延迟分位数
+- 请求运行超过该阶段的 p95 仍未返回时，再发送一个相同的请求，先返回的结果胜出
+- 对冲请求数不超过总请求数的 max_hedge_rate，控制额外的 API 费用
+- 落败的请求：尚未开始的直接取消；已发出的 HTTP 请求无法从同步客户端中止，
+  其结果被丢弃，但延迟仍会记录，用于估计「不对冲时」的尾延迟
+- 失败的原始请求（尤其是超时）同样记录耗时，并单独计数，尾延迟统计不会漏掉它们
+
+使用方法：
+    python data_constructor.py --samples 128 --hedge --hedge-max-rate 0.1
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError, wait
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+
+def _percentiles(values: List[float]) -> Optional[Dict]:
+    if not values:
+        return None
+    array = np.asarray(values, dtype=np.float64)
+    return {
+        "p50": float(np.percentile(array, 50)),
+        "p95": float(np.percentile(array, 95)),
+        "p99": float(np.percentile(array, 99)),
+        "max": float(array.max()),
+    }
+
+
+def _is_timeout(error: BaseException) -> bool:
+    """TimeoutError 以及 openai.APITimeoutError / httpx.TimeoutException 等（按类名判断，不依赖这些库）"""
+    return isinstance(error, TimeoutError) or any("Timeout" in cls.__name__ for cls in type(error).__mro__)
+
+
+class HedgedCaller:
+    """线程安全的对冲调用器：call(stage, fn, ...) 返回最先成功的结果"""
+
+    def __init__(self, max_hedge_rate: float = 0.1, quantile: float = 95.0, min_samples: int = 20,
+                 window: int = 500, max_workers: int = 64):
+        self.max_hedge_rate = max_hedge_rate
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.window = window
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge")
+        self.lock = threading.Lock()
+        self.stages: Dict[str, Dict] = {}
+
+    def _stage(self, stage: str) -> Dict:
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = {
+                    "recent": deque(maxlen=self.window),  # 最近的原始请求延迟，用于对冲阈值
+                    "primary_latency": [],                # 所有原始请求的延迟（含落败的）
+                    "effective_latency": [],              # 调用方实际等待的时间
+                    "calls": 0,
+                    "hedged": 0,
+                    "hedge_wins": 0,
+                    "primary_errors": 0,                  # 失败的原始请求（含超时）
+                    "primary_timeouts": 0,
+                }
+            return self.stages[stage]
+
+    def hedge_delay(self, stage: str) -> Optional[float]:
+        """当前的对冲阈值；样本不足时返回 None（不对冲）"""
+        stats = self._stage(stage)
+        with self.lock:
+            if len(stats["recent"]) < self.min_samples:
+                return None
+            return float(np.percentile(np.asarray(stats["recent"]), self.quantile))
+
+    def _try_reserve_hedge(self, stats: Dict) -> bool:
+        with self.lock:
+            if stats["hedged"] + 1 > self.max_hedge_rate * stats["calls"]:
+                return False
+            stats["hedged"] += 1
+            return True
+
+    def _record_primary(self, stats: Dict, start_time: float, future):
+        """
+        原始请求结束时（无论是否胜出）记录其延迟
+
+        失败的请求也记录耗时：超时正是要统计的尾部，同时计入对冲阈值的样本；
+        其他错误通常很快返回，只计入延迟分布，不拉低阈值。
+        """
+        if future.cancelled():
+            return
+        latency = time.perf_counter() - start_time
+        error = future.exception()
+        with self.lock:
+            if error is not None:
+                stats["primary_errors"] += 1
+                if _is_timeout(error):
+                    stats["primary_timeouts"] += 1
+                    stats["recent"].append(latency)
+            else:
+                stats["recent"].append(latency)
+            stats["primary_latency"].append(latency)
+
+    def call(self, stage: str, fn: Callable, *args, **kwargs):
+        stats = self._stage(stage)
+        with self.lock:
+            stats["calls"] += 1
+        start_time = time.perf_counter()
+        try:
+            return self._call(stats, stage, start_time, fn, *args, **kwargs)
+        finally:
+            # 失败的调用同样计入调用方实际等待的时间
+            self._record_effective(stats, start_time)
+
+    def _call(self, stats: Dict, stage: str, start_time: float, fn: Callable, *args, **kwargs):
+        primary = self.executor.submit(fn, *args, **kwargs)
+        primary.add_done_callback(lambda future: self._record_primary(stats, start_time, future))
+
+        delay = self.hedge_delay(stage)
+        try:
+            return primary.result(timeout=delay)
+        except TimeoutError:
+            # 原始请求自己抛出的超时直接交给调用方，只有等待超过阈值才对冲
+            if primary.done():
+                raise
+
+        if not self._try_reserve_hedge(stats):
+            return primary.result()
+
+        hedge = self.executor.submit(fn, *args, **kwargs)
+        pending, last_error = {primary, hedge}, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    last_error = future.exception()
+                    continue
+                for other in pending:
+                    other.cancel()
+                with self.lock:
+                    stats["hedge_wins"] += future is hedge
+                return future.result()
+        raise last_error
+
+    def _record_effective(self, stats: Dict, start_time: float):
+        with self.lock:
+            stats["effective_latency"].append(time.perf_counter() - start_time)
+
+    def summary(self) -> Dict:
+        """每个阶段的对冲次数、胜出次数，以及不对冲 (原始请求) 与实际等待的延迟分位数"""
+        report = {}
+        with self.lock:
+            for stage, stats in self.stages.items():
+                primary = _percentiles(stats["primary_latency"])
+                effective = _percentiles(stats["effective_latency"])
+                report[stage] = {
+                    "calls": stats["calls"],
+                    "hedged": stats["hedged"],
+                    "hedge_rate": stats["hedged"] / stats["calls"] if stats["calls"] else 0.0,
+                    "hedge_wins": stats["hedge_wins"],
+                    "primary_errors": stats["primary_errors"],
+                    "primary_timeouts": stats["primary_timeouts"],
+                    "primary_latency_s": primary,
+                    "effective_latency_s": effective,
+                    "p99_reduction": (1 - effective["p99"] / primary["p99"])
+                    if primary and effective and primary["p99"] else None,
+                }
+        return report
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def print_hedge_summary(report: Dict):
+    print("\n⚡ 请求对冲统计:")
+    for stage, stats in report.items():
+        primary, effective = stats["primary_latency_s"], stats["effective_latency_s"]
+        line = (f"   {stage}: {stats['calls']} 次调用, 对冲 {stats['hedged']} 次 ({stats['hedge_rate'] * 100:.1f}%), "
+                f"对冲胜出 {stats['hedge_wins']} 次, 原始请求失败 {stats['primary_errors']} 次 "
+                f"(超时 {stats['primary_timeouts']} 次)")
+        if primary and effective:
+            line += (f"; p95 {primary['p95']:.2f}s -> {effective['p95']:.2f}s, "
+                     f"p99 {primary['p99']:.2f}s -> {effective['p99']:.2f}s")
+        print(line)
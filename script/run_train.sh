@@ -1,4 +1,10 @@
-llamafactory-cli train \
+# TOKEN_BUDGET=16384 ./script/run_train.sh  按每批 token 预算组批 (length_sampler.py)，其余参数不变
+TRAIN_CMD="llamafactory-cli train"
+if [ -n "$TOKEN_BUDGET" ]; then
+    TRAIN_CMD="python3 length_sampler.py train --max-tokens $TOKEN_BUDGET"
+fi
+
+$TRAIN_CMD \
     --stage sft \
     --do_train True \
     --model_name_or_path /home/share/models/Qwen2.5-3B \
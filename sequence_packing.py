@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+sequence_packing.py - SFT 序列打包数据集构建
+
+把 batch_validator.py / data_constructor.py 输出的 alpaca 数据分词后，
+用首次适应递减（FFD）装箱把多条样本拼进 cutoff_len（默认 2048）长度的序列：
+- attention_mask 写为样本序号 1, 2, 3...（LLaMA-Factory neat_packing 的格式），
+  配合块对角注意力，样本之间互不可见
+- position_ids 在每条样本开头重新从 0 开始
+- labels 中 prompt 部分为 -100，只在回复上计算损失
+
+输出目录：
+    <output_dir>/samples/       样本级 token 存储（prompt_lengths / source_index 附加数组）
+    <output_dir>/pack_index/    每条打包序列包含的样本下标（token 存储格式）
+    <output_dir>/tokenized/     HF datasets 格式，可直接作为 llamafactory-cli --tokenized_path
+    <output_dir>/packing_report.json
+
+使用方法：
+    python sequence_packing.py outputs/validation/training_data_full_128_valid_alpaca.json --register
+"""
+
+import argparse
+import json
+import os
+import time
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+import numpy as np
+
+from dataset_shards import dataset_sha256, load_alpaca
+from token_store import (
+    TokenStore, special_token_ids, tokenizer_hash, write_token_store,
+)
+from tokenizer_registry import get_tokenizer
+
+# 与 script/run_train.sh 保持一致
+DEFAULT_TOKENIZER = "/home/share/models/Qwen2.5-3B"
+DEFAULT_TEMPLATE = "default"
+DEFAULT_CUTOFF_LEN = 2048
+DEFAULT_BATCH_SIZE = 8
+PACKED_ROOT = "outputs/packed"
+DATASET_INFO = "training_data/dataset_info.json"
+IGNORE_INDEX = -100
+
+
+def render_sample(tokenizer, item: Dict, template: str) -> Tuple[str, str]:
+    """
+    按训练模板渲染一条 alpaca 样本
+
+    Args:
+        template: 'default'（LLaMA-Factory default 模板）或 'qwen'（分词器自带的对话模板）
+
+    Returns:
+        tuple: (prompt 文本, 回复文本)
+    """
+    instruction = item["instruction"]
+    if item.get("input"):
+        instruction = instruction + "\n" + item["input"]
+
+    if template == "default":
+        eos = tokenizer.eos_token
+        return f"Human: {instruction}{eos}\nAssistant:", f"{item['output']}{eos}\n"
+    elif template == "qwen":
+        prompt = tokenizer.apply_chat_template(
+            [{"role": "user", "content": instruction}], tokenize=False, add_generation_prompt=True
+        )
+        return prompt, f"{item['output']}<|im_end|>\n"
+    raise ValueError(f"未知的模板: {template} (可选: default, qwen)")
+
+
+def infer_seqlen(source_len: int, target_len: int, cutoff_len: int) -> Tuple[int, int]:
+    """超长样本的截断分配，与 LLaMA-Factory 的做法一致"""
+    if target_len * 2 < cutoff_len:
+        max_target_len = cutoff_len
+    elif source_len * 2 < cutoff_len:
+        max_target_len = cutoff_len - source_len
+    else:
+        max_target_len = int(cutoff_len * (target_len / (source_len + target_len)))
+    new_target_len = min(max_target_len, target_len)
+    new_source_len = min(max(cutoff_len - new_target_len, 0), source_len)
+    return new_source_len, new_target_len
+
+
+def tokenize_samples(tokenizer, data: List[Dict], template: str, cutoff_len: int,
+                     batch_size: int = 1024) -> Iterator[Tuple[int, List[int], int, bool]]:
+    """
+    批量分词 alpaca 样本
+
+    Yields:
+        tuple: (源数据下标, token ID, prompt 长度, 是否被截断)
+    """
+    for start in range(0, len(data), batch_size):
+        chunk = data[start:start + batch_size]
+        rendered = [render_sample(tokenizer, item, template) for item in chunk]
+        prompt_ids = tokenizer([p for p, _ in rendered], add_special_tokens=False)["input_ids"]
+        response_ids = tokenizer([r for _, r in rendered], add_special_tokens=False)["input_ids"]
+        for offset, (source, target) in enumerate(zip(prompt_ids, response_ids)):
+            source_len, target_len = infer_seqlen(len(source), len(target), cutoff_len)
+            truncated = source_len < len(source) or target_len < len(target)
+            yield start + offset, source[:source_len] + target[:target_len], source_len, truncated
+
+
+class _MaxSegmentTree:
+    """叶子为各箱剩余容量的最大值线段树，O(log n) 找到第一个放得下的箱"""
+
+    def __init__(self, num_leaves: int, capacity: int):
+        self.size = 1
+        while self.size < num_leaves:
+            self.size *= 2
+        self.tree = [0] * (2 * self.size)
+        for i in range(num_leaves):
+            self.tree[self.size + i] = capacity
+        for i in range(self.size - 1, 0, -1):
+            self.tree[i] = max(self.tree[2 * i], self.tree[2 * i + 1])
+
+    def first_fit(self, need: int) -> int:
+        if self.tree[1] < need:
+            return -1
+        node = 1
+        while node < self.size:
+            node = 2 * node if self.tree[2 * node] >= need else 2 * node + 1
+        return node - self.size
+
+    def consume(self, leaf: int, amount: int):
+        node = self.size + leaf
+        self.tree[node] -= amount
+        node //= 2
+        while node:
+            self.tree[node] = max(self.tree[2 * node], self.tree[2 * node + 1])
+            node //= 2
+
+
+def first_fit_decreasing(lengths: Sequence[int], capacity: int) -> List[List[int]]:
+    """
+    首次适应递减装箱
+
+    按长度从长到短依次放入第一个剩余容量足够的箱；未使用的箱剩余容量为满，
+    所以放不进已有箱时自然会打开下一个新箱。
+
+    Returns:
+        list: 每个箱包含的样本下标
+    """
+    order = np.argsort(-np.asarray(lengths, dtype=np.int64), kind="stable")
+    tree = _MaxSegmentTree(max(len(lengths), 1), capacity)
+    bins: List[List[int]] = []
+    for index in order:
+        length = int(lengths[index])
+        if length > capacity:
+            raise ValueError(f"样本 {index} 长度 {length} 超过 cutoff_len {capacity}")
+        leaf = tree.first_fit(length)
+        tree.consume(leaf, length)
+        if leaf == len(bins):
+            bins.append([])
+        bins[leaf].append(int(index))
+    return bins
+
+
+def build_packed_features(samples: TokenStore, prompt_lengths: np.ndarray,
+                          bins: List[List[int]]) -> Iterator[Dict]:
+    """把每个箱中的样本拼接为一条训练序列"""
+    for members in bins:
+        input_ids, attention_mask, position_ids, labels = [], [], [], []
+        for segment, index in enumerate(members, start=1):
+            ids = samples[index].tolist()
+            prompt_len = int(prompt_lengths[index])
+            input_ids.extend(ids)
+            attention_mask.extend([segment] * len(ids))
+            position_ids.extend(range(len(ids)))
+            labels.extend([IGNORE_INDEX] * prompt_len + ids[prompt_len:])
+        yield {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "position_ids": position_ids,
+            "labels": labels,
+        }
+
+
+def padding_report(lengths: np.ndarray, bins: List[List[int]], cutoff_len: int, batch_size: int) -> Dict:
+    """
+    比较打包前后的填充效率
+
+    基线：按数据顺序每 batch_size 条一批、填充到批内最长（--packing False 的行为）
+    打包：每条序列固定 cutoff_len
+    """
+    total_tokens = int(lengths.sum())
+    baseline_slots = 0
+    for start in range(0, len(lengths), batch_size):
+        batch = lengths[start:start + batch_size]
+        baseline_slots += int(batch.max()) * len(batch)
+    packed_slots = len(bins) * cutoff_len
+    return {
+        "samples": int(len(lengths)),
+        "total_tokens": total_tokens,
+        "mean_sample_tokens": float(lengths.mean()) if len(lengths) else 0.0,
+        "max_sample_tokens": int(lengths.max()) if len(lengths) else 0,
+        "baseline_sequences": int(len(lengths)),
+        "baseline_batches": -(-len(lengths) // batch_size),
+        "baseline_efficiency": total_tokens / baseline_slots if baseline_slots else 0.0,
+        "packed_sequences": len(bins),
+        "packed_batches": -(-len(bins) // batch_size),
+        "packed_efficiency": total_tokens / packed_slots if packed_slots else 0.0,
+        "samples_per_sequence": len(lengths) / len(bins) if bins else 0.0,
+    }
+
+
+def save_hf_dataset(features: Iterator[Dict], path: str):
+    """保存为 HF datasets 目录（llamafactory-cli --tokenized_path 直接 load_from_disk）"""
+    from datasets import Dataset
+
+    columns = {"input_ids": [], "attention_mask": [], "position_ids": [], "labels": []}
+    for feature in features:
+        for key in columns:
+            columns[key].append(feature[key])
+    Dataset.from_dict(columns).save_to_disk(path)
+
+
+def register_dataset(dataset_info_path: str, name: str, input_file: str, tokenized_path: str, report: Dict,
+                     template: str, cutoff_len: int):
+    """
+    在 dataset_info.json 中登记打包数据集
+
+    file_name/columns 仍指向原 alpaca 文件（LLaMA-Factory 需要）；
+    tokenized_path 等附加字段 LLaMA-Factory 会忽略，供训练脚本读取。
+    """
+    with open(dataset_info_path, 'r', encoding='utf-8') as f:
+        dataset_info = json.load(f)
+
+    dataset_dir = os.path.dirname(os.path.abspath(dataset_info_path))
+    dataset_info[name] = {
+        "file_name": os.path.relpath(os.path.abspath(input_file), dataset_dir),
+        "columns": {
+            "prompt": "instruction",
+            "response": "output"
+        },
+        "packing": {
+            "template": template,
+            "cutoff_len": cutoff_len,
+            "packed_sequences": report["packed_sequences"],
+            "packed_efficiency": round(report["packed_efficiency"], 4),
+        },
+    }
+    if tokenized_path:
+        dataset_info[name]["tokenized_path"] = os.path.abspath(tokenized_path)
+    with open(dataset_info_path, 'w', encoding='utf-8') as f:
+        json.dump(dataset_info, f, ensure_ascii=False, indent=2)
+
+
+def print_report(report: Dict):
+    print("\n📦 打包统计:")
+    print(f"   样本数: {report['samples']}  总 token: {report['total_tokens']}  "
+          f"平均长度: {report['mean_sample_tokens']:.1f}  最长: {report['max_sample_tokens']}")
+    if report.get("truncated"):
+        print(f"   ⚠️  截断样本: {report['truncated']}")
+    print(f"   不打包: {report['baseline_sequences']} 条序列, {report['baseline_batches']} 批, "
+          f"有效 token 占比 {report['baseline_efficiency']*100:.1f}%")
+    print(f"   打包后: {report['packed_sequences']} 条序列, {report['packed_batches']} 批, "
+          f"有效 token 占比 {report['packed_efficiency']*100:.1f}% "
+          f"(平均每条 {report['samples_per_sequence']:.2f} 个样本)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='把 alpaca 训练数据分词并打包为定长序列')
+    parser.add_argument('input_file', help='alpaca 格式数据文件 (batch_validator.py --output) 或分片目录 (--shard-dir)')
+    parser.add_argument('--tokenizer', default=DEFAULT_TOKENIZER, help=f'分词器路径 (默认: {DEFAULT_TOKENIZER})')
+    parser.add_argument('--template', choices=['default', 'qwen'], default=DEFAULT_TEMPLATE,
+                        help='训练模板，需与 llamafactory-cli --template 一致 (默认: default)')
+    parser.add_argument('--cutoff-len', type=int, default=DEFAULT_CUTOFF_LEN, help='打包序列长度 (默认: 2048)')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='用于对比填充效率的 per_device_train_batch_size (默认: 8)')
+    parser.add_argument('--output-dir', help=f'输出目录 (默认: {PACKED_ROOT}/<输入文件名>-<cutoff_len>)')
+    parser.add_argument('--no-hf', action='store_true', help='不导出 HF datasets 目录')
+    parser.add_argument('--register', action='store_true', help='登记到 dataset_info.json')
+    parser.add_argument('--dataset-info', default=DATASET_INFO, help=f'dataset_info.json 路径 (默认: {DATASET_INFO})')
+    parser.add_argument('--dataset-name', help='登记的数据集名 (默认: <输入文件名>_packed)')
+    args = parser.parse_args()
+
+    stem = os.path.splitext(os.path.basename(os.path.normpath(args.input_file)))[0]
+    output_dir = args.output_dir or os.path.join(PACKED_ROOT, f"{stem}-{args.cutoff_len}")
+    samples_dir = os.path.join(output_dir, "samples")
+    tokenized_path = os.path.join(output_dir, "tokenized")
+
+    print(f"📂 加载数据: {args.input_file}")
+    data = load_alpaca(args.input_file)
+    tokenizer = get_tokenizer(args.tokenizer)
+
+    # 1. 分词，写入样本级 token 存储
+    start_time = time.time()
+    token_list, source_index, prompt_lengths = [], [], []
+    truncated = 0
+    for index, ids, prompt_len, was_truncated in tokenize_samples(tokenizer, data, args.template, args.cutoff_len):
+        token_list.append(ids)
+        source_index.append(index)
+        prompt_lengths.append(prompt_len)
+        truncated += was_truncated
+
+    write_token_store(samples_dir, token_list, {
+        "kind": "sft_samples",
+        "source_file": args.input_file,
+        "source_sha256": dataset_sha256(args.input_file),
+        "tokenizer_hash": tokenizer_hash(tokenizer),
+        "special_token_ids": special_token_ids(tokenizer),
+        "template": args.template,
+        "cutoff_len": args.cutoff_len,
+    }, arrays={
+        "prompt_lengths": np.asarray(prompt_lengths, dtype=np.int32),
+        "source_index": np.asarray(source_index, dtype=np.int64),
+    })
+    del token_list
+    print(f"🔤 分词完成: {len(source_index)} 条样本，耗时 {time.time() - start_time:.2f} 秒")
+
+    # 2. FFD 装箱
+    samples = TokenStore(samples_dir)
+    lengths = samples.lengths()
+    bins = first_fit_decreasing(lengths, args.cutoff_len)
+    write_token_store(os.path.join(output_dir, "pack_index"), bins, {
+        "kind": "pack_index",
+        "cutoff_len": args.cutoff_len,
+    })
+
+    report = padding_report(lengths, bins, args.cutoff_len, args.batch_size)
+    report.update({"truncated": truncated, "template": args.template, "cutoff_len": args.cutoff_len})
+
+    # 3. 导出 HF datasets
+    if not args.no_hf:
+        save_hf_dataset(build_packed_features(samples, samples.array("prompt_lengths"), bins), tokenized_path)
+        print(f"💾 已保存打包数据集: {tokenized_path}")
+
+    with open(os.path.join(output_dir, "packing_report.json"), 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print_report(report)
+
+    if args.register:
+        name = args.dataset_name or f"{stem}_packed"
+        register_dataset(args.dataset_info, name, args.input_file, None if args.no_hf else tokenized_path, report,
+                         args.template, args.cutoff_len)
+        print(f"\n📝 已登记到 {args.dataset_info}: {name}")
+        print("   训练时添加: --tokenized_path "
+              f"{os.path.abspath(tokenized_path)} --packing True --neat_packing True --cutoff_len {args.cutoff_len}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+special_token_scanner.py - 全量训练数据特殊词符完整性扫描
+
+hw3_1.py 只验证 <|AGENT|>/<|EDIT|> 重新加载后 ID 不变。本脚本对整个 alpaca 数据集：
+1. 按训练模板渲染并批量分词（快速分词器的批量接口，Rust 侧并行），带 offset 映射
+2. 所有 token 拼成扁平数组，用 NumPy 向量化检查：
+   - marker_split: 文本中的每个标记都必须在对应字符位置编码为单个 ID（151669/151670），
+     否则说明分词器把它拆成了子词
+   - marker_truncated: 标记所在的 token 超过 cutoff_len 后会被截掉
+   - tool_call_truncated: 函数调用 JSON 的结尾超过 cutoff_len
+   截断按 LLaMA-Factory 的 prompt/回复长度分配规则计算
+
+输入可以是单个 alpaca JSON 文件或分片目录（dataset_shards.py）。sequence_packing.py 已经为同一份数据、
+同一分词器/模板/cutoff_len 写过样本级 token 存储时，先在其内存映射上向量化预筛：回复部分的标记 ID 数
+与文本中的标记数一致、且序列未达到 cutoff_len（未截断）的样本没有问题，只有其余样本重新分词做精确检查。
+
+使用方法：
+    python special_token_scanner.py outputs/validation/training_data_full_128_valid_alpaca.json
+    python special_token_scanner.py data.json --tokenizer /home/share/models/Qwen2.5-3B --cutoff-len 2048
+    python special_token_scanner.py training_data/x --token-store outputs/packed/x-2048/samples
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from dataset_shards import dataset_sha256, load_alpaca
+from sequence_packing import DEFAULT_CUTOFF_LEN, PACKED_ROOT, infer_seqlen, render_sample
+from token_store import TokenStore, read_manifest, tokenizer_hash
+from tokenizer_registry import ARTIFACT_DIR as TOKENIZER_PATH, get_tokenizer
+
+# hw3_1.py 添加特殊词符后的预期 ID
+EXPECTED_MARKER_IDS = {"<|AGENT|>": 151669, "<|EDIT|>": 151670}
+MARKER_PATTERN = re.compile("|".join(re.escape(marker) for marker in EXPECTED_MARKER_IDS))
+TOOL_CALL_PATTERN = re.compile(r'\{\s*"name"\s*:')
+ISSUE_TYPES = ("marker_split", "marker_truncated", "tool_call_truncated")
+
+
+def _flatten_encoding(encoding, texts: List[str]) -> Dict[str, np.ndarray]:
+    """
+    把一批编码结果拼成扁平数组
+
+    字符 offset 加上每条文本的全局字符起点，整批的 token 起点单调不减，
+    之后可以直接用 searchsorted 做字符 -> token 的映射。
+    """
+    lengths = np.fromiter((len(ids) for ids in encoding["input_ids"]), dtype=np.int64, count=len(texts))
+    token_base = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    char_base = np.concatenate(([0], np.cumsum([len(text) + 1 for text in texts])[:-1])).astype(np.int64)
+
+    total = int(lengths.sum())
+    ids = np.fromiter((i for seq in encoding["input_ids"] for i in seq), dtype=np.int64, count=total)
+    offsets = np.fromiter((v for seq in encoding["offset_mapping"] for pair in seq for v in pair),
+                          dtype=np.int64, count=2 * total).reshape(-1, 2)
+    sample_of_token = np.repeat(np.arange(len(texts)), lengths)
+    return {
+        "ids": ids,
+        "starts": offsets[:, 0] + char_base[sample_of_token],
+        "ends": offsets[:, 1] + char_base[sample_of_token],
+        "sample": sample_of_token,
+        "position": np.arange(total) - token_base[sample_of_token],
+        "lengths": lengths,
+        "char_base": char_base,
+    }
+
+
+def scan_batch(tokenizer, items: List[Dict], template: str, cutoff_len: int,
+               marker_ids: Dict[str, int]) -> List[List[Dict]]:
+    """
+    扫描一批样本
+
+    Returns:
+        list: 每条样本的问题列表
+    """
+    rendered = [render_sample(tokenizer, item, template) for item in items]
+    prompts = [prompt for prompt, _ in rendered]
+    responses = [response for _, response in rendered]
+    prompt_lengths = np.fromiter((len(ids) for ids in tokenizer(prompts, add_special_tokens=False)["input_ids"]),
+                                 dtype=np.int64, count=len(items))
+    flat = _flatten_encoding(
+        tokenizer(responses, add_special_tokens=False, return_offsets_mapping=True), responses
+    )
+
+    # 训练时回复部分保留的 token 数
+    kept = np.array([infer_seqlen(int(p), int(r), cutoff_len)[1]
+                     for p, r in zip(prompt_lengths, flat["lengths"])], dtype=np.int64)
+    issues: List[List[Dict]] = [[] for _ in items]
+    if len(flat["ids"]) == 0:
+        return issues
+
+    # 文本中每个标记的位置（全局字符坐标）
+    exp_sample, exp_char, exp_id, exp_marker = [], [], [], []
+    for index, response in enumerate(responses):
+        for match in MARKER_PATTERN.finditer(response):
+            exp_sample.append(index)
+            exp_char.append(match.start())
+            exp_marker.append(match.group())
+            exp_id.append(marker_ids[match.group()])
+
+    if exp_sample:
+        exp_sample = np.asarray(exp_sample, dtype=np.int64)
+        global_char = np.asarray(exp_char, dtype=np.int64) + flat["char_base"][exp_sample]
+        token_index = np.minimum(np.searchsorted(flat["starts"], global_char, side="left"), len(flat["ids"]) - 1)
+        marker_len = np.fromiter((len(m) for m in exp_marker), dtype=np.int64, count=len(exp_marker))
+
+        single = (
+            (flat["sample"][token_index] == exp_sample)
+            & (flat["starts"][token_index] == global_char)
+            & (flat["ends"][token_index] == global_char + marker_len)
+            & (flat["ids"][token_index] == np.asarray(exp_id, dtype=np.int64))
+        )
+        position = flat["position"][token_index]
+        truncated = single & (position >= kept[exp_sample])
+
+        for k in np.flatnonzero(~single):
+            issues[exp_sample[k]].append({"type": "marker_split", "marker": exp_marker[k], "char": exp_char[k]})
+        for k in np.flatnonzero(truncated):
+            issues[exp_sample[k]].append({"type": "marker_truncated", "marker": exp_marker[k],
+                                          "token_position": int(prompt_lengths[exp_sample[k]] + position[k]),
+                                          "cutoff_len": cutoff_len})
+
+    # 函数调用：最后一个 {"name": ... 到其后最后一个 '}'
+    call_sample, call_end = [], []
+    for index, response in enumerate(responses):
+        matches = list(TOOL_CALL_PATTERN.finditer(response))
+        if matches:
+            end = response.rfind("}")
+            if end >= matches[-1].start():
+                call_sample.append(index)
+                call_end.append(end)
+    if call_sample:
+        call_sample = np.asarray(call_sample, dtype=np.int64)
+        global_end = np.asarray(call_end, dtype=np.int64) + flat["char_base"][call_sample]
+        # 包含结尾字符的 token：起点 <= 该字符的最后一个 token
+        token_index = np.searchsorted(flat["starts"], global_end, side="right") - 1
+        position = flat["position"][token_index]
+        for k in np.flatnonzero(position >= kept[call_sample]):
+            issues[call_sample[k]].append({"type": "tool_call_truncated",
+                                           "token_position": int(prompt_lengths[call_sample[k]] + position[k]),
+                                           "cutoff_len": cutoff_len})
+    return issues
+
+
+def marker_token_ids(tokenizer) -> Dict[str, int]:
+    """分词器中标记的 ID，不存在的标记记为 -1（也会被判为 ID 不一致）"""
+    marker_ids = {marker: tokenizer.convert_tokens_to_ids(marker) for marker in EXPECTED_MARKER_IDS}
+    return {marker: -1 if token_id is None or token_id == tokenizer.unk_token_id else token_id
+            for marker, token_id in marker_ids.items()}
+
+
+def find_token_store(input_path: str, tokenizer, template: str, cutoff_len: int,
+                     store_dir: Optional[str] = None) -> Optional[TokenStore]:
+    """
+    sequence_packing.py 为同一份数据写出的样本级 token 存储（默认 outputs/packed/<名称>-<cutoff_len>/samples）
+
+    manifest 中的数据哈希、分词器哈希、模板或 cutoff_len 与当前不一致时返回 None
+    """
+    if store_dir is None:
+        stem = os.path.splitext(os.path.basename(os.path.normpath(input_path)))[0]
+        store_dir = os.path.join(PACKED_ROOT, f"{stem}-{cutoff_len}", "samples")
+    manifest = read_manifest(store_dir)
+    if manifest is None:
+        return None
+    expected = {
+        "source_sha256": dataset_sha256(input_path),
+        "tokenizer_hash": tokenizer_hash(tokenizer),
+        "template": template,
+        "cutoff_len": cutoff_len,
+    }
+    stale = [key for key, value in expected.items() if manifest.get(key) != value]
+    if stale:
+        print(f"⚠️  token 存储 {store_dir} 与当前输入不一致 ({', '.join(stale)})，全部重新分词")
+        return None
+    return TokenStore(store_dir)
+
+
+def prefilter_with_store(store: TokenStore, data: List[Dict], cutoff_len: int,
+                         marker_ids: Dict[str, int]) -> np.ndarray:
+    """
+    在 token 存储上找出需要精确检查的样本（返回数据下标）
+
+    存储中是截断后的 prompt + 回复：回复部分某个标记的 ID 数少于文本中的出现次数，说明标记被拆分或截掉；
+    序列长度达到 cutoff_len 说明可能被截断（函数调用结尾可能丢失）。其余样本不会有任何问题。
+    """
+    lengths = store.lengths()
+    prompt_lengths = np.asarray(store.array("prompt_lengths"), dtype=np.int64)
+    source_index = np.asarray(store.array("source_index"), dtype=np.int64)
+    tokens = np.asarray(store.tokens)
+
+    sequence = np.repeat(np.arange(len(lengths)), lengths)
+    position = np.arange(len(tokens)) - np.repeat(np.asarray(store.offsets[:-1], dtype=np.int64), lengths)
+    in_response = position >= prompt_lengths[sequence]
+
+    suspicious = lengths >= cutoff_len
+    for marker, token_id in marker_ids.items():
+        found = np.bincount(sequence[in_response & (tokens == token_id)], minlength=len(lengths))
+        expected = np.fromiter((data[i]["output"].count(marker) for i in source_index),
+                               dtype=np.int64, count=len(source_index))
+        suspicious |= found < expected
+
+    # 存储中缺少的样本也要检查
+    missing = np.setdiff1d(np.arange(len(data)), source_index)
+    return np.union1d(source_index[suspicious], missing)
+
+
+def scan_dataset(tokenizer, data: List[Dict], template: str = "default", cutoff_len: int = DEFAULT_CUTOFF_LEN,
+                 batch_size: int = 1024, indices: Optional[Sequence[int]] = None) -> Dict:
+    """扫描数据集（indices 给出时只分词检查这些样本），返回汇总结果"""
+    marker_ids = marker_token_ids(tokenizer)
+    id_mismatch = {marker: {"expected": EXPECTED_MARKER_IDS[marker], "actual": token_id}
+                   for marker, token_id in marker_ids.items() if token_id != EXPECTED_MARKER_IDS[marker]}
+
+    indices = list(range(len(data))) if indices is None else [int(i) for i in indices]
+    flagged = []
+    counts = {issue_type: 0 for issue_type in ISSUE_TYPES}
+    for start in range(0, len(indices), batch_size):
+        chunk_indices = indices[start:start + batch_size]
+        chunk = [data[i] for i in chunk_indices]
+        for index, item, sample_issues in zip(chunk_indices, chunk,
+                                              scan_batch(tokenizer, chunk, template, cutoff_len, marker_ids)):
+            if sample_issues:
+                for issue in sample_issues:
+                    counts[issue["type"]] += 1
+                flagged.append({
+                    "index": index,
+                    "instruction": item["instruction"][:100],
+                    "issues": sample_issues,
+                })
+
+    return {
+        "total_samples": len(data),
+        "tokenized_samples": len(indices),
+        "flagged_samples": len(flagged),
+        "marker_ids": marker_ids,
+        "marker_id_mismatch": id_mismatch,
+        "issue_counts": counts,
+        "template": template,
+        "cutoff_len": cutoff_len,
+        "flagged": flagged,
+    }
+
+
+def print_summary(results: Dict):
+    print("\n🔎 特殊词符扫描结果:")
+    print(f"   总样本数: {results['total_samples']}  重新分词检查: {results['tokenized_samples']}")
+    print(f"   有问题样本: {results['flagged_samples']}")
+    print(f"   标记 ID: {results['marker_ids']}")
+    for marker, mismatch in results["marker_id_mismatch"].items():
+        print(f"   ❌ {marker} ID 为 {mismatch['actual']}，预期 {mismatch['expected']}")
+    labels = {"marker_split": "标记被拆成子词", "marker_truncated": "标记超过 cutoff_len",
+              "tool_call_truncated": "函数调用超过 cutoff_len"}
+    for issue_type, count in results["issue_counts"].items():
+        print(f"   {labels[issue_type]}: {count}")
+    for item in results["flagged"][:5]:
+        types = ", ".join(sorted({issue["type"] for issue in item["issues"]}))
+        print(f"   样本 {item['index']}: {types} | {item['instruction'][:50]}...")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='扫描训练数据中的特殊词符是否为单个 ID 且未被截断')
+    parser.add_argument('input_file', help='alpaca 格式数据文件或分片目录')
+    parser.add_argument('--tokenizer', default=TOKENIZER_PATH, help=f'分词器路径 (默认: {TOKENIZER_PATH})')
+    parser.add_argument('--template', choices=['default', 'qwen'], default='default', help='训练模板 (默认: default)')
+    parser.add_argument('--cutoff-len', type=int, default=DEFAULT_CUTOFF_LEN, help='训练 cutoff_len (默认: 2048)')
+    parser.add_argument('--batch-size', type=int, default=1024, help='每批分词的样本数 (默认: 1024)')
+    parser.add_argument('--token-store', default=None,
+                        help=f'sequence_packing.py 的样本级 token 存储 (默认: {PACKED_ROOT}/<输入文件名>-<cutoff_len>/samples)')
+    parser.add_argument('--no-token-store', action='store_true', help='不使用 token 存储，全部重新分词')
+    parser.add_argument('--report', help='扫描报告 JSON 路径 (默认: outputs/reports/<输入文件名>_token_scan.json)')
+    args = parser.parse_args()
+
+    data = load_alpaca(args.input_file)
+    tokenizer = get_tokenizer(args.tokenizer)
+
+    print(f"🔍 扫描 {args.input_file} ({len(data)} 条样本)")
+    indices = None
+    store = None if args.no_token_store else find_token_store(args.input_file, tokenizer, args.template,
+                                                              args.cutoff_len, args.token_store)
+    if store is not None:
+        indices = prefilter_with_store(store, data, args.cutoff_len, marker_token_ids(tokenizer))
+        print(f"⚡ 使用 token 存储 {store.store_dir} 预筛: {len(indices)}/{len(data)} 条样本需要重新分词检查")
+    results = scan_dataset(tokenizer, data, args.template, args.cutoff_len, args.batch_size, indices)
+    results["token_store"] = store.store_dir if store is not None else None
+    print_summary(results)
+
+    stem = os.path.splitext(os.path.basename(os.path.normpath(args.input_file)))[0]
+    report_file = args.report or os.path.join("outputs/reports", f"{stem}_token_scan.json")
+    os.makedirs(os.path.dirname(report_file) or ".", exist_ok=True)
+    with open(report_file, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"\n📋 扫描报告已保存到: {report_file}")
+
+    if results["flagged_samples"] or results["marker_id_mismatch"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
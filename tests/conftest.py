@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 仓库根目录下的模块是平铺的脚本，直接加入 sys.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,61 @@
+import json
+
+from data_constructor import item_seed, merge_shard_outputs, shard_item_ids, shard_output_file
+
+
+def test_item_seed_is_stable_and_distinct():
+    assert item_seed(0, 5) == item_seed(0, 5)
+    assert item_seed(0, 5) != item_seed(1, 5)
+    assert len({item_seed(0, i) for i in range(1000)}) == 1000
+    assert 0 <= item_seed(0, 5) < 2 ** 32
+
+
+def test_shards_partition_item_ids():
+    shards = [shard_item_ids(10, i, 3) for i in range(3)]
+    assert shards[1] == [1, 4, 7]
+    assert sorted(i for shard in shards for i in shard) == list(range(10))
+    assert shard_item_ids(4) == [0, 1, 2, 3]
+
+
+def test_shard_output_file():
+    assert shard_output_file("out/data.json", 0, 1) == "out/data.json"
+    assert shard_output_file("out/data.json", 2, 4) == "out/data.shard-00002-of-00004.json"
+
+
+def sample(item_id, valid, seed=0):
+    return {
+        "item_id": item_id, "seed": seed, "question_id": item_id, "question_title": f"题目 {item_id}",
+        "instruction": f"问题 {item_id}", "output": f"输出 {item_id}", "expected_type": "agent",
+        "edit_format": "full", "buggy_code": "x = 1", "valid": valid, "issues": [] if valid else ["缺少 <think>"],
+    }
+
+
+def test_merge_deduplicates_preferring_valid(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    shards = []
+    for index, items in enumerate([[sample(0, True), sample(2, False)], [sample(1, True), sample(2, True)]]):
+        path = tmp_path / f"shard{index}.json"
+        path.write_text(json.dumps(items, ensure_ascii=False), encoding='utf-8')
+        shards.append(str(path))
+
+    merge_shard_outputs(shards, str(tmp_path / "merged.json"))
+    merged = json.loads((tmp_path / "merged.json").read_text(encoding='utf-8'))
+    assert [(item["item_id"], item["valid"]) for item in merged] == [(0, True), (1, True), (2, True)]
+    alpaca = json.loads((tmp_path / "merged_alpaca.json").read_text(encoding='utf-8'))
+    assert [item["instruction"] for item in alpaca] == ["问题 0", "问题 1", "问题 2"]
+
+
+def test_merge_matches_unsharded_order(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    items = [sample(item_id, item_id % 3 != 0) for item_id in range(10)]
+    shards = []
+    for shard_index in range(2):
+        path = tmp_path / f"shard{shard_index}.json"
+        path.write_text(json.dumps([item for item in items if item["item_id"] % 2 == shard_index],
+                                   ensure_ascii=False), encoding='utf-8')
+        shards.append(str(path))
+
+    merge_shard_outputs(shards, str(tmp_path / "merged.json"))
+    assert json.loads((tmp_path / "merged.json").read_text(encoding='utf-8')) == items
+    alpaca = json.loads((tmp_path / "merged_alpaca.json").read_text(encoding='utf-8'))
+    assert [item["instruction"] for item in alpaca] == [item["instruction"] for item in items if item["valid"]]
@@ -0,0 +1,51 @@
+import json
+import os
+
+from dataset_shards import dataset_sha256, iter_records, load_alpaca, load_manifest, verify_shards, write_shards
+
+RECORDS = [{"instruction": f"问题 {i}", "input": "", "output": "回答" * (i % 7 + 1)} for i in range(50)]
+
+
+def test_split_and_read_back_in_order(tmp_path):
+    shard_dir = str(tmp_path / "data")
+    manifest = write_shards(RECORDS, shard_dir, shard_bytes=512)
+    assert len(manifest["shards"]) > 1
+    assert all(shard["bytes"] <= 512 for shard in manifest["shards"])
+    assert manifest["num_records"] == len(RECORDS)
+    assert list(iter_records(shard_dir)) == RECORDS
+    assert load_alpaca(shard_dir) == RECORDS
+    assert verify_shards(shard_dir) == []
+
+
+def test_oversized_record_gets_own_shard(tmp_path):
+    shard_dir = str(tmp_path / "data")
+    big = {"instruction": "x" * 1000, "input": "", "output": ""}
+    manifest = write_shards([RECORDS[0], big, RECORDS[1]], shard_dir, shard_bytes=256)
+    assert [shard["records"] for shard in manifest["shards"]] == [1, 1, 1]
+
+
+def test_append_keeps_existing_shards(tmp_path):
+    shard_dir = str(tmp_path / "data")
+    first = write_shards(RECORDS[:20], shard_dir, shard_bytes=512)
+    before = dataset_sha256(shard_dir)
+    manifest = write_shards(RECORDS[20:], shard_dir, shard_bytes=512, append=True, source="more.json")
+    assert manifest["shards"][:len(first["shards"])] == first["shards"]
+    assert [batch["source"] for batch in manifest["batches"]] == [None, "more.json"]
+    assert list(iter_records(shard_dir)) == RECORDS
+    assert dataset_sha256(shard_dir) != before
+
+    # 不追加时重写整个目录
+    write_shards(RECORDS[:5], shard_dir, shard_bytes=512)
+    assert load_manifest(shard_dir)["num_records"] == 5
+    assert load_alpaca(shard_dir) == RECORDS[:5]
+
+
+def test_verify_detects_tampering(tmp_path):
+    shard_dir = str(tmp_path / "data")
+    manifest = write_shards(RECORDS, shard_dir, shard_bytes=512)
+    with open(os.path.join(shard_dir, manifest["shards"][0]["file"]), 'a', encoding='utf-8') as f:
+        f.write(json.dumps(RECORDS[0], ensure_ascii=False) + "\n")
+    os.remove(os.path.join(shard_dir, manifest["shards"][-1]["file"]))
+    problems = verify_shards(shard_dir)
+    assert any("sha256" in problem for problem in problems)
+    assert any("文件缺失" in problem for problem in problems)
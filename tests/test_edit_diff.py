@@ -0,0 +1,47 @@
+import json
+
+import pytest
+
+from edit_diff import apply_unified_diff, convert_output, extract_query_code, find_editor_call, make_unified_diff
+
+ORIGINAL = "\n".join(f"line_{i} = {i}" for i in range(30)) + "\n"
+MODIFIED = ORIGINAL.replace("line_3 = 3", "line_3 = 33").replace("line_25 = 25\n", "")
+QUERY = f"这段代码有问题，请修复：\n\n```python\n{ORIGINAL}```"
+
+
+def test_diff_round_trip():
+    diff = make_unified_diff(ORIGINAL, MODIFIED)
+    assert "line_10" not in diff
+    assert apply_unified_diff(ORIGINAL, diff) == MODIFIED
+
+
+def test_mismatched_diff_rejected():
+    with pytest.raises(ValueError):
+        apply_unified_diff(ORIGINAL, "@@ -1,1 +1,1 @@\n-not_in_code = 1\n+x = 2")
+
+
+def test_extract_query_code():
+    assert extract_query_code(QUERY) == ORIGINAL.rstrip("\n")
+    assert extract_query_code("修复：\n\nx = 1\n") == "x = 1"
+
+
+def test_convert_output_between_formats():
+    call = {"name": "editor", "arguments": {"original_code": ORIGINAL, "modified_code": MODIFIED}}
+    output = "<think> 修改 </think>\n<|EDIT|>\n我会修复" + json.dumps(call, ensure_ascii=False)
+
+    as_diff = convert_output(output, "diff")
+    assert as_diff.startswith("<think> 修改 </think>\n<|EDIT|>\n我会修复")
+    arguments = find_editor_call(as_diff)[2]["arguments"]
+    assert set(arguments) == {"diff"}
+
+    back = find_editor_call(convert_output(as_diff, "full", QUERY))[2]["arguments"]
+    assert back["original_code"] == ORIGINAL.rstrip("\n")
+    assert back["modified_code"] == MODIFIED.rstrip("\n")
+    assert convert_output(as_diff, "diff") == as_diff
+
+
+def test_convert_without_editor_call_is_noop():
+    output = '<think> 运行 </think>\n<|AGENT|>\n{"name": "python", "arguments": {"code": "x"}}'
+    assert convert_output(output, "diff") == output
+    with pytest.raises(ValueError):
+        convert_output(output, "patch")
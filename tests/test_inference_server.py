@@ -0,0 +1,100 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi.testclient import TestClient
+
+from hw3_2 import SYSTEM_PROMPTS
+from inference_server import InferenceServer, create_app
+
+REPLY = '<think> 需要运行 </think>\n<|AGENT|>\n{"name": "python", "arguments": {"code": "x"}}'
+
+
+class CharTokenizer:
+    """逐字符编码，对话模板按 <role>content 拼接"""
+
+    def apply_chat_template(self, messages, tokenize=False, add_generation_prompt=True, **kwargs):
+        return "".join(f"<{m['role']}>{m['content']}" for m in messages) + "<assistant>"
+
+    def encode(self, text, add_special_tokens=False):
+        return [ord(char) for char in text]
+
+
+class StubEngine:
+    """记录收到的 prompt；release 未设置时阻塞，用来占满并发槽位"""
+
+    def __init__(self):
+        self.prompts = []
+        self.release = threading.Event()
+        self.release.set()
+
+    async def generate_async(self, prompt_ids, sampling, request_id):
+        self.prompts.append("".join(chr(i) for i in prompt_ids))
+        while not self.release.is_set():
+            await asyncio.sleep(0.01)
+        return {"prompt_tokens": len(prompt_ids),
+                "outputs": [{"text": REPLY, "token_ids": list(range(len(REPLY))), "finish_reason": "stop"}]}
+
+    def close(self):
+        pass
+
+
+def make_client(max_pending=8):
+    engine = StubEngine()
+    server = InferenceServer(engine, CharTokenizer(), "hw3-model", max_pending=max_pending)
+    return TestClient(create_app(server)), server, engine
+
+
+def chat(client, content, **extra):
+    return client.post("/v1/chat/completions", json={"messages": [{"role": "user", "content": content}], **extra})
+
+
+def test_chat_completion_round_trip():
+    client, _, engine = make_client()
+    with client:
+        response = chat(client, "修复代码", max_tokens=64)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["object"] == "chat.completion"
+    assert body["model"] == "hw3-model"
+    assert body["choices"][0]["message"] == {"role": "assistant", "content": REPLY}
+    assert body["choices"][0]["finish_reason"] == "stop"
+    assert body["usage"]["prompt_tokens"] == len(engine.prompts[0])
+    assert body["usage"]["total_tokens"] == body["usage"]["prompt_tokens"] + len(REPLY)
+
+
+def test_system_prompt_injected_only_when_missing():
+    client, _, engine = make_client()
+    with client:
+        chat(client, "修复代码")
+        client.post("/v1/chat/completions", json={"messages": [
+            {"role": "system", "content": "自定义"}, {"role": "user", "content": "修复代码"}]})
+    assert engine.prompts[0] == f"<system>{SYSTEM_PROMPTS['full']}<user>修复代码<assistant>"
+    assert engine.prompts[1] == "<system>自定义<user>修复代码<assistant>"
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_full_queue_returns_503():
+    client, server, engine = make_client(max_pending=1)
+    engine.release.clear()
+    with client, ThreadPoolExecutor(max_workers=2) as pool:
+        # 第一个请求占用唯一的并发槽位，第二个在队列中等待，第三个被拒绝
+        running = pool.submit(chat, client, "一")
+        wait_until(lambda: len(engine.prompts) == 1)
+        queued = pool.submit(chat, client, "二")
+        wait_until(lambda: server.queue.qsize() == 1)
+
+        rejected = chat(client, "三")
+        assert rejected.status_code == 503
+        assert rejected.json()["error"]["type"] == "server_overloaded"
+
+        engine.release.set()
+        assert running.result().status_code == 200
+        assert queued.result().status_code == 200
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from length_sampler import TokenBudgetBatchSampler, fixed_batches, padding_stats
+
+LENGTHS = np.random.default_rng(0).integers(16, 1024, size=500)
+
+
+def test_batches_cover_every_sample_within_budget():
+    sampler = TokenBudgetBatchSampler(LENGTHS, max_tokens=4096, num_buckets=4, max_batch_size=32)
+    batches = list(sampler)
+    assert sorted(i for batch in batches for i in batch) == list(range(len(LENGTHS)))
+    for batch in batches:
+        assert LENGTHS[batch].max() * len(batch) <= 4096
+        assert len(batch) <= 32
+    assert len(sampler) == len(batches)
+
+
+def test_epochs_are_reproducible_and_reshuffled():
+    sampler = TokenBudgetBatchSampler(LENGTHS, max_tokens=4096, seed=1)
+    first = list(sampler)
+    assert list(sampler) == first
+    sampler.set_epoch(1)
+    assert list(sampler) != first
+
+
+def test_bucketing_reduces_padding():
+    budget = padding_stats(LENGTHS, list(TokenBudgetBatchSampler(LENGTHS, max_tokens=4096)))
+    fixed = padding_stats(LENGTHS, fixed_batches(len(LENGTHS), 8))
+    assert budget["real_tokens"] == fixed["real_tokens"] == int(LENGTHS.sum())
+    assert budget["padding_ratio"] < fixed["padding_ratio"]
+
+
+def test_sample_longer_than_budget_rejected():
+    with pytest.raises(ValueError):
+        TokenBudgetBatchSampler([10, 5000], max_tokens=4096)
@@ -0,0 +1,50 @@
+import json
+import os
+
+from edit_diff import check_editor_call, make_unified_diff
+from output_checker import check_query_output_file, check_single_output
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+QUERY = "这个代码报错：SyntaxError: invalid syntax，请修复：\n\ndef f(x):\n    if x > 0\n        return x\n    return -x"
+ORIGINAL = "def f(x):\n    if x > 0\n        return x\n    return -x"
+MODIFIED = "def f(x):\n    if x > 0:\n        return x\n    return -x"
+
+
+def edit_output(call: dict) -> str:
+    return f"<think> 缺少冒号 </think>\n<|EDIT|>\n我会使用编辑模式修复问题{json.dumps(call, ensure_ascii=False)}"
+
+
+def test_baseline_hw3_2_passes():
+    results = check_query_output_file(os.path.join(ROOT, "hw3_2.json"))
+    assert results["total_items"] == 10
+    assert results["passed_items"] == 10
+    assert results["summary"]["invalid_editor_args"] == 0
+
+
+def test_top_level_full_format_accepted():
+    output = edit_output({"name": "editor", "original_code": ORIGINAL, "modified_code": MODIFIED})
+    result = check_single_output(output, 0, QUERY)
+    assert result["issues"] == []
+    assert result["editor_args_valid"] is True
+
+
+def test_nested_full_format_accepted():
+    output = edit_output({"name": "editor", "arguments": {"original_code": ORIGINAL, "modified_code": MODIFIED}})
+    assert check_single_output(output, 0, QUERY)["issues"] == []
+
+
+def test_diff_format_applied_to_query():
+    good = edit_output({"name": "editor", "arguments": {"diff": make_unified_diff(ORIGINAL, MODIFIED)}})
+    assert check_single_output(good, 0, QUERY)["issues"] == []
+
+    bad = edit_output({"name": "editor", "arguments": {"diff": "@@ -1,1 +1,1 @@\n-def g(y):\n+def g(y, z):"}})
+    result = check_single_output(bad, 0, QUERY)
+    assert result["editor_args_valid"] is False
+    assert "diff 无法应用" in result["issues"][0]
+
+
+def test_unparsable_diff_call_reported_accurately():
+    ok, details = check_editor_call('{"name": "editor", "arguments": {"diff": "@@ -1 +1 @@\n-a\n+b"', QUERY)
+    assert not ok
+    assert "diff" in details
@@ -0,0 +1,31 @@
+from prompt_lookup import estimate_acceptance, find_draft_tokens, summarize_acceptance
+
+
+def test_draft_prefers_longest_recent_match():
+    assert find_draft_tokens([1, 2, 3, 9, 2, 3, 4, 5, 2, 3], max_ngram=2, num_draft=2) == [4, 5]
+    assert find_draft_tokens([1, 2, 3], max_ngram=2) == []
+
+
+def test_copied_output_is_mostly_accepted():
+    prompt = list(range(100, 140))
+    stats = estimate_acceptance(prompt, prompt[:30], num_draft=10)
+    assert stats["output_tokens"] == 30
+    # 第一步结尾没有可匹配的 n-gram；之后每步接受 10 个草稿，最后一步只剩 7 个 token
+    assert stats["forward_passes"] == 4
+    assert (stats["proposed"], stats["accepted"]) == (30, 27)
+
+
+def test_novel_output_needs_one_pass_per_token():
+    stats = estimate_acceptance([1, 2, 3], [7, 8, 9, 10])
+    assert stats == {"output_tokens": 4, "proposed": 0, "accepted": 0, "forward_passes": 4}
+
+
+def test_summary():
+    summary = summarize_acceptance([
+        {"output_tokens": 10, "proposed": 8, "accepted": 6, "forward_passes": 4},
+        {"output_tokens": 6, "proposed": 2, "accepted": 0, "forward_passes": 6},
+    ])
+    assert summary["sequences"] == 2
+    assert summary["acceptance_rate"] == 0.6
+    assert summary["tokens_per_pass"] == 1.6
+    assert summarize_acceptance([])["tokens_per_pass"] == 0.0
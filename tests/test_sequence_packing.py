@@ -0,0 +1,44 @@
+import random
+
+import pytest
+
+from sequence_packing import first_fit_decreasing, infer_seqlen
+
+
+def test_ffd_matches_reference_first_fit():
+    rng = random.Random(0)
+    lengths = [rng.randint(1, 100) for _ in range(300)]
+    bins = first_fit_decreasing(lengths, 128)
+
+    # 朴素 O(n²) 首次适应递减作为对照
+    expected, remaining = [], []
+    for index in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        for b, free in enumerate(remaining):
+            if free >= lengths[index]:
+                expected[b].append(index)
+                remaining[b] -= lengths[index]
+                break
+        else:
+            expected.append([index])
+            remaining.append(128 - lengths[index])
+    assert bins == expected
+    assert sorted(i for b in bins for i in b) == list(range(len(lengths)))
+    assert all(sum(lengths[i] for i in b) <= 128 for b in bins)
+
+
+def test_ffd_edge_cases():
+    assert first_fit_decreasing([], 16) == []
+    assert first_fit_decreasing([16, 8, 8], 16) == [[0], [1, 2]]
+    with pytest.raises(ValueError):
+        first_fit_decreasing([17], 16)
+
+
+@pytest.mark.parametrize("source, target, cutoff, expected", [
+    (10, 20, 100, (10, 20)),
+    (30, 200, 100, (30, 70)),
+    (200, 30, 100, (70, 30)),
+    (300, 100, 100, (75, 25)),
+])
+def test_infer_seqlen(source, target, cutoff, expected):
+    assert infer_seqlen(source, target, cutoff) == expected
+    assert sum(infer_seqlen(source, target, cutoff)) <= cutoff
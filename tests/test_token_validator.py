@@ -0,0 +1,84 @@
+import re
+
+import pytest
+
+from token_validator import TokenFormatSpec, TokenFormatValidator, validate_token_ids
+
+SPECIAL = ["<think>", "</think>", "<|AGENT|>", "<|EDIT|>", "<|im_end|>"]
+SPECIAL_PATTERN = re.compile("(" + "|".join(re.escape(token) for token in SPECIAL) + ")")
+
+
+class CharTokenizer:
+    """逐字符分词，特殊词符各占一个 ID"""
+
+    eos_token_id = None
+    unk_token_id = None
+
+    def convert_tokens_to_ids(self, token):
+        return SPECIAL.index(token)
+
+    def encode(self, text, add_special_tokens=False):
+        ids = []
+        for part in SPECIAL_PATTERN.split(text):
+            if part in SPECIAL:
+                ids.append(SPECIAL.index(part))
+            else:
+                ids.extend(1000 + ord(char) for char in part)
+        return ids
+
+    def decode(self, ids, skip_special_tokens=False):
+        return "".join(SPECIAL[i] if i < len(SPECIAL) else chr(i - 1000) for i in ids)
+
+
+TOKENIZER = CharTokenizer()
+AGENT_OUTPUT = '<think> 需要运行 </think>\n<|AGENT|>\n我会使用代理模式{"name": "python", "arguments": {"code": "print(\\"}\\")"}}'
+
+
+def run(text, **spec_kwargs):
+    spec = TokenFormatSpec(TOKENIZER, eos_token_ids=[SPECIAL.index("<|im_end|>")], **spec_kwargs)
+    return validate_token_ids(spec, TOKENIZER.encode(text))
+
+
+def test_valid_output_passes():
+    assert run(AGENT_OUTPUT) is None
+    assert run(AGENT_OUTPUT + "<|im_end|>") is None
+
+
+@pytest.mark.parametrize("text, kind", [
+    ("直接回答", "missing_think"),
+    ("<think> 想一想", "unterminated_think"),
+    ("<think> a </think>\n" + "说明" * 20, "missing_marker"),
+    ("<think> a </think>\n<|EDIT|>\n只有说明", "missing_tool_call"),
+    ('<think> a </think>\n<|EDIT|>\n{"name": "python", "arguments": {}}', "wrong_function"),
+    ('<think> a </think>\n<|AGENT|>\n{"name": "python", "arguments": {"code": "x', "unterminated_tool_call"),
+])
+def test_violations(text, kind):
+    assert run(text)["type"] == kind
+
+
+def test_think_budget():
+    assert run(AGENT_OUTPUT, max_think_tokens=3)["type"] == "think_too_long"
+    assert run(AGENT_OUTPUT, max_think_tokens=64) is None
+
+
+def test_prompt_ending_in_think_start():
+    spec = TokenFormatSpec(TOKENIZER)
+    prompt = TOKENIZER.encode("<|im_start|>assistant\n<think>\n")
+    output = TOKENIZER.encode(AGENT_OUTPUT[len("<think>"):])
+    assert validate_token_ids(spec, output, prompt_ids=prompt) is None
+
+
+def test_steer_constraints():
+    spec = TokenFormatSpec(TOKENIZER, max_think_tokens=2)
+    validator = TokenFormatValidator(spec, "steer")
+    assert validator.allowed_token_ids()[0] == spec.think_start_id
+    for token_id in TOKENIZER.encode("<think>ab"):
+        validator.step(token_id)
+    assert validator.allowed_token_ids() == [spec.think_end_id]
+    validator.step(spec.think_end_id)
+    assert set(spec.marker_ids) <= set(validator.allowed_token_ids())
+
+
+def test_unknown_action_rejected():
+    with pytest.raises(ValueError):
+        TokenFormatValidator(TokenFormatSpec(TOKENIZER), "ignore")
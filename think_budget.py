@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+think_budget.py - 思考预算控制的两阶段生成
+
+阶段 1：所有请求批量生成，遇到 </think> 或生成 N 个 token 即停止；
+       达到预算仍未闭合的思考部分强制补上 "\\n</think>\\n\\n"
+阶段 2：prompt + 阶段 1 输出作为新 prompt，再次批量生成（max_tokens 为原上限减去实际的思考 token 数）；
+       none/flag 升级为 steer，约束第一个非换行 token 必须是 <|AGENT|> 或 <|EDIT|>（abort 保持不变）；
+       后端不支持逐 token 约束（vLLM V1 引擎、cpu-quant）时降级为 flag
+
+ThinkBudgetEngine 包装任意推理后端，对外接口不变（generate / generate_iter），
+因此可以直接用于修复轮次和遥测；每个 output 额外带 think_tokens / think_forced。
+"""
+
+import time
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from inference_backends import _as_int_list, _merge_sampling, _validate_action, supports_steer
+
+PERCENTILES = (50, 90, 99)
+
+
+def _truncate_output(output: Dict, max_tokens: int) -> Dict:
+    """把阶段 2 的输出截断到该候选自己的回答预算；预算之后才出现的违规不再计入"""
+    if len(output["token_ids"]) <= max_tokens:
+        return output
+    violation = output.get("violation")
+    if violation is not None and violation.get("position", 0) >= max_tokens:
+        violation = None
+    return dict(output, token_ids=list(output["token_ids"])[:max_tokens], finish_reason="length", violation=violation)
+
+
+class ThinkBudgetEngine:
+    """
+    把推理后端包装为两阶段生成
+
+    Args:
+        engine: 推理后端（需要 generate_iter）
+        tokenizer: 带特殊词符的分词器
+        think_budget: 思考部分的 token 上限
+    """
+
+    def __init__(self, engine, tokenizer, think_budget: int):
+        self.engine = engine
+        self.tokenizer = tokenizer
+        self.think_budget = think_budget
+        self.think_end_id = tokenizer.convert_tokens_to_ids("</think>")
+        self.close_ids = (tokenizer.encode("\n", add_special_tokens=False) + [self.think_end_id]
+                          + tokenizer.encode("\n\n", add_special_tokens=False))
+        self.eos_ids = {tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids("<|im_end|>")}
+        self.records: List[Dict] = []
+        self.phase_seconds = {"think": 0.0, "answer": 0.0}
+        self._warned_validate = False
+
+    def supports_steer(self) -> bool:
+        return supports_steer(self.engine)
+
+    def _answer_validate(self, sampling: Dict) -> Optional[str]:
+        """阶段 2 的校验模式：默认 steer 保证以标记开头，后端不支持逐 token 约束时降级为 flag"""
+        action = _validate_action(sampling)
+        if not supports_steer(self.engine):
+            if not self._warned_validate:
+                print(f"⚠️  当前后端不支持逐 token 的 {action or 'steer'}，思考预算第二阶段改为 flag 校验（不保证以标记开头）")
+                self._warned_validate = True
+            return "flag"
+        return action if action == "abort" else "steer"
+
+    def _close_think(self, output: Dict) -> Tuple[List[int], bool, bool]:
+        """
+        处理阶段 1 的输出
+
+        Returns:
+            tuple: (进入阶段 2 时追加在 prompt 后的 token, 是否强制闭合, 是否需要阶段 2)
+        """
+        ids = list(output["token_ids"])
+        if ids and ids[-1] == self.think_end_id:
+            return ids, False, True
+        if output["finish_reason"] == "length":
+            return ids + self.close_ids, True, True
+        if ids and ids[-1] in self.eos_ids:
+            # 模型在思考阶段就结束了，直接作为最终输出
+            return ids, False, False
+        # 停止 token 未包含在输出中的后端
+        return ids + [self.think_end_id], False, True
+
+    def generate_iter(self, prompts: List[Sequence[int]],
+                      sampling: Optional[Dict] = None) -> Iterator[Tuple[int, Dict]]:
+        sampling = _merge_sampling(sampling)
+        prompts = [_as_int_list(ids) for ids in prompts]
+
+        # 阶段 1：思考，遇到 </think> 或达到预算停止（校验放到阶段 2）
+        think_sampling = dict(sampling)
+        think_sampling.update({
+            "max_tokens": min(self.think_budget, sampling["max_tokens"]),
+            "stop_token_ids": sorted(set(sampling.get("stop_token_ids") or []) | {self.think_end_id}),
+            "validate": None,
+        })
+        start_time = time.time()
+        phase1 = dict(self.engine.generate_iter(prompts, think_sampling))
+        self.phase_seconds["think"] += time.time() - start_time
+
+        # 阶段 2：每个候选单独续写（steer 时第一个 token 约束为标记）
+        continuations = []
+        candidates: Dict[int, List[Optional[Dict]]] = {}
+        for index, result in phase1.items():
+            candidates[index] = [None] * len(result["outputs"])
+            for cand, output in enumerate(result["outputs"]):
+                prefix, forced, needs_answer = self._close_think(output)
+                think_tokens = len(output["token_ids"])
+                if output["token_ids"] and output["token_ids"][-1] == self.think_end_id:
+                    think_tokens -= 1
+                if needs_answer:
+                    continuations.append((index, cand, prefix, forced, think_tokens))
+                else:
+                    candidates[index][cand] = dict(output, think_tokens=think_tokens, think_forced=False)
+
+        # 思考阶段就结束的请求直接产出
+        for index, outputs in candidates.items():
+            if all(c is not None for c in outputs):
+                yield index, self._finish(index, phase1[index], None, outputs)
+        if not continuations:
+            return
+
+        # 两阶段合计不超过原 max_tokens：每个候选的回答预算 = 原上限 - 自己的思考 token 数（含强制闭合的 token）。
+        # 为保持一个批次，按最大的回答预算提交，再把各输出截断到自己的预算
+        budgets = [max(sampling["max_tokens"] - len(prefix), 1) for _, _, prefix, _, _ in continuations]
+        answer_sampling = dict(sampling, n=1, validate=self._answer_validate(sampling), max_tokens=max(budgets))
+        answer_prompts = [prompts[index] + prefix for index, _, prefix, _, _ in continuations]
+        start_time = time.time()
+        for local_index, result in self.engine.generate_iter(answer_prompts, answer_sampling):
+            index, cand, prefix, forced, think_tokens = continuations[local_index]
+            output = _truncate_output(result["outputs"][0], budgets[local_index])
+            token_ids = prefix + list(output["token_ids"])
+            candidates[index][cand] = {
+                "text": self.tokenizer.decode(self._strip_eos(token_ids, output["finish_reason"]),
+                                              skip_special_tokens=False),
+                "token_ids": token_ids,
+                "finish_reason": output["finish_reason"],
+                "violation": output.get("violation"),
+                "think_tokens": think_tokens,
+                "think_forced": forced,
+            }
+            if all(c is not None for c in candidates[index]):
+                yield index, self._finish(index, phase1[index], result, candidates[index])
+        self.phase_seconds["answer"] += time.time() - start_time
+
+    def _strip_eos(self, token_ids: List[int], finish_reason: str) -> List[int]:
+        if finish_reason == "stop" and token_ids and token_ids[-1] in self.eos_ids:
+            return token_ids[:-1]
+        return token_ids
+
+    def _finish(self, index: int, think_result: Dict, answer_result: Optional[Dict], outputs: List[Dict]) -> Dict:
+        metrics = dict(think_result.get("metrics") or {})
+        if answer_result is not None:
+            metrics["finished_time"] = (answer_result.get("metrics") or {}).get("finished_time")
+        for output in outputs:
+            self.records.append({"index": index, "think_tokens": output["think_tokens"],
+                                 "forced": output["think_forced"]})
+        return {"prompt_tokens": think_result["prompt_tokens"], "outputs": outputs, "metrics": metrics}
+
+    def generate(self, prompts: List[Sequence[int]], sampling: Optional[Dict] = None) -> List[Dict]:
+        results = [None] * len(prompts)
+        for index, result in self.generate_iter(prompts, sampling):
+            results[index] = result
+        return results
+
+    def close(self):
+        self.engine.close()
+
+
+def think_report(records: List[Dict], think_budget: int, phase_seconds: Dict,
+                 baseline_summary: Optional[Dict] = None, wall_time: Optional[float] = None) -> Dict:
+    """思考 token 分布 + 两阶段耗时；提供不限预算的基线指标时给出节省的时间"""
+    think_tokens = np.asarray([r["think_tokens"] for r in records], dtype=np.float64)
+    report = {
+        "think_budget": think_budget,
+        "candidates": len(records),
+        "forced_close": int(sum(r["forced"] for r in records)),
+        "think_tokens": None,
+        "phase_seconds": dict(phase_seconds),
+    }
+    if len(think_tokens):
+        report["think_tokens"] = {f"p{p}": float(np.percentile(think_tokens, p)) for p in PERCENTILES}
+        report["think_tokens"].update({"mean": float(think_tokens.mean()), "max": float(think_tokens.max())})
+    if baseline_summary is not None and wall_time is not None:
+        report["baseline_wall_time_s"] = baseline_summary["wall_time_s"]
+        report["wall_time_s"] = wall_time
+        report["latency_saved_s"] = baseline_summary["wall_time_s"] - wall_time
+        report["baseline_generated_tokens"] = baseline_summary["total_generated_tokens"]
+    return report
+
+
+def print_think_report(report: Dict):
+    print(f"\n🧠 思考预算统计 (预算 {report['think_budget']} token):")
+    print(f"   候选数: {report['candidates']}  强制闭合: {report['forced_close']}")
+    stats = report["think_tokens"]
+    if stats:
+        values = "  ".join(f"p{p}={stats[f'p{p}']:.0f}" for p in PERCENTILES)
+        print(f"   思考 token: {values}  mean={stats['mean']:.1f}  max={stats['max']:.0f}")
+    print(f"   阶段耗时: 思考 {report['phase_seconds']['think']:.2f}s, 回答 {report['phase_seconds']['answer']:.2f}s")
+    if "latency_saved_s" in report:
+        print(f"   相比基线: 墙钟 {report['baseline_wall_time_s']:.2f}s -> {report['wall_time_s']:.2f}s "
+              f"(节省 {report['latency_saved_s']:.2f}s)")
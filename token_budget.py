@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+token_budget.py - 数据生成请求的 token 预算
+
+服务商按 prompt token + max_tokens 计入每分钟 token 限额 (TPM)，固定的 max_tokens=2048
+会为每个请求预留远超实际需要的额度。本模块：
+- 本地统计 prompt 的 token 数（安装了 tiktoken 时使用 gpt-4.1 的 o200k_base 编码，否则按字符估算）
+- 把过长的题目描述截断到预算内（保留开头，按行截断）
+- 按错误代码的长度估算输出所需的 max_tokens：AGENT 输出包含一份代码，
+  EDIT 输出包含原始代码和修改后的代码，约为两倍
+
+使用方法：
+    from token_budget import count_tokens, trim_to_budget, output_max_tokens
+    python token_budget.py outputs/training_data/training_data_full_128.json   # 统计已有数据的实际输出长度
+"""
+
+import argparse
+import json
+import re
+import threading
+from typing import Dict, List
+
+TIKTOKEN_ENCODING = "o200k_base"
+# 输出中 <think> 推理、特殊词符、说明文字和 JSON 包装的开销
+OUTPUT_OVERHEAD_TOKENS = 400
+# 每种类型的输出包含几份代码
+CODE_COPIES = {"agent": 1, "edit": 2}
+OUTPUT_MARGIN = 1.3
+MIN_OUTPUT_TOKENS = 512
+MAX_OUTPUT_TOKENS = 2048
+
+_encoding = None
+_encoding_lock = threading.Lock()
+_CJK = re.compile(r"[\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]")
+
+
+def _get_encoding():
+    """tiktoken 编码器（未安装或加载失败时返回 None，只尝试一次）"""
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None:
+            _encoding = _load_encoding()
+    return _encoding or None
+
+
+def _load_encoding():
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding(TIKTOKEN_ENCODING)
+    except ImportError:
+        print("⚠️  未安装 tiktoken，token 数按字符估算 (pip install tiktoken)")
+    except Exception as e:
+        # 编码文件需要联网下载，离线或缓存损坏时同样退回估算
+        print(f"⚠️  无法加载 tiktoken 编码 {TIKTOKEN_ENCODING}，token 数按字符估算: {e}")
+    return False
+
+
+def count_tokens(text: str) -> int:
+    """prompt 的 token 数；没有 tiktoken 时按 中日韩字符 1 token、其余约 4 字符 1 token 估算"""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def trim_to_budget(text: str, max_tokens: int, suffix: str = "\n...") -> str:
+    """保留开头不超过 max_tokens 的部分，尽量在换行处截断"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    budget = max_tokens - count_tokens(suffix)
+    encoding = _get_encoding()
+    if encoding is not None:
+        head = encoding.decode(encoding.encode(text, disallowed_special=())[:budget])
+    else:
+        # 二分查找不超过预算的最长前缀
+        low, high = 0, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if count_tokens(text[:middle]) <= budget:
+                low = middle
+            else:
+                high = middle - 1
+        head = text[:low]
+    cut = head.rfind("\n")
+    if cut > len(head) // 2:
+        head = head[:cut]
+    return head.rstrip() + suffix
+
+
+def output_max_tokens(code: str, instruction_type: str) -> int:
+    """按代码长度和输出类型估算所需的 max_tokens"""
+    needed = OUTPUT_OVERHEAD_TOKENS + CODE_COPIES.get(instruction_type, 2) * count_tokens(code)
+    return max(MIN_OUTPUT_TOKENS, min(MAX_OUTPUT_TOKENS, int(needed * OUTPUT_MARGIN)))
+
+
+def new_usage_stats() -> Dict:
+    return {"requests": 0, "prompt_tokens": 0, "max_tokens": 0, "fixed_max_tokens": 0, "trimmed": 0,
+            "length_retries": 0}
+
+
+def update_usage_stats(stats: Dict, prompt_tokens: int, max_tokens: int, fixed_max_tokens: int,
+                       trimmed: bool = False):
+    stats["requests"] += 1
+    stats["prompt_tokens"] += prompt_tokens
+    stats["max_tokens"] += max_tokens
+    stats["fixed_max_tokens"] += fixed_max_tokens
+    stats["trimmed"] += int(trimmed)
+
+
+def print_usage_stats(usage: Dict[str, Dict]):
+    print("\n🧮 请求 token 预算 (计入 TPM 的 prompt + max_tokens):")
+    for stage, stats in usage.items():
+        if not stats["requests"]:
+            continue
+        reserved = stats["prompt_tokens"] + stats["max_tokens"]
+        fixed = stats["prompt_tokens"] + stats["fixed_max_tokens"]
+        saving = (1 - reserved / fixed) * 100 if fixed else 0.0
+        print(f"   {stage}: {stats['requests']} 次请求, 平均 prompt {stats['prompt_tokens'] / stats['requests']:.0f}, "
+              f"平均 max_tokens {stats['max_tokens'] / stats['requests']:.0f}, 预留 {reserved} "
+              f"(固定 max_tokens 时 {fixed}, 节省 {saving:.1f}%), 截断题目 {stats['trimmed']} 次, "
+              f"因长度截断重试 {stats['length_retries']} 次")
+
+
+def output_length_report(results: List[Dict]) -> Dict:
+    """已有生成结果中，实际输出 token 数与 output_max_tokens 估算值的对比"""
+    report = {}
+    for item in results:
+        if not item.get("output") or not item.get("buggy_code"):
+            continue
+        kind = item.get("expected_type", "edit")
+        entry = report.setdefault(kind, {"samples": 0, "actual": 0, "budget": 0, "over_budget": 0})
+        actual = count_tokens(item["output"])
+        budget = output_max_tokens(item["buggy_code"], kind)
+        entry["samples"] += 1
+        entry["actual"] += actual
+        entry["budget"] += budget
+        entry["over_budget"] += int(actual > budget)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='统计生成结果的实际输出长度，检查 max_tokens 估算')
+    parser.add_argument('input_file', help='data_constructor.py 的原始输出 (含 buggy_code/output)')
+    args = parser.parse_args()
+
+    with open(args.input_file, 'r', encoding='utf-8') as f:
+        results = json.load(f)
+    print(f"🔤 token 计数: {'tiktoken ' + TIKTOKEN_ENCODING if _get_encoding() else '字符估算 (未安装 tiktoken)'}")
+    for kind, entry in output_length_report(results).items():
+        print(f"   {kind.upper()}: {entry['samples']} 条, 平均实际输出 {entry['actual'] / entry['samples']:.0f}, "
+              f"平均预算 {entry['budget'] / entry['samples']:.0f}, 超出预算 {entry['over_budget']} 条")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+token_store.py - 扁平 uint32 token 存储（内存映射）
+
+目录结构：
+    <store_dir>/
+        tokens.u32      所有序列首尾相接的 token ID (uint32, 小端)
+        offsets.u64     序列起始偏移 (uint64)，长度为 N+1，第 i 条序列为 tokens[offsets[i]:offsets[i+1]]
+        manifest.json   元数据：分词器哈希、序列数、token 总数以及调用方附加的字段
+        <name>.npy      可选：与序列一一对应的附加数组
+
+读取时两个数组都以 np.memmap 打开，切片直接返回视图，不解析、不复制。
+"""
+
+import hashlib
+import json
+import os
+from typing import Dict, Iterable, Iterator, Optional, Sequence
+
+import numpy as np
+
+TOKENS_FILE = "tokens.u32"
+OFFSETS_FILE = "offsets.u64"
+MANIFEST_FILE = "manifest.json"
+TOKEN_DTYPE = np.dtype("<u4")
+OFFSET_DTYPE = np.dtype("<u8")
+FORMAT_VERSION = 1
+
+
+def sha256_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def sha256_text(text: str) -> str:
+    return sha256_bytes(text.encode("utf-8"))
+
+
+def sha256_file(path: str, chunk_size: int = 1 << 20) -> str:
+    """流式计算文件的 sha256"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def tokenizer_hash(tokenizer) -> str:
+    """
+    计算分词器内容哈希（词表、合并规则、added tokens）
+
+    快速分词器直接序列化 tokenizer.json；慢速分词器退化为词表哈希。
+    """
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        return sha256_text(backend.to_str())
+    vocab = sorted(tokenizer.get_vocab().items(), key=lambda item: item[1])
+    return sha256_text(json.dumps(vocab, ensure_ascii=False))
+
+
+def special_token_ids(tokenizer) -> Dict[str, int]:
+    """附加特殊词符 -> ID，写入 manifest 便于离线校验"""
+    return {
+        token: tokenizer.convert_tokens_to_ids(token)
+        for token in getattr(tokenizer, "additional_special_tokens", [])
+    }
+
+
+def write_token_store(store_dir: str, sequences: Iterable[Sequence[int]], manifest: Optional[Dict] = None,
+                      arrays: Optional[Dict[str, np.ndarray]] = None) -> Dict:
+    """
+    流式写入 token 存储
+
+    Args:
+        store_dir: 输出目录
+        sequences: token ID 序列的可迭代对象，逐条写入，不需要整体放入内存
+        manifest: 附加到 manifest.json 的元数据
+        arrays: 与序列一一对应的附加数组（如 prompt 长度），保存为 <name>.npy
+
+    Returns:
+        dict: 写入的 manifest
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    tokens_path = os.path.join(store_dir, TOKENS_FILE)
+    offsets = [0]
+
+    # 先写临时文件再替换，避免中断后留下与 manifest 不一致的存储
+    with open(tokens_path + ".tmp", "wb") as f:
+        for ids in sequences:
+            data = np.asarray(ids, dtype=TOKEN_DTYPE)
+            f.write(data.tobytes())
+            offsets.append(offsets[-1] + len(data))
+    os.replace(tokens_path + ".tmp", tokens_path)
+
+    offsets_path = os.path.join(store_dir, OFFSETS_FILE)
+    np.asarray(offsets, dtype=OFFSET_DTYPE).tofile(offsets_path + ".tmp")
+    os.replace(offsets_path + ".tmp", offsets_path)
+
+    num_sequences = len(offsets) - 1
+    array_names = []
+    for name, values in (arrays or {}).items():
+        values = np.asarray(values)
+        if len(values) != num_sequences:
+            raise ValueError(f"附加数组 {name} 长度 {len(values)} 与序列数 {num_sequences} 不一致")
+        np.save(os.path.join(store_dir, f"{name}.npy"), values)
+        array_names.append(name)
+
+    full_manifest = dict(manifest or {})
+    full_manifest.update({
+        "format_version": FORMAT_VERSION,
+        "token_dtype": TOKEN_DTYPE.str,
+        "offset_dtype": OFFSET_DTYPE.str,
+        "num_sequences": num_sequences,
+        "total_tokens": offsets[-1],
+        "arrays": array_names,
+    })
+    with open(os.path.join(store_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(full_manifest, f, ensure_ascii=False, indent=2)
+
+    return full_manifest
+
+
+def read_manifest(store_dir: str) -> Optional[Dict]:
+    """读取 manifest，不存在时返回 None"""
+    path = os.path.join(store_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class TokenStore:
+    """只读的内存映射 token 存储，store[i] 返回第 i 条序列的 uint32 视图"""
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        self.manifest = read_manifest(store_dir)
+        if self.manifest is None:
+            raise FileNotFoundError(f"找不到 token 存储: {store_dir}")
+
+        self.offsets = np.memmap(os.path.join(store_dir, OFFSETS_FILE), dtype=OFFSET_DTYPE, mode="r")
+        if self.manifest["total_tokens"] > 0:
+            self.tokens = np.memmap(os.path.join(store_dir, TOKENS_FILE), dtype=TOKEN_DTYPE, mode="r")
+        else:
+            # 空文件无法 memmap
+            self.tokens = np.zeros(0, dtype=TOKEN_DTYPE)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        if index < 0:
+            index += len(self)
+        return self.tokens[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def lengths(self) -> np.ndarray:
+        """每条序列的 token 数"""
+        return np.diff(self.offsets).astype(np.int64)
+
+    def array(self, name: str) -> np.ndarray:
+        """以内存映射方式读取附加数组"""
+        return np.load(os.path.join(self.store_dir, f"{name}.npy"), mmap_mode="r")
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+token_validator.py - 推理时基于 token ID 的输出格式校验
+
+output_checker.py 在生成结束后对解码文本做正则检查；这里直接消费生成中的 token ID，
+用一个小状态机在生成过程中发现格式错误：
+
+    start ──<think>──> think ──</think>──> after_think ──<|AGENT|>/<|EDIT|>──> after_marker
+          ──{"name": "python"/"editor"──> tool_call ──JSON 闭合──> done
+
+<think> / </think> / <|AGENT|> / <|EDIT|> 都是单个 ID，只有函数调用 JSON 需要看 token 文本
+（逐字符跟踪字符串和花括号深度）。发现违规时可以：
+- flag: 只记录
+- abort: 立即结束该请求（finish_reason="abort"），不再把 token 花在会被丢弃的输出上
+- steer: 在可以纠正的位置约束下一个 token（开头只允许 <think>、</think> 之后只允许标记、
+  思考超出上限时强制 </think>），无法纠正的违规仍然中止
+"""
+
+import re
+from typing import Dict, List, Optional, Sequence
+
+VALIDATE_ACTIONS = ("none", "flag", "abort", "steer")
+# 标记 -> 之后应调用的函数，与 output_checker.check_single_output 一致
+EXPECTED_FUNCTION = {"AGENT": "python", "EDIT": "editor"}
+FUNCTION_CALL_PATTERN = re.compile(r'\{\s*"name"\s*:\s*"([^"]*)"')
+# 增量匹配函数调用开头时回看的字符数
+_SEARCH_OVERLAP = 64
+
+
+class TokenFormatSpec:
+    """
+    与分词器相关的格式常量，所有请求共享
+
+    Args:
+        tokenizer: 带特殊词符的分词器
+        eos_token_ids: 结束 token（不参与状态机）
+        max_think_tokens: 思考部分 token 上限，None 表示不限制
+        max_preamble_tokens: </think> 之后、标记之前允许的非空白 token 数
+    """
+
+    def __init__(self, tokenizer, eos_token_ids: Sequence[int] = (), max_think_tokens: Optional[int] = None,
+                 max_preamble_tokens: int = 16):
+        self.tokenizer = tokenizer
+        self.think_start_id = tokenizer.convert_tokens_to_ids("<think>")
+        self.think_end_id = tokenizer.convert_tokens_to_ids("</think>")
+        self.marker_ids = {
+            tokenizer.convert_tokens_to_ids("<|AGENT|>"): "AGENT",
+            tokenizer.convert_tokens_to_ids("<|EDIT|>"): "EDIT",
+        }
+        eos_ids = set(eos_token_ids)
+        if tokenizer.eos_token_id is not None:
+            eos_ids.add(tokenizer.eos_token_id)
+        im_end = tokenizer.convert_tokens_to_ids("<|im_end|>")
+        if isinstance(im_end, int) and im_end != tokenizer.unk_token_id:
+            eos_ids.add(im_end)
+        self.eos_token_ids = eos_ids
+        # 引导时允许出现在特殊 token 之间的换行
+        self.newline_ids = set(tokenizer.encode("\n", add_special_tokens=False)
+                               + tokenizer.encode("\n\n", add_special_tokens=False))
+        self.max_think_tokens = max_think_tokens
+        self.max_preamble_tokens = max_preamble_tokens
+        self._pieces: Dict[int, str] = {}
+
+    def piece(self, token_id: int) -> str:
+        """单个 token 的文本（缓存）；字节级分词中不完整的 UTF-8 片段不影响括号和引号"""
+        text = self._pieces.get(token_id)
+        if text is None:
+            text = self.tokenizer.decode([token_id], skip_special_tokens=False)
+            self._pieces[token_id] = text
+        return text
+
+
+class TokenFormatValidator:
+    """单条生成序列的格式状态机"""
+
+    def __init__(self, spec: TokenFormatSpec, action: str = "flag", prompt_ids: Optional[Sequence[int]] = None):
+        if action not in VALIDATE_ACTIONS:
+            raise ValueError(f"未知的校验动作: {action} (可选: {', '.join(VALIDATE_ACTIONS)})")
+        self.spec = spec
+        self.action = action
+        self.state = "start"
+        # prompt 末尾已有 <think>（对话模板）或 </think>（思考预算的第二阶段）时从对应状态开始
+        if prompt_ids is not None and len(prompt_ids):
+            last = self._last_non_newline(prompt_ids)
+            if last == spec.think_start_id:
+                self.state = "think"
+            elif last == spec.think_end_id:
+                self.state = "after_think"
+        self._initial_state = self.state
+        self.position = 0
+        self.think_tokens = 0
+        self.preamble_tokens = 0
+        self.mode: Optional[str] = None
+        self.violation: Optional[Dict] = None
+        self._buffer = ""
+        self._search_from = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._fed = 0
+
+    def _last_non_newline(self, ids: Sequence[int]) -> Optional[int]:
+        for token_id in reversed(list(ids[-4:])):
+            if int(token_id) not in self.spec.newline_ids:
+                return int(token_id)
+        return None
+
+    def clone(self) -> "TokenFormatValidator":
+        """vLLM 对 n > 1 的请求会克隆 logits processor，每个序列各自一份状态"""
+        validator = TokenFormatValidator(self.spec, self.action)
+        validator.state = validator._initial_state = self._initial_state
+        return validator
+
+    def _violate(self, kind: str, detail: str) -> Dict:
+        self.violation = {"type": kind, "position": self.position, "detail": detail}
+        return self.violation
+
+    def _feed_json(self, text: str):
+        """逐字符跟踪 JSON 字符串和花括号深度，对象闭合时进入 done"""
+        for char in text:
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    self.state = "done"
+                    return
+
+    def step(self, token_id: int) -> Optional[Dict]:
+        """消费一个生成的 token，返回本步新出现的违规（没有则 None）"""
+        if self.violation is not None or token_id in self.spec.eos_token_ids:
+            return None
+        spec = self.spec
+        self.position += 1
+
+        if self.state == "start":
+            if token_id == spec.think_start_id:
+                self.state = "think"
+            elif spec.piece(token_id).strip():
+                return self._violate("missing_think", "输出没有以 <think> 开头")
+        elif self.state == "think":
+            if token_id == spec.think_end_id:
+                self.state = "after_think"
+            else:
+                self.think_tokens += 1
+                if spec.max_think_tokens is not None and self.think_tokens > spec.max_think_tokens:
+                    return self._violate("think_too_long", f"思考部分超过 {spec.max_think_tokens} 个 token")
+        elif self.state == "after_think":
+            if token_id in spec.marker_ids:
+                self.mode = spec.marker_ids[token_id]
+                self.state = "after_marker"
+            elif spec.piece(token_id).strip():
+                self.preamble_tokens += 1
+                if self.preamble_tokens > spec.max_preamble_tokens:
+                    return self._violate("missing_marker", "</think> 之后没有 <|AGENT|> 或 <|EDIT|>")
+        elif self.state == "after_marker":
+            self._buffer += spec.piece(token_id)
+            match = FUNCTION_CALL_PATTERN.search(self._buffer, self._search_from)
+            if match is None:
+                self._search_from = max(0, len(self._buffer) - _SEARCH_OVERLAP)
+            else:
+                expected = EXPECTED_FUNCTION[self.mode]
+                if match.group(1) != expected:
+                    return self._violate("wrong_function",
+                                         f"<|{self.mode}|> 后调用了 {match.group(1)}，应为 {expected}")
+                self.state = "tool_call"
+                self._feed_json(self._buffer[match.start():])
+                self._buffer = ""
+        elif self.state == "tool_call":
+            self._feed_json(spec.piece(token_id))
+        return None
+
+    def finish(self) -> Optional[Dict]:
+        """生成结束（eos 或达到 max_tokens）时检查是否停在了不完整的状态"""
+        if self.violation is not None:
+            return None
+        if self.state in ("start", "think"):
+            return self._violate("unterminated_think", "生成结束时 <think> 部分未闭合")
+        if self.state == "after_think":
+            return self._violate("missing_marker", "生成结束时仍没有 <|AGENT|> 或 <|EDIT|>")
+        if self.state == "after_marker":
+            return self._violate("missing_tool_call", f"<|{self.mode}|> 之后没有函数调用")
+        if self.state == "tool_call":
+            return self._violate("unterminated_tool_call", "生成结束时函数调用 JSON 未闭合")
+        return None
+
+    @property
+    def should_abort(self) -> bool:
+        return self.violation is not None and self.action in ("abort", "steer")
+
+    def allowed_token_ids(self) -> Optional[List[int]]:
+        """steer 模式下对下一个 token 的约束，None 表示不约束"""
+        if self.action != "steer" or self.violation is not None:
+            return None
+        spec = self.spec
+        if self.state == "start":
+            return [spec.think_start_id] + sorted(spec.newline_ids)
+        if self.state == "think" and spec.max_think_tokens is not None and self.think_tokens >= spec.max_think_tokens:
+            return [spec.think_end_id]
+        if self.state == "after_think":
+            return sorted(spec.marker_ids) + sorted(spec.newline_ids)
+        return None
+
+    def __call__(self, output_token_ids: Sequence[int], logits):
+        """
+        作为 vLLM（V0 引擎）的 logits processor 使用
+
+        补喂上一步之后新增的 token；中止时只留下 eos，引导时屏蔽约束之外的 token。
+        """
+        for token_id in list(output_token_ids[self._fed:]):
+            self.step(int(token_id))
+        self._fed = len(output_token_ids)
+
+        if self.should_abort:
+            eos_id = next(iter(sorted(self.spec.eos_token_ids)))
+            logits.fill_(float("-inf"))
+            logits[eos_id] = 0.0
+            return logits
+        allowed = self.allowed_token_ids()
+        if allowed is not None:
+            keep = logits[allowed].clone()
+            logits.fill_(float("-inf"))
+            logits[allowed] = keep
+        return logits
+
+
+def validate_token_ids(spec: TokenFormatSpec, token_ids: Sequence[int], prompt_ids: Optional[Sequence[int]] = None,
+                       finished: bool = True) -> Optional[Dict]:
+    """对完整的生成结果回放状态机，返回第一个违规"""
+    validator = TokenFormatValidator(spec, "flag", prompt_ids)
+    for token_id in token_ids:
+        violation = validator.step(int(token_id))
+        if violation is not None:
+            return violation
+    return validator.finish() if finished else None
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+tokenizer_registry.py - 带版本的分词器产物缓存
+
+以 基座分词器文件内容 + 添加的特殊词符 的哈希作为键：
+- 只有键变化（基座文件或特殊词符改变）时才重新构建，否则直接复用已有产物
+- 产物目录就是 ./tokenizer_with_special_tokens（vLLM 等仍按目录加载），
+  其中的 tokenizer.json 是快速路径所需的唯一序列化文件，registry.json 记录键和特殊词符 ID
+- 各入口通过 get_tokenizer() 延迟加载，同一进程内只构造一次
+
+使用方法：
+    python tokenizer_registry.py            # 按需构建并打印产物信息
+    python tokenizer_registry.py --force    # 强制重建
+"""
+
+import argparse
+import json
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from token_store import sha256_file, sha256_text, tokenizer_hash
+
+BASE_MODEL_PATH = "/home/share/models/Qwen3-8B"
+ARTIFACT_DIR = "./tokenizer_with_special_tokens"
+SPECIAL_TOKENS = ["<|AGENT|>", "<|EDIT|>"]
+REGISTRY_FILE = "registry.json"
+FAST_TOKENIZER_FILE = "tokenizer.json"
+# 参与哈希的基座分词器文件（不存在的跳过）
+BASE_TOKENIZER_FILES = (
+    "tokenizer.json", "tokenizer_config.json", "vocab.json", "merges.txt",
+    "special_tokens_map.json", "added_tokens.json", "tokenizer.model",
+)
+
+_tokenizers: Dict[str, object] = {}
+_lock = threading.Lock()
+
+
+def registry_key(base_path: str, added_tokens: List[str]) -> str:
+    """基座分词器文件 + 特殊词符的哈希"""
+    files = {
+        name: sha256_file(os.path.join(base_path, name))
+        for name in BASE_TOKENIZER_FILES
+        if os.path.exists(os.path.join(base_path, name))
+    }
+    if not files:
+        raise FileNotFoundError(f"在 {base_path} 下找不到分词器文件")
+    return sha256_text(json.dumps({"files": files, "added_tokens": added_tokens}, sort_keys=True))
+
+
+def read_registry(artifact_dir: str = ARTIFACT_DIR) -> Optional[Dict]:
+    path = os.path.join(artifact_dir, REGISTRY_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _has_tokenizer_files(artifact_dir: str) -> bool:
+    return os.path.isdir(artifact_dir) and any(
+        os.path.exists(os.path.join(artifact_dir, name)) for name in BASE_TOKENIZER_FILES)
+
+
+def _write_registry(artifact_dir: str, tokenizer, key: Optional[str], base_path: Optional[str],
+                    added_tokens: List[str]) -> Dict:
+    registry = {
+        "key": key,
+        "base_path": base_path,
+        "added_tokens": added_tokens,
+        "special_token_ids": {token: tokenizer.convert_tokens_to_ids(token) for token in added_tokens},
+        "vocab_size": len(tokenizer),
+        "tokenizer_hash": tokenizer_hash(tokenizer),
+    }
+    try:
+        with open(os.path.join(artifact_dir, REGISTRY_FILE), 'w', encoding='utf-8') as f:
+            json.dump(registry, f, ensure_ascii=False, indent=2)
+    except OSError as e:
+        print(f"⚠️  无法写入 {REGISTRY_FILE}: {e}")
+    with _lock:
+        _tokenizers[artifact_dir] = tokenizer
+    return registry
+
+
+def ensure_tokenizer_artifact(base_path: str = BASE_MODEL_PATH, added_tokens: Optional[List[str]] = None,
+                              artifact_dir: str = ARTIFACT_DIR, force: bool = False) -> Tuple[Dict, bool]:
+    """
+    确保产物与输入一致，必要时重新构建
+
+    基座分词器文件无法哈希（例如只拷贝了产物的机器）时直接信任已有产物；
+    旧版 hw3_1 生成的产物没有 registry.json，此时按原样加载并补写（key 为 None，基座可用时会重建一次）。
+
+    Returns:
+        tuple: (registry 信息, 本次是否重新构建)
+    """
+    added_tokens = list(added_tokens or SPECIAL_TOKENS)
+    registry = read_registry(artifact_dir)
+    has_artifact = registry is not None and os.path.exists(os.path.join(artifact_dir, FAST_TOKENIZER_FILE))
+
+    try:
+        key = registry_key(base_path, added_tokens)
+    except OSError:
+        if force or not _has_tokenizer_files(artifact_dir):
+            raise FileNotFoundError(f"基座分词器 {base_path} 不可用，且 {artifact_dir} 中没有可用产物")
+        if registry is None:
+            from transformers import AutoTokenizer
+
+            print(f"⚠️  基座分词器 {base_path} 不可用，按原样使用 {artifact_dir}")
+            tokenizer = AutoTokenizer.from_pretrained(artifact_dir, trust_remote_code=True)
+            registry = _write_registry(artifact_dir, tokenizer, None, None, added_tokens)
+        return registry, False
+
+    if has_artifact and not force and registry.get("key") == key:
+        return registry, False
+
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(base_path, trust_remote_code=True)
+    tokenizer.add_special_tokens({'additional_special_tokens': added_tokens})
+    tokenizer.save_pretrained(artifact_dir)
+    return _write_registry(artifact_dir, tokenizer, key, base_path, added_tokens), True
+
+
+def get_tokenizer(path: str = ARTIFACT_DIR):
+    """
+    延迟加载分词器，同一进程内按路径缓存
+
+    默认产物目录会先检查是否需要重建；其他路径（如训练用的基座模型）直接加载。
+    """
+    with _lock:
+        tokenizer = _tokenizers.get(path)
+    if tokenizer is not None:
+        return tokenizer
+
+    if os.path.normpath(path) == os.path.normpath(ARTIFACT_DIR):
+        ensure_tokenizer_artifact(artifact_dir=path)
+
+    from transformers import AutoTokenizer
+
+    with _lock:
+        if path not in _tokenizers:
+            _tokenizers[path] = AutoTokenizer.from_pretrained(path, trust_remote_code=True)
+        return _tokenizers[path]
+
+
+def get_fast_tokenizer(path: str = ARTIFACT_DIR):
+    """只需要编码/解码时直接加载 tokenizer.json（tokenizers 库），跳过 transformers 的构造"""
+    from tokenizers import Tokenizer
+
+    return Tokenizer.from_file(os.path.join(path, FAST_TOKENIZER_FILE))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='构建/检查带特殊词符的分词器产物')
+    parser.add_argument('--base', default=BASE_MODEL_PATH, help=f'基座分词器路径 (默认: {BASE_MODEL_PATH})')
+    parser.add_argument('--artifact-dir', default=ARTIFACT_DIR, help=f'产物目录 (默认: {ARTIFACT_DIR})')
+    parser.add_argument('--force', action='store_true', help='忽略缓存强制重建')
+    args = parser.parse_args()
+
+    registry, built = ensure_tokenizer_artifact(args.base, SPECIAL_TOKENS, args.artifact_dir, args.force)
+    print(f"{'🔨 已重新构建' if built else '✅ 复用已有'}分词器产物: {args.artifact_dir}")
+    print(f"   键: {(registry['key'] or '未记录 (旧产物)')[:16]}  词表大小: {registry['vocab_size']}")
+    print(f"   特殊词符: {registry['special_token_ids']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+train_analytics.py - 训练运行分析与吞吐回归检测
+
+LLaMA-Factory 在 training_log/<run>/ 下保存 trainer_log.jsonl、train_results.json 和 running_log.txt。
+本脚本逐行流式解析所有运行目录，生成两张列式表：
+- 步级表：run / step / epoch / loss / lr / elapsed_s / total_tokens / 区间 tokens/s
+- 运行级表：稳态 tokens/s、每步耗时、samples/s、最终 loss、批大小等
+
+trainer_log 中的 throughput 是从训练开始算起的累计平均，包含模型加载、编译等启动开销，
+会随训练逐渐上升；稳态吞吐跳过前 --warmup 比例的日志点，只用之后的 token 增量 / 时间增量计算。
+
+每个运行与保存的基线比较，稳态 tokens/s 下降超过 --threshold 时标记为回归；
+训练曲线（loss、区间吞吐）从日志直接绘制，无需重新训练。
+
+使用方法：
+    python train_analytics.py                                              # 分析 training_log/ 下所有运行
+    python train_analytics.py --set-baseline train_2025-07-18-01-18-07     # 保存基线
+    python train_analytics.py --threshold 0.05 --strict                    # 有回归时退出码为 1
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+
+import pandas as pd
+
+LOG_ROOT = "training_log"
+REPORT_DIR = "outputs/reports"
+BASELINE_FILE = os.path.join(REPORT_DIR, "train_baseline.json")
+TRAINER_LOG = "trainer_log.jsonl"
+TRAIN_RESULTS = "train_results.json"
+RUNNING_LOG = "running_log.txt"
+
+# running_log.txt 中的 Unsloth/Trainer 启动信息
+RUNNING_LOG_PATTERNS = {
+    "num_examples": re.compile(r"Num examples = ([\d,]+)"),
+    "num_epochs": re.compile(r"Num Epochs = ([\d,]+)"),
+    "total_steps": re.compile(r"Total steps = ([\d,]+)"),
+    "per_device_batch_size": re.compile(r"Batch size per device = ([\d,]+)"),
+    "gradient_accumulation_steps": re.compile(r"Gradient accumulation steps = ([\d,]+)"),
+    "num_gpus": re.compile(r"Data Parallel GPUs = ([\d,]+)"),
+    "total_batch_size": re.compile(r"Total batch size \(.*?\) = ([\d,]+)"),
+    "trainable_params": re.compile(r"trainable params: ([\d,]+)"),
+}
+LOG_TIMESTAMP = re.compile(r"^\[\w+\|(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})\]")
+
+
+# ==================== 解析 ====================
+
+def discover_runs(root: str = LOG_ROOT) -> List[str]:
+    """包含 trainer_log.jsonl 的运行目录，按名称排序"""
+    if not os.path.isdir(root):
+        return []
+    return [os.path.join(root, name) for name in sorted(os.listdir(root))
+            if os.path.exists(os.path.join(root, name, TRAINER_LOG))]
+
+
+def parse_elapsed(value) -> Optional[float]:
+    """"H:MM:SS" 或 "D day, H:MM:SS" -> 秒"""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    days = 0
+    if "day" in value:
+        day_part, value = value.split(",", 1)
+        days = int(day_part.split()[0])
+    parts = [float(part) for part in value.strip().split(":")]
+    seconds = 0.0
+    for part in parts:
+        seconds = seconds * 60 + part
+    return days * 86400 + seconds
+
+
+def iter_trainer_log(path: str) -> Iterator[Dict]:
+    """逐行读取 trainer_log.jsonl；训练中断时最后一行可能不完整，直接跳过"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def parse_running_log(path: str) -> Dict:
+    """逐行提取批大小、样本数等启动信息，以及首末日志时间"""
+    info = {}
+    if not os.path.exists(path):
+        return info
+    first_time = last_time = None
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            match = LOG_TIMESTAMP.match(line)
+            if match:
+                timestamp = datetime.strptime(match.group(1), "%Y-%m-%d %H:%M:%S")
+                first_time = first_time or timestamp
+                last_time = timestamp
+            for key, pattern in RUNNING_LOG_PATTERNS.items():
+                if key not in info:
+                    found = pattern.search(line)
+                    if found:
+                        info[key] = int(found.group(1).replace(",", ""))
+    if first_time and last_time:
+        info["started_at"] = first_time.strftime("%Y-%m-%d %H:%M:%S")
+        info["log_span_s"] = (last_time - first_time).total_seconds()
+    return info
+
+
+def load_run_steps(run_dir: str) -> List[Dict]:
+    """
+    步级记录：每个 current_steps 只保留第一条带 loss 的日志
+
+    训练结束时 LLaMA-Factory 会再写一条同步数、不带 loss 的汇总行，这里丢弃。
+    """
+    run = os.path.basename(os.path.normpath(run_dir))
+    rows, seen = [], set()
+    previous = None
+    for entry in iter_trainer_log(os.path.join(run_dir, TRAINER_LOG)):
+        step = entry.get("current_steps")
+        if step is None or step in seen or "loss" not in entry:
+            continue
+        seen.add(step)
+        row = {
+            "run": run,
+            "step": step,
+            "total_steps": entry.get("total_steps"),
+            "epoch": entry.get("epoch"),
+            "loss": entry.get("loss"),
+            "lr": entry.get("lr"),
+            "elapsed_s": parse_elapsed(entry.get("elapsed_time")),
+            "total_tokens": entry.get("total_tokens"),
+            "cumulative_tokens_per_s": entry.get("throughput"),
+            "interval_tokens_per_s": None,
+            "interval_s_per_step": None,
+        }
+        if previous and row["elapsed_s"] is not None and previous["elapsed_s"] is not None:
+            dt = row["elapsed_s"] - previous["elapsed_s"]
+            if dt > 0:
+                if row["total_tokens"] is not None and previous["total_tokens"] is not None:
+                    row["interval_tokens_per_s"] = (row["total_tokens"] - previous["total_tokens"]) / dt
+                row["interval_s_per_step"] = dt / (step - previous["step"])
+        rows.append(row)
+        previous = row
+    return rows
+
+
+# ==================== 指标 ====================
+
+def steady_state(steps: List[Dict], warmup: float) -> Dict:
+    """
+    跳过前 warmup 比例的日志点（至少跳过第一个点，它包含启动开销），
+    用剩余区间的 token / 步数增量除以时间增量
+    """
+    usable = [row for row in steps if row["elapsed_s"] is not None]
+    if len(usable) < 2:
+        return {}
+    skip = min(max(1, int(len(usable) * warmup)), len(usable) - 2)
+    start, end = usable[skip], usable[-1]
+    dt = end["elapsed_s"] - start["elapsed_s"]
+    if dt <= 0:
+        return {}
+    result = {
+        "warmup_steps": start["step"],
+        "steady_s_per_step": dt / (end["step"] - start["step"]),
+    }
+    if start["total_tokens"] is not None and end["total_tokens"] is not None:
+        result["steady_tokens_per_s"] = (end["total_tokens"] - start["total_tokens"]) / dt
+    return result
+
+
+def summarize_run(run_dir: str, warmup: float = 0.2):
+    """
+    运行级汇总：trainer_log + train_results + running_log
+
+    Returns:
+        tuple: (运行汇总, 步级记录列表)
+    """
+    steps = load_run_steps(run_dir)
+    summary = {"run": os.path.basename(os.path.normpath(run_dir)), "logged_steps": len(steps)}
+
+    results_path = os.path.join(run_dir, TRAIN_RESULTS)
+    if os.path.exists(results_path):
+        with open(results_path, 'r', encoding='utf-8') as f:
+            results = json.load(f)
+        summary.update({
+            "train_runtime_s": results.get("train_runtime"),
+            "train_loss": results.get("train_loss"),
+            "reported_samples_per_s": results.get("train_samples_per_second"),
+            "reported_steps_per_s": results.get("train_steps_per_second"),
+            "num_input_tokens_seen": results.get("num_input_tokens_seen"),
+        })
+    summary.update(parse_running_log(os.path.join(run_dir, RUNNING_LOG)))
+
+    if steps:
+        last = steps[-1]
+        summary["final_step"] = last["step"]
+        summary["final_loss"] = last["loss"]
+        summary["cumulative_tokens_per_s"] = last["cumulative_tokens_per_s"]
+    summary.update(steady_state(steps, warmup))
+    if summary.get("steady_s_per_step") and summary.get("total_batch_size"):
+        summary["steady_samples_per_s"] = summary["total_batch_size"] / summary["steady_s_per_step"]
+    return summary, steps
+
+
+def compare_to_baseline(summaries: List[Dict], baseline: Dict, threshold: float) -> List[Dict]:
+    """稳态 tokens/s（缺失时用 s/step）相对基线的变化，下降超过 threshold 记为回归"""
+    comparisons = []
+    for summary in summaries:
+        if summary["run"] == baseline.get("run"):
+            continue
+        if summary.get("steady_tokens_per_s") and baseline.get("steady_tokens_per_s"):
+            metric, ratio = "steady_tokens_per_s", summary["steady_tokens_per_s"] / baseline["steady_tokens_per_s"]
+        elif summary.get("steady_s_per_step") and baseline.get("steady_s_per_step"):
+            metric, ratio = "steady_s_per_step", baseline["steady_s_per_step"] / summary["steady_s_per_step"]
+        else:
+            continue
+        comparisons.append({
+            "run": summary["run"],
+            "baseline": baseline["run"],
+            "metric": metric,
+            "ratio": ratio,
+            "regression": ratio < 1 - threshold,
+        })
+    return comparisons
+
+
+# ==================== 输出 ====================
+
+def plot_runs(steps: pd.DataFrame, output_dir: str) -> List[str]:
+    """每个指标一张图，所有运行叠加；未安装 matplotlib 时跳过"""
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("⚠️  未安装 matplotlib，跳过绘图 (pip install matplotlib)")
+        return []
+
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for column, label in (("loss", "loss"), ("interval_tokens_per_s", "tokens/s (interval)"),
+                          ("interval_s_per_step", "s/step (interval)")):
+        fig, ax = plt.subplots(figsize=(8, 4.5))
+        for run, group in steps.groupby("run"):
+            data = group.dropna(subset=[column])
+            if not data.empty:
+                ax.plot(data["step"], data[column], marker="o", label=run)
+        ax.set_xlabel("step")
+        ax.set_ylabel(label)
+        ax.grid(alpha=0.3)
+        ax.legend(fontsize=8)
+        path = os.path.join(output_dir, f"{column}.png")
+        fig.tight_layout()
+        fig.savefig(path, dpi=120)
+        plt.close(fig)
+        paths.append(path)
+    return paths
+
+
+def print_runs(summaries: List[Dict], comparisons: List[Dict]):
+    def f(value, fmt):
+        return format(value, fmt) if value is not None else "-"
+
+    flagged = {item["run"]: item for item in comparisons}
+    print(f"\n📊 训练运行汇总 ({len(summaries)} 个):")
+    print(f"{'运行':<32}{'步数':>6}{'稳态tok/s':>12}{'s/step':>9}{'samples/s':>11}{'最终loss':>10}{'对比基线':>12}")
+    print("-" * 92)
+    for summary in summaries:
+        comparison = flagged.get(summary["run"])
+        if comparison:
+            mark = "❌" if comparison["regression"] else "✅"
+            delta = f"{mark}{(comparison['ratio'] - 1) * 100:+.1f}%"
+        else:
+            delta = "基线" if summary.get("is_baseline") else "-"
+        print(f"{summary['run']:<32}{f(summary.get('final_step'), 'd'):>6}"
+              f"{f(summary.get('steady_tokens_per_s'), '.0f'):>12}{f(summary.get('steady_s_per_step'), '.2f'):>9}"
+              f"{f(summary.get('steady_samples_per_s'), '.2f'):>11}{f(summary.get('final_loss'), '.4f'):>10}{delta:>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='训练运行分析与吞吐回归检测')
+    parser.add_argument('runs', nargs='*', help=f'运行目录 (默认: {LOG_ROOT}/ 下所有包含 {TRAINER_LOG} 的目录)')
+    parser.add_argument('--log-root', default=LOG_ROOT, help=f'训练日志根目录 (默认: {LOG_ROOT})')
+    parser.add_argument('--warmup', type=float, default=0.2, help='计算稳态吞吐时跳过的日志点比例 (默认: 0.2)')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help=f'基线文件 (默认: {BASELINE_FILE})')
+    parser.add_argument('--set-baseline', metavar='RUN', help='把该运行的汇总保存为基线')
+    parser.add_argument('--threshold', type=float, default=0.1, help='吞吐下降超过该比例记为回归 (默认: 0.1)')
+    parser.add_argument('--strict', action='store_true', help='存在回归时退出码为 1')
+    parser.add_argument('--output-dir', default=REPORT_DIR, help=f'表格和报告目录 (默认: {REPORT_DIR})')
+    parser.add_argument('--no-plots', action='store_true', help='不绘制训练曲线')
+    args = parser.parse_args()
+
+    run_dirs = args.runs or discover_runs(args.log_root)
+    if not run_dirs:
+        print(f"❌ 没有找到训练运行 ({args.log_root}/*/{TRAINER_LOG})")
+        sys.exit(1)
+
+    summaries, all_steps = [], []
+    for run_dir in run_dirs:
+        summary, steps = summarize_run(run_dir, args.warmup)
+        summaries.append(summary)
+        all_steps.extend(steps)
+
+    if args.set_baseline:
+        baseline = next((s for s in summaries if s["run"] == args.set_baseline), None)
+        if baseline is None:
+            parser.error(f"没有找到运行 {args.set_baseline}")
+        os.makedirs(os.path.dirname(args.baseline) or ".", exist_ok=True)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, ensure_ascii=False, indent=2)
+        print(f"📌 已保存基线: {args.set_baseline} -> {args.baseline}")
+
+    comparisons = []
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        for summary in summaries:
+            summary["is_baseline"] = summary["run"] == baseline.get("run")
+        comparisons = compare_to_baseline(summaries, baseline, args.threshold)
+    print_runs(summaries, comparisons)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    steps_frame = pd.DataFrame(all_steps)
+    steps_path = os.path.join(args.output_dir, "training_steps.csv")
+    runs_path = os.path.join(args.output_dir, "training_runs.csv")
+    steps_frame.to_csv(steps_path, index=False)
+    pd.DataFrame(summaries).to_csv(runs_path, index=False)
+    with open(os.path.join(args.output_dir, "training_analytics.json"), 'w', encoding='utf-8') as f:
+        json.dump({"warmup": args.warmup, "threshold": args.threshold, "runs": summaries,
+                   "comparisons": comparisons}, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 步级表: {steps_path}，运行表: {runs_path}")
+
+    if not args.no_plots and not steps_frame.empty:
+        for path in plot_runs(steps_frame, os.path.join(args.output_dir, "training_plots")):
+            print(f"📈 {path}")
+
+    regressions = [item for item in comparisons if item["regression"]]
+    for item in regressions:
+        print(f"❌ 吞吐回归: {item['run']} 的 {item['metric']} 为基线 {item['baseline']} 的 "
+              f"{item['ratio'] * 100:.1f}% (阈值 {(1 - args.threshold) * 100:.0f}%)")
+    if regressions and args.strict:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()